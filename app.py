@@ -12,6 +12,7 @@ from numpyencoder import NumpyEncoder
 import fastmot
 import fastmot.models
 from fastmot.utils import ConfigDecoder, Profiler, NpEncoder
+from fastmot.utils.frame import to_bgr
 from fastmot.videoio import VideoIO, Protocol
 
 from logging.handlers import RotatingFileHandler
@@ -103,6 +104,9 @@ def main():
                           help='path to output MOT Challenge format results (e.g. MOT20-01.txt)')
     optional.add_argument('-m', '--mot', action='store_true', help='run multiple object tracker')
     optional.add_argument('-s', '--show', action='store_true', help='show visualizations')
+    optional.add_argument('-p', '--pipeline-depth', metavar="N", type=int, default=0,
+                          help='read and preprocess up to N frames ahead of the tracker\n'
+                          'in a worker thread (0 to run serially)')
     group.add_argument('-q', '--quiet', action='store_true', help='reduce output verbosity')
     group.add_argument('-v', '--verbose', action='store_true', help='increase output verbosity')
     parser._action_groups.append(optional)
@@ -152,21 +156,29 @@ def main():
             label_map = label_file.read().splitlines()
             fastmot.models.set_label_map(label_map)
 
-    stream = fastmot.VideoIO(config.resize_to, args.input_uri, args.output_uri, **vars(config.stream_cfg))
-
     mot = None
     txt = None
     if args.mot:
+        # load models in the background while the stream is opened
         draw = args.show or args.output_uri is not None
         mot = fastmot.MOT(
             config.resize_to, 
-            draw=draw, on_trackevt=partial(on_trackevt, logger=logger, mqtt_client=mqtt_client, feathers_sio_client=feathers_sio_client),
+            draw=draw, pixel_format=config.pixel_format, on_trackevt=partial(on_trackevt, logger=logger, mqtt_client=mqtt_client, feathers_sio_client=feathers_sio_client),
+            lazy_load=True,
             **vars(config.mot_cfg)
         )
-        mot.reset(stream.cap_dt)
+
+    if mot is not None and mot.region_detect:
+        # region crops are taken from native frames, which must keep the source resolution
+        config.stream_cfg.reduced_decode = False
+    stream = fastmot.VideoIO(config.resize_to, args.input_uri, args.output_uri,
+                             pixel_format=config.pixel_format, **vars(config.stream_cfg))
+
     if args.txt is not None:
-        Path(args.txt).parent.mkdir(parents=True, exist_ok=True)
-        txt = open(args.txt, 'w')
+        txt = fastmot.ResultWriter(args.txt, config.resize_to, stream.resolution)
+    if args.mot:
+        mot.result_writer = txt
+        mot.reset(stream.cap_dt)
     if args.show:
         cv2.namedWindow('Video', cv2.WINDOW_AUTOSIZE)
 
@@ -175,28 +187,34 @@ def main():
         txt=txt, stream=stream
     ))
 
+    if args.mot:
+        logger.info('Warming up...')
+        mot.warmup()
     logger.info('Starting video capture...')
     stream.start_capture()
+    pipeline = None
+    if args.mot and args.pipeline_depth > 0:
+        pipeline = fastmot.Pipeline(stream, mot, args.pipeline_depth)
+        frames = iter(pipeline)
     try:
         with Profiler('app') as prof:
             while not args.show or cv2.getWindowProperty('Video', 0) >= 0:
-                frame = stream.read()
+                if pipeline is not None:
+                    # frames are already stepped by the pipeline
+                    frame, timestamp = next(frames, (None, None))
+                else:
+                    frame, timestamp = stream.read(return_timestamp=True)
                 if frame is None:
                     logger.info("No more frame received!")
                     break
 
-                if args.mot:
-                    mot.step(frame)
-                    if txt is not None:
-                        for track in mot.visible_tracks():
-                            tl = track.tlbr[:2] / config.resize_to * stream.resolution
-                            br = track.tlbr[2:] / config.resize_to * stream.resolution
-                            w, h = br - tl + 1
-                            txt.write(f'{mot.frame_count},{track.trk_id},{tl[0]:.6f},{tl[1]:.6f},'
-                                      f'{w:.6f},{h:.6f},-1,-1,-1\n')
+                if args.mot and pipeline is None:
+                    with Profiler('step') as step_prof:
+                        mot.step(frame, timestamp, native_frame=stream.native_frame)
+                    stream.update_latency(step_prof.duration, timestamp)
 
                 if args.show:                   
-                    cv2.imshow('Video', frame)
+                    cv2.imshow('Video', to_bgr(frame, stream.pixel_format))
                     if cv2.waitKey(1) & 0xFF == 27:
                         break
 
@@ -217,6 +235,8 @@ def main():
         if txt is not None:
             txt.close()
         stream.release()
+        if pipeline is not None:
+            pipeline.stop()
         cv2.destroyAllWindows()
 
     # timing statistics
@@ -224,6 +244,9 @@ def main():
         avg_fps = round(mot.frame_count / prof.duration)
         logger.info('Average FPS: %d', avg_fps)
         mot.print_timing_info()
+        stream.print_capture_info()
+        if pipeline is not None:
+            pipeline.print_occupancy_info()
 
 # Too many threads running, impossible to stop without explictly set this procedure
 def on_sigint(app_print, mqtt_client, sio_client, txt, stream):
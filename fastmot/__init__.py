@@ -1,5 +1,7 @@
 from .videoio import VideoIO, Protocol
 from .mot import MOT
+from .results import ResultWriter
+from .pipeline import Pipeline
 from .feature_extractor import FeatureExtractor
 from .tracker import MultiTracker
 from .kalman_filter import KalmanFilter
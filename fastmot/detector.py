@@ -1,4 +1,3 @@
-from collections import defaultdict
 from pathlib import Path
 import configparser
 import abc
@@ -6,13 +5,13 @@ import numpy as np
 import numba as nb
 import cupy as cp
 import cupyx.scipy.ndimage
-import cv2
 
 from . import models
 from .utils import TRTInference
-from .utils.rect import as_tlbr, aspect_ratio, to_tlbr, get_size, area
-from .utils.rect import enclosing, multi_crop, iom, diou_nms
-from .utils.numba import find_split_indices
+from .utils.rect import as_tlbr, aspect_ratio, to_tlbr, get_size, area, get_center
+from .utils.rect import intersection, enclosing, multi_crop, iom
+from .utils.nms import NMSMethod, batched_nms
+from .utils.frame import PixelFormat, frame_size, yuv_planes, resize_to_bgr
 
 import logging
 logger = logging.getLogger(__name__)
@@ -35,6 +34,9 @@ class Detector(abc.ABC):
         self.detect_async(frame)
         return self.postprocess()
 
+    def reset(self):
+        """Resets per-stream state and statistics."""
+
     @abc.abstractmethod
     def detect_async(self, frame):
         raise NotImplementedError
@@ -52,7 +54,9 @@ class SSDDetector(Detector):
                  tiling_grid=(4, 2),
                  conf_thresh=0.5,
                  merge_thresh=0.6,
-                 max_area=120000):
+                 max_area=120000,
+                 tile_refresh_interval=0,
+                 pixel_format='bgr'):
         """An object detector for SSD models.
 
         Parameters
@@ -74,6 +78,11 @@ class SSDDetector(Detector):
             Overlap threshold to merge bounding boxes across tiles.
         max_area : int, optional
             Max area of bounding boxes to detect.
+        tile_refresh_interval : int, optional
+            Infer all tiles every N calls to `select_tiles` and only tiles with tracks
+            or motion otherwise. Set to 0 to always infer all tiles.
+        pixel_format : {'bgr', 'i420', 'nv12'}, optional
+            Layout of input frames. YUV frames are converted after resizing.
         """
         super().__init__(size)
         self.model = models.SSD.get_model(model)
@@ -87,6 +96,9 @@ class SSDDetector(Detector):
         self.merge_thresh = merge_thresh
         assert max_area >= 0
         self.max_area = max_area
+        assert tile_refresh_interval >= 0
+        self.tile_refresh_interval = tile_refresh_interval
+        self.pixel_format = PixelFormat[pixel_format.upper()]
 
         self.label_mask = np.zeros(self.model.NUM_CLASSES, dtype=np.bool_)
         try:
@@ -97,31 +109,136 @@ class SSDDetector(Detector):
         self.batch_size = int(np.prod(self.tiling_grid))
         self.tiles, self.tiling_region_sz = self._generate_tiles()
         self.scale_factor = tuple(np.array(self.size) / self.tiling_region_sz)
+        # tile extents in frame coordinates
+        self.tile_extents = self.tiles + (0, 0, 1, 1)
+        self.tile_extents *= np.tile(self.scale_factor, 2)
         self.backend = TRTInference(self.model, self.batch_size)
         self.inp_handle = self.backend.input.host.reshape(self.batch_size, *self.model.INPUT_SHAPE)
 
-    def detect_async(self, frame):
-        """Detects objects asynchronously."""
-        self._preprocess(frame)
-        self.backend.infer_async()
+        # reusable detection buffers, bounded by top-k detections per tile
+        capacity = self.batch_size * self.model.TOPK
+        self.raw_dets = np.empty(capacity, DET_DTYPE).view(np.recarray)
+        self.raw_tile_ids = np.empty(capacity, np.int64)
+        self.dets = np.empty(capacity, DET_DTYPE).view(np.recarray)
+        # merge scratch buffers, pair buffers grow with the number of overlapping pairs
+        self.merge_tlbrs = np.empty((capacity, 4))
+        self.merge_ids = np.empty((4, capacity + 1), np.int64)
+        self.merge_masks = np.empty((4, capacity), np.bool_)
+        self.max_ioms = np.empty(self.batch_size)
+        self._alloc_pairs(capacity)
+
+        self.reset()
+
+    def reset(self):
+        """Resets tile selection and its statistics."""
+        self.active_tile_ids = np.arange(self.batch_size)
+        # tile skipping statistics
+        self.num_selections = 0
+        self.num_tiles_skipped = 0
+        self.infer_time = {'full': 0., 'partial': 0.}
+        self.infer_count = {'full': 0, 'partial': 0}
+
+    def detect_async(self, frame, tile_ids=None):
+        """Detects objects asynchronously.
+
+        Parameters
+        ----------
+        frame : ndarray
+            Frame to detect objects in.
+        tile_ids : ndarray, optional
+            Indices of tiles to infer, see `select_tiles`.
+            Active tiles are packed into a smaller batch. Defaults to all tiles.
+        """
+        self.active_tile_ids = np.arange(self.batch_size) if tile_ids is None else tile_ids
+        if len(self.active_tile_ids) > 0:
+            self._preprocess(frame)
+            self.backend.infer_async(batch_size=len(self.active_tile_ids))
+
+    def select_tiles(self, tlbrs, motion_pts=None, expand=0.5):
+        """Selects tiles that may contain objects in the next detector frame.
+        A tile is active if it overlaps a track or a moving point. All tiles are
+        selected periodically and when motion is unknown.
+
+        Parameters
+        ----------
+        tlbrs : ndarray
+            Nx4 array of predicted track bounding boxes.
+        motion_pts : ndarray, optional
+            Mx2 array of points moving independently from the camera,
+            e.g. `Flow.bg_outliers`. None if camera motion estimation failed.
+        expand : float, optional
+            Expand track bounding boxes by this ratio of their size to
+            account for motion until the next detector frame.
+
+        Returns
+        -------
+        ndarray
+            Indices of active tiles.
+        """
+        refresh = (self.tile_refresh_interval == 0 or motion_pts is None or
+                   self.num_selections % self.tile_refresh_interval == 0)
+        self.num_selections += 1
+        if refresh:
+            return np.arange(self.batch_size)
+        tile_mask = self._active_tile_mask(self.tile_extents, tlbrs, motion_pts, expand)
+        tile_ids = np.flatnonzero(tile_mask)
+        self.num_tiles_skipped += self.batch_size - len(tile_ids)
+        return tile_ids
+
+    def print_tile_stats(self):
+        """Logs the skipped tile ratio and inference latency saved by tile skipping."""
+        if self.tile_refresh_interval == 0 or self.num_selections == 0:
+            return
+        skipped_ratio = self.num_tiles_skipped / (self.num_selections * self.batch_size)
+        avg_time = {key: self.infer_time[key] / max(self.infer_count[key], 1)
+                    for key in self.infer_time}
+        saved_time = (avg_time['full'] - avg_time['partial']) * self.infer_count['partial']
+        logger.debug(f"{'skipped tile ratio:':<37}{skipped_ratio:>6.3f}")
+        logger.debug(f"{'full batch inference time:':<37}{avg_time['full']:>6.3f} ms")
+        logger.debug(f"{'partial batch inference time:':<37}{avg_time['partial']:>6.3f} ms")
+        logger.debug(f"{'total inference time saved:':<37}{saved_time:>6.3f} ms")
 
     def postprocess(self):
         """Synchronizes, applies postprocessing, and returns a record array
         of detections (DET_DTYPE).
         This API should be called after `detect_async`.
         Detections are sorted in ascending order by class ID.
+        The returned array is a view of a buffer reused by the next call.
         """
+        if len(self.active_tile_ids) == 0:
+            return self.dets[:0]
         det_out = self.backend.synchronize()[0]
-        detections, tile_ids = self._filter_dets(det_out, self.tiles, self.model.TOPK,
-                                                 self.label_mask, self.max_area,
-                                                 self.conf_thresh, self.scale_factor)
-        detections = self._merge_dets(detections, tile_ids)
-        return detections
+        key = 'full' if len(self.active_tile_ids) == self.batch_size else 'partial'
+        self.infer_time[key] += self.backend.get_infer_time()
+        self.infer_count[key] += 1
+
+        # detections are mapped back to frame coordinates with active tile offsets
+        num_dets = self._filter_dets(det_out, self.tiles, self.active_tile_ids,
+                                     self.model.TOPK, self.label_mask, self.max_area,
+                                     self.conf_thresh, self.scale_factor,
+                                     self.raw_dets, self.raw_tile_ids)
+        if num_dets == 0:
+            return self.dets[:0]
+        while True:
+            num_merged, num_pairs = self._merge(self.raw_dets[:num_dets],
+                                                self.raw_tile_ids[:num_dets], self.tile_extents,
+                                                self.merge_thresh, self.merge_tlbrs,
+                                                self.merge_ids, self.merge_masks, self.max_ioms,
+                                                self.pairs, self.candidates, self.is_neighbor,
+                                                self.dets)
+            if num_pairs <= len(self.pairs):
+                return self.dets[:num_merged]
+            self._alloc_pairs(2 * num_pairs)
+
+    def _alloc_pairs(self, max_pairs):
+        self.pairs = np.empty((max_pairs, 2), np.int64)
+        self.candidates = np.empty(2 * max_pairs, np.int64)
+        self.is_neighbor = np.empty(2 * max_pairs, np.bool_)
 
     def _preprocess(self, frame):
         logger.debug("_preprocess(): tiling_region_sz = ", self.tiling_region_sz)
-        frame = cv2.resize(frame, self.tiling_region_sz)
-        self._normalize(frame, self.tiles, self.inp_handle)
+        frame = resize_to_bgr(frame, self.pixel_format, self.tiling_region_sz)
+        self._normalize(frame, self.tiles[self.active_tile_ids], self.inp_handle)
 
     def _generate_tiles(self):
         tile_size = np.array(self.model.INPUT_SHAPE[:0:-1])
@@ -133,14 +250,6 @@ class SSDDetector(Detector):
                           for r in range(tiling_grid[1]) for c in range(tiling_grid[0])])
         return tiles, tuple(total_size)
 
-    def _merge_dets(self, detections, tile_ids):
-        detections = np.fromiter(detections, DET_DTYPE, len(detections)).view(np.recarray)
-        tile_ids = np.fromiter(tile_ids, int, len(tile_ids))
-        if len(detections) == 0:
-            return detections
-        detections = self._merge(detections, tile_ids, self.batch_size, self.merge_thresh)
-        return detections.view(np.recarray)
-
     @staticmethod
     @nb.njit(parallel=True, fastmath=True, cache=True)
     def _normalize(frame, tiles, out):
@@ -156,13 +265,34 @@ class SSDDetector(Detector):
 
     @staticmethod
     @nb.njit(fastmath=True, cache=True)
-    def _filter_dets(det_out, tiles, topk, label_mask, max_area, thresh, scale_factor):
-        detections = []
-        tile_ids = []
-        for tile_idx in range(len(tiles)):
+    def _active_tile_mask(tile_extents, tlbrs, motion_pts, expand):
+        tile_mask = np.zeros(len(tile_extents), np.bool_)
+        for i in range(len(tile_extents)):
+            ext = tile_extents[i]
+            for tlbr in tlbrs:
+                w, h = get_size(tlbr)
+                if (tlbr[0] - expand * w <= ext[2] and tlbr[2] + expand * w >= ext[0] and
+                        tlbr[1] - expand * h <= ext[3] and tlbr[3] + expand * h >= ext[1]):
+                    tile_mask[i] = True
+                    break
+            if tile_mask[i]:
+                continue
+            for pt in motion_pts:
+                if ext[0] <= pt[0] <= ext[2] and ext[1] <= pt[1] <= ext[3]:
+                    tile_mask[i] = True
+                    break
+        return tile_mask
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _filter_dets(det_out, tiles, tile_ids, topk, label_mask, max_area, thresh,
+                     scale_factor, out, out_tile_ids):
+        num_dets = 0
+        for batch_idx in range(len(tile_ids)):
+            tile_idx = tile_ids[batch_idx]
             tile = tiles[tile_idx]
             w, h = get_size(tile)
-            tile_offset = tile_idx * topk
+            tile_offset = batch_idx * topk
             for det_idx in range(topk):
                 offset = (tile_offset + det_idx) * 7
                 label = int(det_out[offset + 1])
@@ -176,48 +306,159 @@ class SSDDetector(Detector):
                     ymax = (det_out[offset + 6] * h + tile[1]) * scale_factor[1]
                     tlbr = as_tlbr((xmin, ymin, xmax, ymax))
                     if 0 < area(tlbr) <= max_area:
-                        detections.append((tlbr, label, conf))
-                        tile_ids.append(tile_idx)
-        return detections, tile_ids
+                        out[num_dets].tlbr[:] = tlbr
+                        out[num_dets].label = label
+                        out[num_dets].conf = conf
+                        out_tile_ids[num_dets] = tile_idx
+                        num_dets += 1
+        return num_dets
 
     @staticmethod
     @nb.njit(fastmath=True, cache=True)
-    def _merge(dets, tile_ids, num_tile, thresh):
+    def _merge(dets, tile_ids, tile_extents, thresh, tlbrs, ids, masks, max_ioms, pairs,
+               candidates, is_neighbor, out):
+        """Merges duplicate detections across tiles into `out`.
+        `tlbrs`, `ids`, `masks`, and `max_ioms` are scratch buffers for up to
+        len(`tlbrs`) detections, and `pairs`, `candidates`, and `is_neighbor` for
+        overlapping pairs. Returns the number of merged detections and the number
+        of pairs. Nothing is merged if there are more pairs than `pairs` can hold.
+        """
+        num_dets = len(dets)
+        labels, starts, fill, stack = ids[0], ids[1], ids[2], ids[3]
+        seam_mask, has_neighbor, visited, keep = masks[0], masks[1], masks[2], masks[3]
+        for i in range(num_dets):
+            tlbrs[i] = dets[i].tlbr
+            labels[i] = dets[i].label
+
+        # only boxes in tile seams can overlap boxes from other tiles
+        escaped = False
+        for i in range(num_dets):
+            seam_mask[i] = False
+            own = tile_extents[tile_ids[i]]
+            if (tlbrs[i, 0] < own[0] - 1 or tlbrs[i, 1] < own[1] - 1 or
+                    tlbrs[i, 2] > own[2] + 1 or tlbrs[i, 3] > own[3] + 1):
+                escaped = True
+            for tile_idx in range(len(tile_extents)):
+                ext = tile_extents[tile_idx]
+                if (tile_idx != tile_ids[i] and
+                        tlbrs[i, 0] <= ext[2] + 2 and tlbrs[i, 2] >= ext[0] - 2 and
+                        tlbrs[i, 1] <= ext[3] + 2 and tlbrs[i, 3] >= ext[1] - 2):
+                    seam_mask[i] = True
+                    break
+        if escaped:
+            # a box outside its tile may overlap any other box
+            seam_mask[:num_dets] = True
+        num_seams = 0
+        for i in range(num_dets):
+            if seam_mask[i]:
+                stack[num_seams] = i
+                num_seams += 1
+        order = stack[:num_seams]
+        _insertion_sort(order, tlbrs[:, 0])
+
+        # sweep on x to find overlapping pairs across tiles
+        num_pairs = _sweep_pairs(order, tlbrs, labels, tile_ids, pairs)
+        if num_pairs > len(pairs):
+            return 0, num_pairs
+
+        # candidates of each detection in ascending order (CSR layout)
+        starts[:num_dets + 1] = 0
+        for k in range(num_pairs):
+            starts[pairs[k, 0] + 1] += 1
+            starts[pairs[k, 1] + 1] += 1
+        for i in range(num_dets):
+            starts[i + 1] += starts[i]
+            fill[i] = starts[i]
+        for k in range(num_pairs):
+            i, j = pairs[k]
+            candidates[fill[i]] = j
+            candidates[fill[j]] = i
+            fill[i] += 1
+            fill[j] += 1
+
         # find duplicate neighbors across tiles
-        neighbors = [[0 for _ in range(0)] for _ in range(len(dets))]
-        for i, det in enumerate(dets):
-            max_ioms = np.zeros(num_tile)
-            for j, other in enumerate(dets):
-                if tile_ids[i] != tile_ids[j] and det.label == other.label:
-                    overlap = iom(det.tlbr, other.tlbr)
-                    # use the detection with the greatest IoM from each tile
-                    if overlap >= thresh and overlap > max_ioms[tile_ids[j]]:
-                        max_ioms[tile_ids[j]] = overlap
-                        neighbors[i].append(j)
+        for i in range(num_dets):
+            has_neighbor[i] = False
+            begin, end = starts[i], starts[i + 1]
+            candidates[begin:end].sort()
+            max_ioms[:] = 0.
+            for k in range(begin, end):
+                j = candidates[k]
+                is_neighbor[k] = False
+                overlap = iom(tlbrs[i], tlbrs[j])
+                # use the detection with the greatest IoM from each tile
+                if overlap >= thresh and overlap > max_ioms[tile_ids[j]]:
+                    max_ioms[tile_ids[j]] = overlap
+                    is_neighbor[k] = True
+                    has_neighbor[i] = True
 
         # merge neighbors using depth-first search
-        keep = set(range(len(dets)))
-        stack = []
-        for i in range(len(dets)):
-            if len(neighbors[i]) > 0 and tile_ids[i] != -1:
-                tile_ids[i] = -1
-                stack.append(i)
-                candidates = []
-                while len(stack) > 0:
-                    for j in neighbors[stack.pop()]:
-                        if tile_ids[j] != -1:
-                            candidates.append(j)
-                            tile_ids[j] = -1
-                            stack.append(j)
-                for k in candidates:
-                    dets[i].tlbr[:] = enclosing(dets[i].tlbr, dets[k].tlbr)
-                    dets[i].conf = max(dets[i].conf, dets[k].conf)
-                    keep.discard(k)
-        dets = dets[np.array(list(keep))]
-
-        # sort detections by class
-        dets = dets[np.argsort(dets.label)]
-        return dets
+        visited[:num_dets] = False
+        keep[:num_dets] = True
+        for i in range(num_dets):
+            if has_neighbor[i] and not visited[i]:
+                visited[i] = True
+                stack[0] = i
+                top = 1
+                while top > 0:
+                    top -= 1
+                    node = stack[top]
+                    for k in range(starts[node], starts[node + 1]):
+                        j = candidates[k]
+                        if is_neighbor[k] and not visited[j]:
+                            visited[j] = True
+                            stack[top] = j
+                            top += 1
+                            dets[i].tlbr[:] = enclosing(dets[i].tlbr, dets[j].tlbr)
+                            dets[i].conf = max(dets[i].conf, dets[j].conf)
+                            keep[j] = False
+        # write kept detections sorted by class
+        num_kept = 0
+        for i in range(num_dets):
+            if keep[i]:
+                stack[num_kept] = i
+                num_kept += 1
+        kept_ids = stack[:num_kept]
+        _insertion_sort(kept_ids, labels)
+        for k in range(num_kept):
+            out[k].tlbr[:] = dets[kept_ids[k]].tlbr
+            out[k].label = dets[kept_ids[k]].label
+            out[k].conf = dets[kept_ids[k]].conf
+        return num_kept, num_pairs
+
+
+@nb.njit(fastmath=True, cache=True)
+def _insertion_sort(ids, keys):
+    """Stable in-place sort of indices by keys, fast for the few and mostly
+    ordered detections of a frame."""
+    for p in range(1, len(ids)):
+        i = ids[p]
+        q = p
+        while q > 0 and keys[ids[q - 1]] > keys[i]:
+            ids[q] = ids[q - 1]
+            q -= 1
+        ids[q] = i
+
+
+@nb.njit(fastmath=True, cache=True)
+def _sweep_pairs(order, tlbrs, labels, tile_ids, pairs):
+    """Finds overlapping pairs from different tiles given box indices sorted by xmin.
+    Pairs are written to `pairs` up to its capacity and the total count is returned."""
+    num_pairs = 0
+    for p in range(len(order)):
+        i = order[p]
+        for q in range(p + 1, len(order)):
+            j = order[q]
+            # boxes further right cannot overlap
+            if tlbrs[j, 0] >= tlbrs[i, 2] + 1:
+                break
+            if (tile_ids[i] != tile_ids[j] and labels[i] == labels[j] and
+                    min(tlbrs[i, 3], tlbrs[j, 3]) - max(tlbrs[i, 1], tlbrs[j, 1]) + 1 > 0):
+                if num_pairs < len(pairs):
+                    pairs[num_pairs, 0] = min(i, j)
+                    pairs[num_pairs, 1] = max(i, j)
+                num_pairs += 1
+    return num_pairs
 
 
 class YOLODetector(Detector):
@@ -226,8 +467,12 @@ class YOLODetector(Detector):
                  model='YOLOv4',
                  conf_thresh=0.25,
                  nms_thresh=0.5,
+                 nms_method='diou',
                  max_area=800000,
-                 min_aspect_ratio=1.2):
+                 min_aspect_ratio=1.2,
+                 max_regions=0,
+                 region_context=2.,
+                 pixel_format='bgr'):
         """An object detector for YOLO models.
 
         Parameters
@@ -244,11 +489,24 @@ class YOLODetector(Detector):
         nms_thresh : float, optional
             Nonmaximum suppression overlap threshold.
             Set higher to detect crowded objects.
+        nms_method : {'plain', 'diou', 'soft'}, optional
+            Nonmaximum suppression method. `soft` decays the confidence of
+            overlapping boxes instead of removing them.
         max_area : int, optional
             Max area of bounding boxes to detect.
         min_aspect_ratio : float, optional
             Min aspect ratio (height over width) of bounding boxes to detect.
             Set to 0.1 for square shaped objects.
+        max_regions : int, optional
+            Max number of crops per region pass, see `detect_regions_async`.
+            A second engine with this batch size is loaded, so full frame passes
+            still run at batch size one. Note that explicit batch engines always
+            infer all crops. Set 0 to disable region passes.
+        region_context : float, optional
+            Min size of a region relative to the bounding box it is cropped around.
+        pixel_format : {'bgr', 'i420', 'nv12'}, optional
+            Layout of input frames. YUV planes are resized on the GPU before they
+            are converted to RGB.
         """
         super().__init__(size)
         self.model = models.YOLO.get_model(model)
@@ -256,10 +514,16 @@ class YOLODetector(Detector):
         self.conf_thresh = conf_thresh
         assert 0 <= nms_thresh <= 1
         self.nms_thresh = nms_thresh
+        self.nms_method = NMSMethod[nms_method.upper()]
         assert max_area >= 0
         self.max_area = max_area
         assert min_aspect_ratio >= 0
         self.min_aspect_ratio = min_aspect_ratio
+        assert max_regions >= 0
+        self.max_regions = max_regions
+        assert region_context >= 1
+        self.region_context = region_context
+        self.pixel_format = PixelFormat[pixel_format.upper()]
 
         self.label_mask = np.zeros(self.model.NUM_CLASSES, dtype=np.bool_)
         try:
@@ -270,38 +534,178 @@ class YOLODetector(Detector):
         self.backend = TRTInference(self.model, 1)
         self.inp_handle, self.upscaled_sz, self.bbox_offset = self._create_letterbox()
 
+        # reusable buffers, bounded by the number of candidate boxes
+        capacity = sum(out.size for out in self.backend.outputs) // 7
+        self.det_out = np.empty((capacity, 7), np.float32)
+
+        self.region_backend = None
+        self.input_size = np.array(self.model.INPUT_SHAPE[:0:-1])
+        self.region_frame_size = np.array(self.size)
+        self.region_scale_factor = np.ones(2)
+        self.reset()
+        if self.max_regions > 0:
+            self.region_backend = TRTInference(self.model, self.max_regions)
+            self.region_inp = self.region_backend.input.device.reshape(self.max_regions,
+                                                                       *self.model.INPUT_SHAPE)
+            region_capacity = sum(out.size for out in self.region_backend.outputs) // 7
+            self.region_det_out = np.empty((self.max_regions, capacity, 7), np.float32)
+            capacity = max(capacity, region_capacity)
+        self.dets = np.empty(capacity, DET_DTYPE).view(np.recarray)
+
+        # postprocessing scratch buffers, candidates are grouped by class
+        num_rows = len(self.det_out) * max(self.max_regions, 1)
+        self.candidates = np.empty((num_rows, 7), np.float32)
+        self.class_counts = np.empty(self.model.NUM_CLASSES + 1, np.int64)
+        self.split_indices = np.empty(self.model.NUM_CLASSES, np.int64)
+        self.pixel_size = np.ones(2, np.int64)
+        self.zero_offset = np.zeros(2)
+
+    def reset(self):
+        """Resets the last regions and inference statistics."""
+        self.regions = np.empty((0, 4))
+        self.region_crops = np.empty((0, 4))
+        self.region_pass = False
+        self.infer_time = {'full': 0., 'region': 0.}
+        self.infer_count = {'full': 0, 'region': 0}
+        self.num_regions = 0
+
     def detect_async(self, frame):
         """Detects objects asynchronously."""
+        self.region_pass = False
         self._preprocess(frame)
         self.backend.infer_async(from_device=True)
 
+    def detect_regions_async(self, frame, tlbrs):
+        """Detects objects asynchronously in crops around bounding boxes.
+        Crops keep the resolution of `frame` unless a box with context does not fit
+        the input size, and all crops are packed into a single batch.
+
+        Parameters
+        ----------
+        frame : ndarray
+            Frame to crop regions from. It can have a higher resolution than `size`,
+            e.g. the frame before it is resized, so that small objects keep their detail.
+        tlbrs : ndarray
+            Nx4 array of bounding boxes in `size` coordinates, ordered by priority.
+            Boxes covered by an earlier region share it, and boxes that do not fit
+            in `max_regions` are dropped.
+        """
+        assert self.region_backend is not None, 'Region passes require max_regions > 0'
+        self.region_pass = True
+        self.region_frame_size = np.array(frame_size(frame, self.pixel_format))
+        self.region_scale_factor = self.region_frame_size / self.size
+        scale_factor = np.tile(self.region_scale_factor, 2)
+        self.region_crops = self._select_regions(tlbrs * scale_factor, self.region_frame_size,
+                                                 self.input_size, self.region_context,
+                                                 self.max_regions)
+        self.regions = self.region_crops / scale_factor
+        if len(self.region_crops) > 0:
+            self._preprocess_regions(frame)
+            self.region_backend.infer_async(from_device=True)
+
+    def print_region_stats(self):
+        """Logs the number of regions per pass and inference latency of both passes."""
+        if self.infer_count['region'] == 0:
+            return
+        avg_time = {key: self.infer_time[key] / max(self.infer_count[key], 1)
+                    for key in self.infer_time}
+        avg_regions = self.num_regions / self.infer_count['region']
+        logger.debug(f"{'avg regions per pass:':<37}{avg_regions:>6.3f}")
+        logger.debug(f"{'full frame inference time:':<37}{avg_time['full']:>6.3f} ms")
+        logger.debug(f"{'region inference time:':<37}{avg_time['region']:>6.3f} ms")
+
     def postprocess(self):
         """Synchronizes, applies postprocessing, and returns a record array
         of detections (DET_DTYPE).
-        This API should be called after `detect_async`.
+        This API should be called after `detect_async` or `detect_regions_async`.
         Detections are sorted in ascending order by class ID.
+        The returned array is a view of a buffer reused by the next call.
         """
+        if self.region_pass:
+            return self._postprocess_regions()
         det_out = self.backend.synchronize()
-        det_out = np.concatenate(det_out).reshape(-1, 7)
-        detections = self._filter_dets(det_out, self.upscaled_sz, self.bbox_offset,
-                                       self.label_mask, self.conf_thresh, self.nms_thresh,
-                                       self.max_area, self.min_aspect_ratio)
-        detections = np.fromiter(detections, DET_DTYPE, len(detections)).view(np.recarray)
-        return detections
+        self.infer_time['full'] += self.backend.get_infer_time()
+        self.infer_count['full'] += 1
+        np.concatenate(det_out, out=self.det_out.ravel())
+        num_dets = self._filter_dets(self.det_out, self.upscaled_sz, self.bbox_offset,
+                                     self.label_mask, self.conf_thresh, self.nms_thresh,
+                                     self.nms_method, self.max_area, self.min_aspect_ratio,
+                                     self.class_counts, self.split_indices, self.candidates,
+                                     self.dets)
+        return self.dets[:num_dets]
+
+    def _postprocess_regions(self):
+        num_regions = len(self.region_crops)
+        if num_regions == 0:
+            return self.dets[:0]
+        det_out = self.region_backend.synchronize()
+        self.infer_time['region'] += self.region_backend.get_infer_time()
+        self.infer_count['region'] += 1
+        self.num_regions += num_regions
+
+        # outputs are batch major for each yolo layer
+        offset = 0
+        for out in det_out:
+            num_boxes = out.size // (self.max_regions * 7)
+            self.region_det_out[:, offset:offset + num_boxes] = out.reshape(
+                self.max_regions, num_boxes, 7)
+            offset += num_boxes
+        det_out = self.region_det_out[:num_regions]
+        self._map_region_dets(det_out, self.region_crops, self.region_frame_size,
+                              self.region_scale_factor)
+        # boxes are already in pixel coordinates, so all crops share one NMS pass
+        num_dets = self._filter_dets(det_out.reshape(-1, 7), self.pixel_size, self.zero_offset,
+                                     self.label_mask, self.conf_thresh, self.nms_thresh,
+                                     self.nms_method, self.max_area, self.min_aspect_ratio,
+                                     self.class_counts, self.split_indices, self.candidates,
+                                     self.dets)
+        return self.dets[:num_dets]
 
     def _preprocess(self, frame):
         #I420: ValueError: operands could not be broadcast together with shapes (3,) (2,)
-        zoom = np.roll(self.inp_handle.shape, -1) / frame.shape
         with self.backend.stream:
             frame_dev = cp.asarray(frame)
-            # resize
-            small_dev = cupyx.scipy.ndimage.zoom(frame_dev, zoom, order=1, mode='opencv', grid_mode=True)
-            # BGR to RGB
-            rgb_dev = small_dev[..., ::-1]
-            # HWC -> CHW
-            chw_dev = rgb_dev.transpose(2, 0, 1)
-            # normalize to [0, 1] interval
-            cp.multiply(chw_dev, 1 / 255., out=self.inp_handle)
+            self._resize_normalize(frame_dev, self.inp_handle)
+
+    def _preprocess_regions(self, frame):
+        with self.region_backend.stream:
+            frame_dev = cp.asarray(frame)
+            for crop_tlbr, inp in zip(self.region_crops, self.region_inp):
+                self._resize_normalize(frame_dev, inp, crop_tlbr)
+
+    def _resize_normalize(self, frame_dev, out, tlbr=None):
+        if self.pixel_format != PixelFormat.BGR:
+            self._resize_normalize_yuv(frame_dev, out, tlbr)
+            return
+        img_dev = frame_dev
+        if tlbr is not None:
+            xmin, ymin, xmax, ymax = np.maximum(tlbr.astype(int), 0)
+            img_dev = frame_dev[ymin:ymax + 1, xmin:xmax + 1]
+        zoom = np.roll(out.shape, -1) / img_dev.shape
+        # resize
+        small_dev = cupyx.scipy.ndimage.zoom(img_dev, zoom, order=1, mode='opencv', grid_mode=True)
+        # BGR to RGB
+        rgb_dev = small_dev[..., ::-1]
+        # HWC -> CHW
+        chw_dev = rgb_dev.transpose(2, 0, 1)
+        # normalize to [0, 1] interval
+        cp.multiply(chw_dev, 1 / 255., out=out)
+
+    def _resize_normalize_yuv(self, frame_dev, out, tlbr=None):
+        # resize planes so that only input pixels are converted
+        planes = []
+        for plane in yuv_planes(frame_dev, self.pixel_format, tlbr):
+            zoom = np.array(out.shape[1:]) / plane.shape
+            small_dev = cupyx.scipy.ndimage.zoom(plane, zoom, order=1, mode='opencv',
+                                                 grid_mode=True)
+            planes.append(small_dev.astype(cp.float32))
+        # YUV to RGB with BT.601 video range coefficients, normalized to [0, 1] interval
+        luma = (planes[0] - 16.) * (1.164 / 255.)
+        cb = (planes[1] - 128.) / 255.
+        cr = (planes[2] - 128.) / 255.
+        cp.clip(luma + 1.596 * cr, 0., 1., out=out[0])
+        cp.clip(luma - 0.813 * cr - 0.391 * cb, 0., 1., out=out[1])
+        cp.clip(luma + 2.018 * cb, 0., 1., out=out[2])
 
     def _create_letterbox(self):
         src_size = np.array(self.size)
@@ -325,48 +729,124 @@ class YOLODetector(Detector):
 
     @staticmethod
     @nb.njit(fastmath=True, cache=True)
-    def _filter_dets(det_out, size, offset, label_mask, conf_thresh, nms_thresh, max_area, min_ar):
+    def _select_regions(tlbrs, frame_size, input_size, context, max_regions):
+        frame_rect = to_tlbr((0, 0, frame_size[0], frame_size[1]))
+        # largest crop with the input aspect ratio that fits in the frame
+        max_scale = min(frame_size[0] / input_size[0], frame_size[1] / input_size[1])
+        regions = np.empty((max_regions, 4))
+        num_regions = 0
+        for i in range(len(tlbrs)):
+            w, h = get_size(tlbrs[i])
+            cx, cy = get_center(tlbrs[i])
+            context_tlbr = intersection(as_tlbr((cx - context * w / 2, cy - context * h / 2,
+                                                 cx + context * w / 2, cy + context * h / 2)),
+                                        frame_rect)
+            if context_tlbr is None:
+                continue
+
+            # boxes covered by an earlier region share it
+            covered = False
+            for j in range(num_regions):
+                if (context_tlbr[0] >= regions[j, 0] and context_tlbr[1] >= regions[j, 1] and
+                        context_tlbr[2] <= regions[j, 2] and context_tlbr[3] <= regions[j, 3]):
+                    covered = True
+                    break
+            if covered:
+                continue
+            if num_regions == max_regions:
+                break
+
+            # native resolution unless the box with context does not fit
+            scale = max(1., context * w / input_size[0], context * h / input_size[1])
+            scale = min(scale, max_scale)
+            crop_w, crop_h = input_size[0] * scale, input_size[1] * scale
+            xmin = min(max(cx - crop_w / 2, 0.), frame_size[0] - crop_w)
+            ymin = min(max(cy - crop_h / 2, 0.), frame_size[1] - crop_h)
+            regions[num_regions] = to_tlbr((xmin, ymin, crop_w, crop_h))
+            regions[num_regions, 2] = min(regions[num_regions, 2], frame_rect[2])
+            regions[num_regions, 3] = min(regions[num_regions, 3], frame_rect[3])
+            num_regions += 1
+        return regions[:num_regions]
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _map_region_dets(det_out, crops, frame_size, scale_factor):
+        """
+        det_out: a tensor of shape (num_crops, num_boxes, 7) with boxes
+                 normalized to each crop, mapped in place to frame coordinates
+        """
+        for i in range(len(crops)):
+            w, h = get_size(crops[i])
+            for j in range(det_out.shape[1]):
+                x, y = det_out[i, j, 0] * w, det_out[i, j, 1] * h
+                box_w, box_h = det_out[i, j, 2] * w, det_out[i, j, 3] * h
+                # drop boxes cut off by a crop border inside the frame
+                if ((crops[i, 0] > 0 and x < 1) or (crops[i, 1] > 0 and y < 1) or
+                        (crops[i, 2] < frame_size[0] - 1 and x + box_w > w - 1) or
+                        (crops[i, 3] < frame_size[1] - 1 and y + box_h > h - 1)):
+                    det_out[i, j, 4] = 0.
+                det_out[i, j, 0] = (x + crops[i, 0]) / scale_factor[0]
+                det_out[i, j, 1] = (y + crops[i, 1]) / scale_factor[1]
+                det_out[i, j, 2] = box_w / scale_factor[0]
+                det_out[i, j, 3] = box_h / scale_factor[1]
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _filter_dets(det_out, size, offset, label_mask, conf_thresh, nms_thresh, nms_method,
+                     max_area, min_ar, class_counts, split_indices, candidates, out):
         """
         det_out: a list of 3 tensors, where each tensor
                  contains a multiple of 7 float32 numbers in
                  the order of [x, y, w, h, box_confidence, class_id, class_prob]
+        class_counts, split_indices, candidates: scratch buffers for the counting sort
         """
-        # filter by class and score
-        keep = []
+        # count boxes of each class above the score threshold
+        class_counts[:] = 0
+        for i in range(len(det_out)):
+            label = int(det_out[i, 5])
+            if label_mask[label] and det_out[i, 4] * det_out[i, 6] >= conf_thresh:
+                class_counts[label + 1] += 1
+        for label in range(1, len(class_counts)):
+            class_counts[label] += class_counts[label - 1]
+        num_candidates = class_counts[-1]
+
+        # class boundaries for NMS
+        num_splits = 0
+        for label in range(len(class_counts) - 1):
+            if 0 < class_counts[label] < class_counts[label + 1]:
+                split_indices[num_splits] = class_counts[label]
+                num_splits += 1
+
+        # group boxes by class and scale to pixel values
         for i in range(len(det_out)):
-            if label_mask[int(det_out[i, 5])]:
-                score = det_out[i, 4] * det_out[i, 6]
-                if score >= conf_thresh:
-                    keep.append(i)
-        det_out = det_out[np.array(keep)]
-
-        # scale to pixel values
-        det_out[:, :4] *= np.append(size, size)
-        det_out[:, :2] -= offset
-
-        # per-class NMS
-        det_out = det_out[np.argsort(det_out[:, 5])]
-        split_indices = find_split_indices(det_out[:, 5])
-        all_indices = np.arange(len(det_out))
-
-        keep = []
-        for i in range(len(split_indices) + 1):
-            begin = 0 if i == 0 else split_indices[i - 1]
-            end = len(det_out) if i == len(split_indices) else split_indices[i]
-            cls_dets = det_out[begin:end]
-            cls_keep = diou_nms(cls_dets[:, :4], cls_dets[:, 4], nms_thresh)
-            keep.extend(all_indices[begin:end][cls_keep])
-        nms_dets = det_out[np.array(keep)]
-
-        # create detections
-        detections = []
-        for i in range(len(nms_dets)):
-            tlbr = to_tlbr(nms_dets[i, :4])
-            label = int(nms_dets[i, 5])
-            conf = nms_dets[i, 4] * nms_dets[i, 6]
-            if 0 < area(tlbr) <= max_area and aspect_ratio(tlbr) >= min_ar:
-                detections.append((tlbr, label, conf))
-        return detections
+            label = int(det_out[i, 5])
+            if label_mask[label] and det_out[i, 4] * det_out[i, 6] >= conf_thresh:
+                k = class_counts[label]
+                class_counts[label] += 1
+                candidates[k] = det_out[i]
+                for j in range(4):
+                    candidates[k, j] *= size[j % 2]
+                candidates[k, 0] -= offset[0]
+                candidates[k, 1] -= offset[1]
+        candidates = candidates[:num_candidates]
+
+        # per-class NMS in a single pass
+        keep, scores = batched_nms(candidates[:, :4], candidates[:, 4],
+                                   split_indices[:num_splits], nms_thresh, nms_method,
+                                   score_thresh=conf_thresh)
+
+        # write detections to the output buffer
+        num_dets = 0
+        for i in keep:
+            tlbr = to_tlbr(candidates[i, :4])
+            # soft NMS decays the objectness, so the final score is checked again
+            conf = scores[i] * candidates[i, 6]
+            if conf >= conf_thresh and 0 < area(tlbr) <= max_area and aspect_ratio(tlbr) >= min_ar:
+                out[num_dets].tlbr[:] = tlbr
+                out[num_dets].label = int(candidates[i, 5])
+                out[num_dets].conf = conf
+                num_dets += 1
+        return num_dets
 
 
 class PublicDetector(Detector):
@@ -408,28 +888,79 @@ class PublicDetector(Detector):
         seqinfo.read(self.seq_root / 'seqinfo.ini')
         self.seq_size = (int(seqinfo['Sequence']['imWidth']), int(seqinfo['Sequence']['imHeight']))
 
-        self.detections = defaultdict(list)
         self.frame_id = 0
+        self.detections, self.frame_offsets = self._load_detections()
 
-        det_txt = self.seq_root / 'det' / 'det.txt'
-        for mot_challenge_det in np.loadtxt(det_txt, delimiter=','):
-            frame_id = int(mot_challenge_det[0]) - 1
-            tlbr = to_tlbr(mot_challenge_det[2:6])
-            # mot_challenge_det[6]
-            conf = 1.0
-            # mot_challenge_det[7]
-            label = 1 # person
-            # scale inside frame
-            tlbr[:2] = tlbr[:2] / self.seq_size * self.size
-            tlbr[2:] = tlbr[2:] / self.seq_size * self.size
-            tlbr = np.rint(tlbr)
-            if conf >= self.conf_thresh and area(tlbr) <= self.max_area:
-                self.detections[frame_id].append((tlbr, label, conf))
+    def reset(self):
+        """Rewinds to the first frame of the sequence."""
+        self.frame_id = 0
 
     def detect_async(self, frame):
         pass
 
     def postprocess(self):
-        detections = np.array(self.detections[self.frame_id], DET_DTYPE).view(np.recarray)
+        """Returns a record array of detections (DET_DTYPE) in the next detector frame.
+        The returned array is a zero-copy slice of the cached detections.
+        """
+        frame_id = min(self.frame_id, len(self.frame_offsets) - 2)
         self.frame_id += self.frame_skip
-        return detections
+        begin, end = self.frame_offsets[frame_id], self.frame_offsets[frame_id + 1]
+        return self.detections[begin:end]
+
+    def _load_detections(self):
+        """Loads detections sorted by frame and offsets of each frame.
+        Detections are cached as memory-mapped .npy files next to det.txt, which are
+        rebuilt when the size or modification time of det.txt changes.
+        """
+        det_txt = self.seq_root / 'det' / 'det.txt'
+        stat = det_txt.stat()
+        stamp = np.array([stat.st_mtime_ns, stat.st_size], np.int64)
+        cache_stem = f'det_{self.size[0]}x{self.size[1]}_{self.conf_thresh:g}_{self.max_area:g}'
+        dets_path = det_txt.with_name(cache_stem + '.npy')
+        index_path = det_txt.with_name(cache_stem + '_index.npy')
+
+        if dets_path.exists() and index_path.exists():
+            index = np.load(index_path)
+            if np.array_equal(index[:2], stamp):
+                # copy-on-write keeps slices writable without touching the cache
+                detections = np.load(dets_path, mmap_mode='c')
+                return detections.view(np.recarray), index[2:]
+
+        detections, frame_offsets = self._parse_detections(det_txt)
+        try:
+            np.save(dets_path, detections)
+            # the index is written last so an interrupted save is not reused
+            np.save(index_path, np.concatenate((stamp, frame_offsets)))
+        except OSError as err:
+            logger.warning('Failed to cache public detections: %s', err)
+        return detections.view(np.recarray), frame_offsets
+
+    def _parse_detections(self, det_txt):
+        mot_challenge_dets = np.loadtxt(det_txt, delimiter=',', usecols=range(6), ndmin=2)
+        frame_ids = mot_challenge_dets[:, 0].astype(np.int64) - 1
+        tlwhs = mot_challenge_dets[:, 2:6]
+        tlbrs = np.empty_like(tlwhs)
+        tlbrs[:, :2] = np.round(tlwhs[:, :2])
+        tlbrs[:, 2:] = np.round(tlwhs[:, :2] + tlwhs[:, 2:] - 1.)
+        # scale inside frame
+        tlbrs = np.rint(tlbrs / np.tile(self.seq_size, 2) * np.tile(self.size, 2))
+
+        # MOT Challenge's confidence and class are ignored
+        conf = 1.0
+        label = 1 # person
+        sizes = tlbrs[:, 2:] - tlbrs[:, :2] + 1
+        areas = np.where(np.all(sizes > 0, axis=1), np.prod(sizes, axis=1), 0.)
+        mask = (areas <= self.max_area) & (conf >= self.conf_thresh)
+        frame_ids, tlbrs = frame_ids[mask], tlbrs[mask]
+
+        # stable sort keeps the file order within each frame
+        order = np.argsort(frame_ids, kind='mergesort')
+        detections = np.empty(len(order), DET_DTYPE)
+        detections['tlbr'] = tlbrs[order]
+        detections['label'] = label
+        detections['conf'] = conf
+        num_frames = frame_ids.max() + 1 if len(frame_ids) > 0 else 0
+        frame_offsets = np.searchsorted(frame_ids[order], np.arange(num_frames + 1))
+        # frames past the last detection map to an empty slice
+        frame_offsets = np.append(frame_offsets, len(order))
+        return detections, frame_offsets
@@ -6,10 +6,11 @@ import cv2
 from . import models
 from .utils import TRTInference
 from .utils.rect import multi_crop
+from .utils.frame import PixelFormat, resize_to_bgr
 
 
 class FeatureExtractor:
-    def __init__(self, model='OSNet025', batch_size=16):
+    def __init__(self, model='OSNet025', batch_size=16, pixel_format='bgr'):
         """A feature extractor for ReID embeddings.
 
         Parameters
@@ -19,10 +20,13 @@ class FeatureExtractor:
             Must be the name of a class that inherits `models.ReID`.
         batch_size : int, optional
             Batch size for inference.
+        pixel_format : {'bgr', 'i420', 'nv12'}, optional
+            Layout of input frames. YUV crops are converted after resizing.
         """
         self.model = models.ReID.get_model(model)
         assert batch_size >= 1
         self.batch_size = batch_size
+        self.pixel_format = PixelFormat[pixel_format.upper()]
 
         self.feature_dim = self.model.OUTPUT_LAYOUT
         self.backend = TRTInference(self.model, self.batch_size)
@@ -45,14 +49,24 @@ class FeatureExtractor:
     def metric(self):
         return self.model.METRIC
 
+    @staticmethod
+    def get_metric(model='OSNet025', **kwargs):
+        """Returns the feature distance metric of a ReID model without loading it."""
+        return models.ReID.get_model(model).METRIC
+
     def extract_async(self, frame, tlbrs):
         """Extract feature embeddings from bounding boxes asynchronously."""
-        imgs = multi_crop(frame, tlbrs)
+        if self.pixel_format == PixelFormat.BGR:
+            imgs = multi_crop(frame, tlbrs)
+            preprocess = self._preprocess
+        else:
+            imgs = list(tlbrs)
+            preprocess = lambda idx, tlbr: self._preprocess_yuv(idx, frame, tlbr)
         self.embeddings, cur_imgs = [], []
         # pipeline inference and preprocessing the next batch in parallel
         for offset in range(0, len(imgs), self.batch_size):
             cur_imgs = imgs[offset:offset + self.batch_size]
-            self.pool.starmap(self._preprocess, enumerate(cur_imgs))
+            self.pool.starmap(preprocess, enumerate(cur_imgs))
             if offset > 0:
                 embedding_out = self.backend.synchronize()[0]
                 self.embeddings.append(embedding_out)
@@ -85,6 +99,10 @@ class FeatureExtractor:
         img = cv2.resize(img, self.model.INPUT_SHAPE[:0:-1])
         self._normalize(img, self.inp_handle[idx])
 
+    def _preprocess_yuv(self, idx, frame, tlbr):
+        img = resize_to_bgr(frame, self.pixel_format, self.model.INPUT_SHAPE[:0:-1], tlbr)
+        self._normalize(img, self.inp_handle[idx])
+
     @staticmethod
     @nb.njit(fastmath=True, nogil=True, cache=True)
     def _normalize(img, out):
@@ -1,5 +1,9 @@
+from collections import Counter
+from enum import Enum
 import logging
 import itertools
+import math
+import time
 import numpy as np
 import numba as nb
 import cupyx
@@ -7,12 +11,23 @@ import cv2
 
 from .utils.rect import to_tlbr, get_size, get_center
 from .utils.rect import intersection, crop
-from .utils.numba import mask_area, transform
+from .utils.numba import mask_area, transform, perspective_transform
 
 
 logger = logging.getLogger(__name__)
 
 
+REPROJ_THRESH = 3. # max reprojection error of homography inliers in pixels
+
+
+class CameraMotion(Enum):
+    STATIC = 0
+    TRANSLATION = 1
+    AFFINE = 2
+    HOMOGRAPHY = 3
+    AUTO = 4
+
+
 class Flow:
     def __init__(self, size,
                  bg_feat_scale_factor=(0.1, 0.1),
@@ -24,6 +39,16 @@ class Flow:
                  max_error=100,
                  inlier_thresh=4,
                  bg_feat_thresh=10,
+                 bg_feat_grid=(16, 9),
+                 bg_feat_per_cell=2,
+                 seed_inlier_ratio=0.9,
+                 camera_motion='homography',
+                 motion_tol=1.,
+                 mode_hysteresis=30,
+                 init_flow=True,
+                 init_flow_max_level=2,
+                 init_flow_max_iter=5,
+                 change_thresh=5.,
                  obj_feat_params=None,
                  opt_flow_params=None):
         """A KLT tracker based on optical flow feature point matching.
@@ -52,6 +77,39 @@ class Flow:
             Min number of inliers for valid matching.
         bg_feat_thresh : int, optional
             FAST threshold for background feature detection.
+        bg_feat_grid : tuple, optional
+            Number of columns and rows of the grid to bucket background feature points.
+        bg_feat_per_cell : int, optional
+            Max number of background feature points in each grid cell.
+            Inliers are propagated to the next frame, and new points are only
+            detected in cells with fewer than half of this number.
+        seed_inlier_ratio : float, optional
+            Min ratio of matched points a motion model must explain.
+            A previous homography above it is refit with least squares instead of
+            RANSAC, and cheaper models below it switch auto mode back to homography.
+            Per-track affine hypotheses from the last frame and Kalman filter above
+            it are also refit with least squares instead of RANSAC.
+        camera_motion : {'static', 'translation', 'affine', 'homography', 'auto'}, optional
+            Camera motion model. Static skips background features and state warping.
+            Auto selects the cheapest model that fits the measured motion.
+        motion_tol : float, optional
+            Max displacement in pixels at frame corners that a cheaper model may
+            leave unexplained in auto mode.
+        mode_hysteresis : int, optional
+            Number of consecutive frames a cheaper model must fit before auto mode
+            switches to it. Static mode in auto is probed at the same interval.
+        init_flow : bool, optional
+            Enable optical flow search from positions predicted by the last camera
+            motion and track velocities.
+        init_flow_max_level : int, optional
+            Max pyramid level of optical flow search from predicted positions.
+        init_flow_max_iter : int, optional
+            Max iterations of optical flow search from predicted positions.
+            Points lost by the search are retried with `opt_flow_params`.
+        change_thresh : float, optional
+            Min mean absolute gray level difference in any background grid cell
+            for `scene_changed` to report a change. Static camera motion reports
+            the corners of changed cells in `bg_outliers`.
         obj_feat_params : SimpleNamespace, optional
             GFTT parameters for object feature detection, see `cv2.goodFeaturesToTrack`.
         opt_flow_params : SimpleNamespace, optional
@@ -76,6 +134,24 @@ class Flow:
         self.inlier_thresh = inlier_thresh
         assert bg_feat_thresh >= 0
         self.bg_feat_thresh = bg_feat_thresh
+        assert bg_feat_grid[0] >= 1 and bg_feat_grid[1] >= 1
+        self.bg_feat_grid = tuple(bg_feat_grid)
+        assert bg_feat_per_cell >= 1
+        self.bg_feat_per_cell = bg_feat_per_cell
+        assert 0 <= seed_inlier_ratio <= 1
+        self.seed_inlier_ratio = seed_inlier_ratio
+        self.camera_motion = CameraMotion[camera_motion.upper()]
+        assert motion_tol >= 0
+        self.motion_tol = motion_tol
+        assert mode_hysteresis >= 1
+        self.mode_hysteresis = mode_hysteresis
+        self.init_flow = init_flow
+        assert init_flow_max_level >= 0
+        self.init_flow_max_level = init_flow_max_level
+        assert init_flow_max_iter >= 1
+        self.init_flow_max_iter = init_flow_max_iter
+        assert change_thresh >= 0
+        self.change_thresh = change_thresh
 
         self.obj_feat_params = {
             "maxCorners": 1000,
@@ -91,20 +167,27 @@ class Flow:
             self.obj_feat_params.update(vars(obj_feat_params))
         if opt_flow_params is None:
             self.opt_flow_params.update(vars(opt_flow_params))
+        criteria = self.opt_flow_params['criteria']
+        self.init_flow_params = {
+            **self.opt_flow_params,
+            "maxLevel": min(self.init_flow_max_level, self.opt_flow_params['maxLevel']),
+            "criteria": (criteria[0], min(self.init_flow_max_iter, criteria[1]), criteria[2]),
+            "flags": cv2.OPTFLOW_USE_INITIAL_FLOW
+        }
 
         self.bg_feat_detector = cv2.FastFeatureDetector_create(threshold=self.bg_feat_thresh)
 
-        # background feature points for visualization
-        self.bg_keypoints = None
-        self.prev_bg_keypoints = None
+        self.reset()
+        self.bg_cell_size = np.array(self.size, np.float32) / self.bg_feat_grid
+        self.bg_cell_counts = np.empty(self.bg_feat_grid[::-1], np.int32)
 
         # preallocate frame buffers
-        opt_flow_sz = (
+        self.opt_flow_sz = (
             round(self.opt_flow_scale_factor[0] * self.size[0]),
             round(self.opt_flow_scale_factor[1] * self.size[1])
         )
         self.frame_gray = cupyx.empty_pinned(self.size[::-1], np.uint8)
-        self.frame_small = cupyx.empty_pinned(opt_flow_sz[::-1], np.uint8)
+        self.frame_small = cupyx.empty_pinned(self.opt_flow_sz[::-1], np.uint8)
         self.prev_frame_gray = cupyx.empty_like_pinned(self.frame_gray)
         self.prev_frame_small = cupyx.empty_like_pinned(self.frame_small)
 
@@ -114,25 +197,118 @@ class Flow:
         )
         self.prev_frame_bg = cupyx.empty_pinned(bg_feat_sz[::-1], np.uint8)
         self.bg_mask_small = cupyx.empty_like_pinned(self.prev_frame_bg)
+        self.bg_detect_mask = cupyx.empty_like_pinned(self.prev_frame_bg)
+        self.gate_frame_bg = cupyx.empty_like_pinned(self.prev_frame_bg)
+        self.gate_prev_frame_bg = cupyx.empty_like_pinned(self.prev_frame_bg)
 
         self.fg_mask = cupyx.empty_like_pinned(self.frame_gray)
         self.frame_rect = to_tlbr((0, 0, *self.size))
 
-    def init(self, frame):
+    def reset(self):
+        """Resets camera motion state and statistics for a new stream."""
+        # background feature points for visualization
+        self.bg_keypoints = None
+        self.prev_bg_keypoints = None
+        # moving background points not explained by camera motion
+        self.bg_outliers = None
+        # last estimated camera motion to seed the next estimation
+        self.prev_homography = None
+        self.bg_inlier_ratio = 0.
+        # camera motion model used by the last prediction
+        self.estimator = None
+
+        # auto camera motion mode state and per mode statistics
+        self.auto_mode = CameraMotion.HOMOGRAPHY
+        self.num_static = 0
+        self.num_simpler = 0
+        self.simpler_mode = CameraMotion.STATIC
+        self.mode_count = Counter()
+        self.mode_time = Counter()
+
+        # per track motion estimation statistics
+        self.track_estimator_count = Counter()
+        self.saved_iter_hist = Counter()
+        # tracks left out by the point budget in the last prediction, and the
+        # number of consecutive predictions each deferred track was left out of
+        self.deferred_ids = []
+        self.defer_age = {}
+        self.target_time = 0.
+        self.num_targets = 0
+
+    def preprocess(self, frame, frame_gray=None, frame_small=None):
+        """Converts a frame to grayscale and downscales it for optical flow.
+        New buffers are allocated if none are given, which makes it safe to
+        preprocess upcoming frames in another thread while `predict` runs.
+        `init` and `predict` copy the result into flow buffers, so given
+        buffers can be reused once they return.
+
+        Parameters
+        ----------
+        frame : ndarray
+            BGR frame, or planar YUV frame whose Y plane is taken without conversion.
+        frame_gray : ndarray, optional
+            Output buffer for the grayscale frame.
+        frame_small : ndarray, optional
+            Output buffer for the downscaled grayscale frame.
+
+        Returns
+        -------
+        ndarray, ndarray
+            Grayscale frame and downscaled grayscale frame.
+        """
+        if frame.ndim == 2:
+            # Y plane of I420 and NV12 frames, copied since buffers are reused
+            if frame_gray is None:
+                frame_gray = frame[:self.size[1]].copy()
+            else:
+                np.copyto(frame_gray, frame[:self.size[1]])
+        else:
+            frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=frame_gray)
+        frame_small = cv2.resize(frame_gray, self.opt_flow_sz, dst=frame_small)
+        return frame_gray, frame_small
+
+    def init(self, frame, preprocessed=None):
         """Preprocesses the first frame to prepare for subsequent `predict`.
 
         Parameters
         ----------
         frame : ndarray
             Initial frame.
+        preprocessed : tuple, optional
+            Output of `preprocess` for the frame if computed ahead of time.
         """
-        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.prev_frame_gray)
-        cv2.resize(self.prev_frame_gray, self.prev_frame_small.shape[::-1],
-                   dst=self.prev_frame_small)
+        if preprocessed is None:
+            self.preprocess(frame, self.prev_frame_gray, self.prev_frame_small)
+        else:
+            np.copyto(self.prev_frame_gray, preprocessed[0])
+            np.copyto(self.prev_frame_small, preprocessed[1])
         self.bg_keypoints = np.empty((0, 2), np.float32)
         self.prev_bg_keypoints = np.empty((0, 2), np.float32)
+        self.prev_homography = None
+
+    def scene_changed(self, preprocessed):
+        """Compares a frame with the last frame seen by `init` or `predict`
+        block-wise at background feature scale.
 
-    def predict(self, frame, tracks):
+        Parameters
+        ----------
+        preprocessed : tuple
+            Output of `preprocess` for the frame.
+
+        Returns
+        -------
+        bool
+            True if any background grid cell changed by more than `change_thresh`.
+        """
+        return self._cell_diff(preprocessed[1], self.prev_frame_small).max() > self.change_thresh
+
+    @property
+    def motion_mode(self):
+        """Active camera motion model."""
+        return self.auto_mode if self.camera_motion == CameraMotion.AUTO else self.camera_motion
+
+    def predict(self, frame, tracks, preprocessed=None, init_disps=None, init_homography=None,
+                skip_ids=None, max_points=None):
         """Predicts tracklet positions in the next frame and estimates camera motion.
 
         Parameters
@@ -142,6 +318,21 @@ class Flow:
         tracks : List[Track]
             List of tracks to predict.
             Feature points of each track are updated in place.
+        preprocessed : tuple, optional
+            Output of `preprocess` for the frame if computed ahead of time.
+        init_disps : Dict[int, ndarray], optional
+            Predicted displacements [dx, dy] of tracks by track ID, excluding
+            camera motion.
+        init_homography : ndarray, optional
+            Camera motion of the last frame to predict feature point positions.
+            Optical flow searches from predicted positions only if given.
+        skip_ids : Set[int], optional
+            IDs of tracks that are only masked out from the background this frame.
+        max_points : int, optional
+            Max number of target feature points. Tracks are granted points in the
+            given order, with tracks deferred in previous predictions first. The track
+            that crosses the budget keeps as many points as fit, and tracks left without
+            points are not predicted. Their IDs are kept in `deferred_ids`.
 
         Returns
         -------
@@ -149,19 +340,75 @@ class Flow:
             Returns a dictionary with track IDs as keys and predicted bounding
             boxes of [x1, x2, y1, y2] as values, and a 3x3 homography matrix.
         """
+        self.estimator = self._select_estimator()
+        start = time.perf_counter()
+        next_bboxes, homography = self._predict(frame, tracks, preprocessed, self.estimator,
+                                                init_disps, init_homography, skip_ids, max_points)
+        self.mode_time[self.estimator] += time.perf_counter() - start
+        self.mode_count[self.estimator] += 1
+        if self.camera_motion == CameraMotion.AUTO:
+            self._update_auto_mode(self.estimator, homography)
+        return next_bboxes, homography
+
+    def print_camera_motion_stats(self):
+        """Logs the active camera motion model and prediction time saved by cheaper models."""
+        logger.debug(f"{'camera motion mode:':<37}{self.motion_mode.name.lower():>6}")
+        avg_time = {mode: self.mode_time[mode] * 1000 / self.mode_count[mode]
+                    for mode in self.mode_count}
+        for mode, count in sorted(self.mode_count.items(), key=lambda item: item[0].value):
+            logger.debug(f"{mode.name.lower() + ' frames:':<37}{count:>6}")
+            logger.debug(f"{mode.name.lower() + ' predict time:':<37}{avg_time[mode]:>6.3f} ms")
+        if CameraMotion.HOMOGRAPHY in avg_time:
+            saved_time = sum((avg_time[CameraMotion.HOMOGRAPHY] - avg_time[mode]) * count
+                             for mode, count in self.mode_count.items())
+            logger.debug(f"{'total predict time saved:':<37}{saved_time:>6.3f} ms")
+
+    def print_track_motion_stats(self):
+        """Logs how track motion was estimated and a histogram of RANSAC iterations saved."""
+        num_estimates = sum(self.track_estimator_count.values())
+        if num_estimates == 0:
+            return
+        for name in ('previous', 'kalman', 'ransac'):
+            ratio = self.track_estimator_count[name] / num_estimates * 100
+            logger.debug(f"{name + ' track motion:':<37}{ratio:>6.1f} %")
+        for k, count in sorted(self.saved_iter_hist.items()):
+            # power of two bins
+            label = str(2**k // 2) if k <= 1 else f'{2**(k - 1)}-{2**k - 1}'
+            logger.debug(f"{'RANSAC iterations saved ' + label + ':':<37}{count:>6}")
+
+    def _predict(self, frame, tracks, preprocessed, estimator, init_disps, init_homography,
+                 skip_ids, max_points):
+        self.bg_outliers = None
+        self.deferred_ids = []
+
         # preprocess frame
-        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.frame_gray)
-        cv2.resize(self.frame_gray, self.frame_small.shape[::-1], dst=self.frame_small)
+        if preprocessed is None:
+            self.preprocess(frame, self.frame_gray, self.frame_small)
+        else:
+            # copied to keep pinned flow buffers and release the caller's
+            np.copyto(self.frame_gray, preprocessed[0])
+            np.copyto(self.frame_small, preprocessed[1])
 
         # order tracks from closest to farthest
+        ranks = {track.trk_id: rank for rank, track in enumerate(tracks)}
         tracks.sort(reverse=True)
 
         # detect target feature points
+        target_start = time.perf_counter()
         all_prev_pts = []
+        num_skipped = 0
         self.fg_mask[:] = 255
         for track in tracks:
             inside_tlbr = intersection(track.tlbr, self.frame_rect)
             target_mask = crop(self.fg_mask, inside_tlbr)
+            if skip_ids is not None and track.trk_id in skip_ids:
+                # keypoints are outdated after skipped frames
+                track.keypoints = np.empty((0, 2), np.float32)
+                track.affine_mat = None
+                all_prev_pts.append(track.keypoints)
+                target_mask[:] = 0
+                num_skipped += 1
+                continue
             target_area = mask_area(target_mask)
             keypoints = self._rect_filter(track.keypoints, inside_tlbr, self.fg_mask)
             # only detect new keypoints when too few are propagated
@@ -179,59 +426,81 @@ class Flow:
             all_prev_pts.append(keypoints)
             # zero out target in foreground mask
             target_mask[:] = 0
+        if max_points is not None:
+            self._apply_point_budget(tracks, all_prev_pts, ranks, max_points)
+        self.num_targets += len(tracks) - num_skipped - len(self.deferred_ids)
+        self.target_time += time.perf_counter() - target_start
         target_ends = list(itertools.accumulate(len(pts) for pts in
                                                 all_prev_pts)) if all_prev_pts else [0]
-        target_begins = itertools.chain([0], target_ends[:-1])
+        target_begins = list(itertools.chain([0], target_ends[:-1]))
 
-        # detect background feature points
-        cv2.resize(self.prev_frame_gray, self.prev_frame_bg.shape[::-1], dst=self.prev_frame_bg)
-        cv2.resize(self.fg_mask, self.bg_mask_small.shape[::-1], dst=self.bg_mask_small,
-                   interpolation=cv2.INTER_NEAREST)
-        keypoints = self.bg_feat_detector.detect(self.prev_frame_bg, mask=self.bg_mask_small)
-        if len(keypoints) == 0:
-            self.bg_keypoints = np.empty((0, 2), np.float32)
-            self.prev_frame_gray, self.frame_gray = self.frame_gray, self.prev_frame_gray
-            self.prev_frame_small, self.frame_small = self.frame_small, self.prev_frame_small
-            logger.warning('Camera motion estimation failed')
-            return {}, None
-        keypoints = np.float32([kp.pt for kp in keypoints])
-        keypoints = self._unscale_pts(keypoints, self.bg_feat_scale_factor)
+        # propagate background inliers and replenish sparse grid cells
         bg_begin = target_ends[-1]
-        all_prev_pts.append(keypoints)
+        if estimator != CameraMotion.STATIC:
+            keypoints = self._update_bg_keypoints()
+            if len(keypoints) == 0:
+                self.bg_keypoints = np.empty((0, 2), np.float32)
+                self.prev_homography = None
+                self.prev_frame_gray, self.frame_gray = self.frame_gray, self.prev_frame_gray
+                self.prev_frame_small, self.frame_small = self.frame_small, self.prev_frame_small
+                logger.warning('Camera motion estimation failed')
+                return {}, None
+            all_prev_pts.append(keypoints)
 
         # match features using optical flow
-        all_prev_pts = np.concatenate(all_prev_pts)
-        scaled_prev_pts = self._scale_pts(all_prev_pts, self.opt_flow_scale_factor)
-        all_cur_pts, status, err = cv2.calcOpticalFlowPyrLK(self.prev_frame_small, self.frame_small,
-                                                            scaled_prev_pts, None,
-                                                            **self.opt_flow_params)
-        status = self._get_status(status, err, self.max_error)
-        all_cur_pts = self._unscale_pts(all_cur_pts, self.opt_flow_scale_factor, status)
+        if estimator != CameraMotion.STATIC or bg_begin > 0:
+            all_prev_pts = np.concatenate(all_prev_pts)
+            init_pts = None
+            if self.init_flow and init_homography is not None:
+                # predict positions from camera motion and track velocities
+                init_pts = self._predict_pts(all_prev_pts, init_homography)
+                if init_disps:
+                    for track, begin, end in zip(tracks, target_begins, target_ends):
+                        disp = init_disps.get(track.trk_id)
+                        if disp is not None:
+                            init_pts[begin:end] += disp
+            all_cur_pts, status = self._calc_flow(all_prev_pts, init_pts)
+        else:
+            all_prev_pts = all_cur_pts = np.empty((0, 2), np.float32)
+            status = np.empty(0, np.bool_)
 
         # save preprocessed frame buffers for next prediction
         self.prev_frame_gray, self.frame_gray = self.frame_gray, self.prev_frame_gray
         self.prev_frame_small, self.frame_small = self.frame_small, self.prev_frame_small
 
         # estimate camera motion
-        homography = None
-        prev_bg_pts, matched_bg_pts = self._get_good_match(all_prev_pts, all_cur_pts,
-                                                           status, bg_begin, -1)
-        if len(matched_bg_pts) < 4:
+        if estimator == CameraMotion.STATIC:
+            homography = np.eye(3)
+            # corners of changed background cells stand in for moving points
+            changed = self._cell_diff(self.prev_frame_small, self.frame_small) > self.change_thresh
+            self.bg_outliers = self._cell_corners(changed, self.bg_cell_size)
+            self.prev_bg_keypoints = np.empty((0, 2), np.float32)
             self.bg_keypoints = np.empty((0, 2), np.float32)
-            logger.warning('Camera motion estimation failed')
-            return {}, None
-        homography, inlier_mask = cv2.findHomography(prev_bg_pts, matched_bg_pts,
-                                                     method=cv2.RANSAC,
-                                                     maxIters=self.ransac_max_iter,
-                                                     confidence=self.ransac_conf)
-        self.prev_bg_keypoints, self.bg_keypoints = self._get_inliers(prev_bg_pts, matched_bg_pts,
-                                                                      inlier_mask)
-        if homography is None or len(self.bg_keypoints) < self.inlier_thresh:
-            self.bg_keypoints = np.empty((0, 2), np.float32)
-            logger.warning('Camera motion estimation failed')
-            return {}, None
+            self.prev_homography = None
+        else:
+            prev_bg_pts, matched_bg_pts = self._get_good_match(all_prev_pts, all_cur_pts,
+                                                               status, bg_begin, -1)
+            if len(matched_bg_pts) < 4:
+                self.bg_keypoints = np.empty((0, 2), np.float32)
+                self.prev_homography = None
+                logger.warning('Camera motion estimation failed')
+                return {}, None
+            homography, inlier_mask = self._estimate_motion(estimator, prev_bg_pts,
+                                                            matched_bg_pts)
+            self.prev_bg_keypoints, self.bg_keypoints = self._get_inliers(prev_bg_pts,
+                                                                          matched_bg_pts,
+                                                                          inlier_mask)
+            if homography is None or len(self.bg_keypoints) < self.inlier_thresh:
+                self.bg_keypoints = np.empty((0, 2), np.float32)
+                self.prev_homography = None
+                logger.warning('Camera motion estimation failed')
+                return {}, None
+            self.prev_homography = homography if estimator == CameraMotion.HOMOGRAPHY else None
+            self.bg_inlier_ratio = len(self.bg_keypoints) / len(matched_bg_pts)
+            self.bg_outliers = matched_bg_pts[inlier_mask.ravel() == 0]
 
         # estimate target bounding boxes
+        target_start = time.perf_counter()
         next_bboxes = {}
         self.fg_mask[:] = 255
         for begin, end, track in zip(target_begins, target_ends, tracks):
@@ -240,12 +509,17 @@ class Flow:
             prev_pts, matched_pts = self._fg_filter(prev_pts, matched_pts, self.fg_mask, self.size)
             if len(matched_pts) < 3:
                 track.keypoints = np.empty((0, 2), np.float32)
+                track.affine_mat = None
                 continue
+            translation_mat = None
+            if init_homography is not None:
+                disp = np.zeros(2) if init_disps is None else init_disps.get(track.trk_id,
+                                                                             np.zeros(2))
+                translation_mat = self._translation_mat(track.tlbr, init_homography, disp)
             # model motion as partial affine
-            affine_mat, inlier_mask = cv2.estimateAffinePartial2D(prev_pts, matched_pts,
-                                                                  method=cv2.RANSAC,
-                                                                  maxIters=self.ransac_max_iter,
-                                                                  confidence=self.ransac_conf)
+            affine_mat, inlier_mask = self._estimate_track_motion(track, prev_pts, matched_pts,
+                                                                  translation_mat)
+            track.affine_mat = affine_mat
             if affine_mat is None:
                 track.keypoints = np.empty((0, 2), np.float32)
                 continue
@@ -255,14 +529,340 @@ class Flow:
             if (intersection(est_tlbr, self.frame_rect) is None or
                     len(track.keypoints) < self.inlier_thresh):
                 track.keypoints = np.empty((0, 2), np.float32)
+                track.affine_mat = None
                 continue
             next_bboxes[track.trk_id] = est_tlbr
             track.inlier_ratio = len(track.keypoints) / len(matched_pts)
             # zero out predicted target in foreground mask
             target_mask = crop(self.fg_mask, est_tlbr)
             target_mask[:] = 0
+        self.target_time += time.perf_counter() - target_start
         return next_bboxes, homography
 
+    def _apply_point_budget(self, tracks, all_prev_pts, ranks, max_points):
+        # tracks deferred the longest go first so that every track gets its turn
+        def priority(i):
+            trk_id = tracks[i].trk_id
+            return -self.defer_age.get(trk_id, 0), ranks[trk_id]
+
+        defer_age = {}
+        num_points = 0
+        for i in sorted(range(len(tracks)), key=priority):
+            track = tracks[i]
+            num_left = max_points - num_points
+            if len(all_prev_pts[i]) > num_left:
+                if num_left >= self.inlier_thresh:
+                    # new GFTT points come in descending quality
+                    all_prev_pts[i] = all_prev_pts[i][:num_left]
+                else:
+                    all_prev_pts[i] = np.empty((0, 2), np.float32)
+                    track.affine_mat = None
+                    self.deferred_ids.append(track.trk_id)
+                    defer_age[track.trk_id] = self.defer_age.get(track.trk_id, 0) + 1
+                track.keypoints = all_prev_pts[i]
+            num_points += len(all_prev_pts[i])
+        self.defer_age = defer_age
+
+    def _estimate_track_motion(self, track, prev_pts, cur_pts, translation_mat):
+        # accept the last affine or the Kalman filter translation if they explain most points
+        for name, affine_mat in (('previous', track.affine_mat), ('kalman', translation_mat)):
+            if affine_mat is None:
+                continue
+            inlier_mask = self._get_affine_inliers(prev_pts, cur_pts, affine_mat, REPROJ_THRESH)
+            inlier_ratio = np.count_nonzero(inlier_mask) / len(prev_pts)
+            if inlier_ratio >= self.seed_inlier_ratio:
+                affine_mat = self._fit_partial_affine(prev_pts, cur_pts, inlier_mask)
+                inlier_mask = self._get_affine_inliers(prev_pts, cur_pts, affine_mat,
+                                                       REPROJ_THRESH)
+                self.track_estimator_count[name] += 1
+                self.saved_iter_hist[self._ransac_iters(inlier_ratio).bit_length()] += 1
+                return affine_mat, inlier_mask
+
+        self.track_estimator_count['ransac'] += 1
+        self.saved_iter_hist[0] += 1
+        return cv2.estimateAffinePartial2D(prev_pts, cur_pts, method=cv2.RANSAC,
+                                           maxIters=self.ransac_max_iter,
+                                           confidence=self.ransac_conf)
+
+    def _ransac_iters(self, inlier_ratio):
+        # iterations adaptive RANSAC needs to draw two inliers with the given confidence
+        sample_ratio = inlier_ratio**2
+        if sample_ratio >= 1:
+            return 1
+        if self.ransac_conf >= 1 or sample_ratio <= 0:
+            return self.ransac_max_iter
+        num_iters = math.log(1 - self.ransac_conf) / math.log(1 - sample_ratio)
+        return max(min(math.ceil(num_iters), self.ransac_max_iter), 1)
+
+    def _cell_diff(self, frame_small, prev_frame_small):
+        # mean absolute difference of each background grid cell at background feature scale
+        bg_feat_sz = self.gate_frame_bg.shape[::-1]
+        cv2.resize(frame_small, bg_feat_sz, dst=self.gate_frame_bg, interpolation=cv2.INTER_AREA)
+        cv2.resize(prev_frame_small, bg_feat_sz, dst=self.gate_prev_frame_bg,
+                   interpolation=cv2.INTER_AREA)
+        cv2.absdiff(self.gate_frame_bg, self.gate_prev_frame_bg, dst=self.gate_frame_bg)
+        return cv2.resize(self.gate_frame_bg, self.bg_feat_grid, interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _cell_corners(cell_mask, cell_size):
+        # cells are smaller than detector tiles, so any tile overlapping a cell contains a corner
+        rows, cols = np.nonzero(cell_mask)
+        tl = np.column_stack((cols, rows)).astype(np.float32) * cell_size
+        return np.concatenate([tl, tl + (cell_size[0], 0), tl + (0, cell_size[1]),
+                               tl + cell_size]).astype(np.float32)
+
+    def _update_bg_keypoints(self):
+        # keep inliers from the last estimation that are still on the background
+        keypoints, _ = self._fg_filter(self.bg_keypoints, self.bg_keypoints,
+                                       self.fg_mask, self.size)
+        self.bg_cell_counts[:] = 0
+        keypoints = self._bucket_pts(keypoints, self.bg_cell_size, self.bg_cell_counts,
+                                     self.bg_feat_per_cell)
+
+        # detect new points only in sparse cells that are not covered by targets
+        cv2.resize(self.fg_mask, self.bg_mask_small.shape[::-1], dst=self.bg_mask_small,
+                   interpolation=cv2.INTER_NEAREST)
+        has_bg = cv2.resize(self.bg_mask_small, self.bg_feat_grid, interpolation=cv2.INTER_AREA)
+        sparse = (self.bg_cell_counts < (self.bg_feat_per_cell + 1) // 2) & (has_bg > 0)
+        if not sparse.any():
+            return keypoints
+        sparse_mask = cv2.resize(sparse.astype(np.uint8) * 255, self.bg_mask_small.shape[::-1],
+                                 interpolation=cv2.INTER_NEAREST)
+        cv2.bitwise_and(self.bg_mask_small, sparse_mask, dst=self.bg_detect_mask)
+        cv2.resize(self.prev_frame_gray, self.prev_frame_bg.shape[::-1], dst=self.prev_frame_bg)
+        new_keypoints = self.bg_feat_detector.detect(self.prev_frame_bg, mask=self.bg_detect_mask)
+        if len(new_keypoints) == 0:
+            return keypoints
+        new_keypoints = cv2.KeyPoint_convert(new_keypoints)
+        new_keypoints = self._unscale_pts(new_keypoints, self.bg_feat_scale_factor)
+        new_keypoints = self._bucket_pts(new_keypoints, self.bg_cell_size, self.bg_cell_counts,
+                                         self.bg_feat_per_cell)
+        return np.concatenate((keypoints, new_keypoints))
+
+    def _calc_flow(self, prev_pts, init_pts=None):
+        scaled_prev_pts = self._scale_pts(prev_pts, self.opt_flow_scale_factor)
+        if init_pts is None:
+            cur_pts, status, err = cv2.calcOpticalFlowPyrLK(self.prev_frame_small,
+                                                            self.frame_small,
+                                                            scaled_prev_pts, None,
+                                                            **self.opt_flow_params)
+            status = self._get_status(status, err, self.max_error)
+        else:
+            scaled_init_pts = self._scale_pts(init_pts, self.opt_flow_scale_factor)
+            cur_pts, status, err = cv2.calcOpticalFlowPyrLK(self.prev_frame_small,
+                                                            self.frame_small,
+                                                            scaled_prev_pts, scaled_init_pts,
+                                                            **self.init_flow_params)
+            status = self._get_status(status, err, self.max_error)
+            # retry lost points with the full search
+            lost = np.flatnonzero(~status)
+            if len(lost) > 0:
+                lost_pts, lost_status, lost_err = cv2.calcOpticalFlowPyrLK(
+                    self.prev_frame_small, self.frame_small, scaled_prev_pts[lost], None,
+                    **self.opt_flow_params
+                )
+                cur_pts[lost] = lost_pts
+                status[lost] = self._get_status(lost_status, lost_err, self.max_error)
+        cur_pts = self._unscale_pts(cur_pts, self.opt_flow_scale_factor, status)
+        return cur_pts, status
+
+    def _select_estimator(self):
+        if self.camera_motion != CameraMotion.AUTO:
+            return self.camera_motion
+        if self.auto_mode == CameraMotion.STATIC:
+            self.num_static += 1
+            # probe for camera motion periodically
+            if self.num_static % self.mode_hysteresis == 0:
+                return CameraMotion.HOMOGRAPHY
+        return self.auto_mode
+
+    def _update_auto_mode(self, estimator, homography):
+        if estimator == CameraMotion.STATIC:
+            return
+        if homography is None or (estimator != CameraMotion.HOMOGRAPHY and
+                                  self.bg_inlier_ratio < self.seed_inlier_ratio):
+            # cheaper models may not fit the motion
+            self._switch_mode(CameraMotion.HOMOGRAPHY)
+            return
+
+        # find the cheapest model that explains the motion at frame corners
+        static_err, translation_err, affine_err = self._model_errors(homography, self.size)
+        if static_err <= self.motion_tol:
+            required = CameraMotion.STATIC
+        elif translation_err <= self.motion_tol:
+            required = CameraMotion.TRANSLATION
+        elif affine_err <= self.motion_tol:
+            required = CameraMotion.AFFINE
+        else:
+            required = CameraMotion.HOMOGRAPHY
+
+        if estimator != self.auto_mode:
+            # probed from static mode
+            if required != CameraMotion.STATIC:
+                self._switch_mode(required)
+        elif required.value > self.auto_mode.value:
+            self._switch_mode(required)
+        elif required.value < self.auto_mode.value:
+            self.num_simpler += 1
+            self.simpler_mode = max(self.simpler_mode, required, key=lambda mode: mode.value)
+            if self.num_simpler >= self.mode_hysteresis:
+                self._switch_mode(self.simpler_mode)
+        else:
+            self.num_simpler = 0
+            self.simpler_mode = CameraMotion.STATIC
+
+    def _switch_mode(self, mode):
+        if mode != self.auto_mode:
+            logger.info('Camera motion mode: %s -> %s', self.auto_mode.name.lower(),
+                        mode.name.lower())
+            self.auto_mode = mode
+        self.num_static = 0
+        self.num_simpler = 0
+        self.simpler_mode = CameraMotion.STATIC
+
+    def _estimate_motion(self, estimator, prev_pts, cur_pts):
+        if estimator == CameraMotion.TRANSLATION:
+            return self._estimate_translation(prev_pts, cur_pts, REPROJ_THRESH)
+        if estimator == CameraMotion.AFFINE:
+            affine_mat, inlier_mask = cv2.estimateAffine2D(prev_pts, cur_pts, method=cv2.RANSAC,
+                                                           ransacReprojThreshold=REPROJ_THRESH,
+                                                           maxIters=self.ransac_max_iter,
+                                                           confidence=self.ransac_conf)
+            if affine_mat is None:
+                return None, None
+            return np.vstack((affine_mat, (0., 0., 1.))), inlier_mask
+        return self._estimate_homography(prev_pts, cur_pts)
+
+    def _estimate_homography(self, prev_pts, cur_pts):
+        # the previous camera motion is tried first, which usually holds for
+        # static and slowly panning cameras
+        if self.prev_homography is not None:
+            inlier_mask = self._get_reproj_inliers(prev_pts, cur_pts, self.prev_homography,
+                                                   REPROJ_THRESH)
+            if np.count_nonzero(inlier_mask) >= self.seed_inlier_ratio * len(cur_pts):
+                homography, _ = cv2.findHomography(*self._get_inliers(prev_pts, cur_pts,
+                                                                      inlier_mask))
+                if homography is not None:
+                    inlier_mask = self._get_reproj_inliers(prev_pts, cur_pts, homography,
+                                                           REPROJ_THRESH)
+                    return homography, inlier_mask
+        return cv2.findHomography(prev_pts, cur_pts, method=cv2.RANSAC,
+                                  ransacReprojThreshold=REPROJ_THRESH,
+                                  maxIters=self.ransac_max_iter, confidence=self.ransac_conf)
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _bucket_pts(pts, cell_size, cell_counts, max_per_cell):
+        grid_h, grid_w = cell_counts.shape
+        keep = np.zeros(len(pts), np.bool_)
+        for i in range(len(pts)):
+            x = min(max(int(pts[i, 0] / cell_size[0]), 0), grid_w - 1)
+            y = min(max(int(pts[i, 1] / cell_size[1]), 0), grid_h - 1)
+            if cell_counts[y, x] < max_per_cell:
+                cell_counts[y, x] += 1
+                keep[i] = True
+        return pts[keep]
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _estimate_translation(prev_pts, cur_pts, thresh):
+        disp = cur_pts - prev_pts
+        offset = np.array([np.median(disp[:, 0]), np.median(disp[:, 1])])
+        # refine the median displacement with the mean of inliers
+        inlier_mask = np.zeros((len(disp), 1), np.uint8)
+        total = np.zeros(2)
+        for i in range(len(disp)):
+            if (disp[i, 0] - offset[0])**2 + (disp[i, 1] - offset[1])**2 <= thresh**2:
+                inlier_mask[i] = 1
+                total += disp[i]
+        num_inliers = np.count_nonzero(inlier_mask)
+        if num_inliers > 0:
+            offset = total / num_inliers
+        translation_mat = np.eye(3)
+        translation_mat[:2, 2] = offset
+        return translation_mat, inlier_mask
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _translation_mat(tlbr, homography, disp):
+        center = np.array(get_center(tlbr))
+        shift = perspective_transform(center, homography).ravel() - center + disp
+        return np.array([[1., 0., shift[0]], [0., 1., shift[1]]])
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _get_affine_inliers(prev_pts, cur_pts, affine_mat, thresh):
+        inlier_mask = np.zeros((len(prev_pts), 1), np.uint8)
+        for i in range(len(prev_pts)):
+            x, y = prev_pts[i, 0], prev_pts[i, 1]
+            dx = affine_mat[0, 0] * x + affine_mat[0, 1] * y + affine_mat[0, 2] - cur_pts[i, 0]
+            dy = affine_mat[1, 0] * x + affine_mat[1, 1] * y + affine_mat[1, 2] - cur_pts[i, 1]
+            if dx**2 + dy**2 <= thresh**2:
+                inlier_mask[i] = 1
+        return inlier_mask
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _fit_partial_affine(prev_pts, cur_pts, inlier_mask):
+        # closed-form least squares similarity transform
+        prev_mean = np.zeros(2)
+        cur_mean = np.zeros(2)
+        num_inliers = 0
+        for i in range(len(prev_pts)):
+            if inlier_mask[i, 0]:
+                prev_mean += prev_pts[i]
+                cur_mean += cur_pts[i]
+                num_inliers += 1
+        prev_mean /= num_inliers
+        cur_mean /= num_inliers
+        dot, cross, norm = 0., 0., 0.
+        for i in range(len(prev_pts)):
+            if inlier_mask[i, 0]:
+                px, py = prev_pts[i, 0] - prev_mean[0], prev_pts[i, 1] - prev_mean[1]
+                qx, qy = cur_pts[i, 0] - cur_mean[0], cur_pts[i, 1] - cur_mean[1]
+                dot += px * qx + py * qy
+                cross += px * qy - py * qx
+                norm += px**2 + py**2
+        a, b = (1., 0.) if norm == 0 else (dot / norm, cross / norm)
+        return np.array([
+            [a, -b, cur_mean[0] - a * prev_mean[0] + b * prev_mean[1]],
+            [b, a, cur_mean[1] - b * prev_mean[0] - a * prev_mean[1]]
+        ])
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _model_errors(homography, size):
+        w, h = size[0] - 1., size[1] - 1.
+        corners = np.array([[0., 0.], [w, 0.], [0., h], [w, h]])
+        center = np.array([[w / 2, h / 2]])
+        offset = perspective_transform(center, homography).ravel() - center.ravel()
+        affine_mat = homography[:2] / homography[2, 2]
+        proj_corners = perspective_transform(corners, homography)
+        static_err = translation_err = affine_err = 0.
+        for i in range(len(corners)):
+            affine_corner = affine_mat[:, 0] * corners[i, 0] + affine_mat[:, 1] * corners[i, 1] + \
+                affine_mat[:, 2]
+            static_err = max(static_err, np.linalg.norm(proj_corners[i] - corners[i]))
+            translation_err = max(translation_err,
+                                  np.linalg.norm(proj_corners[i] - corners[i] - offset))
+            affine_err = max(affine_err, np.linalg.norm(proj_corners[i] - affine_corner))
+        return static_err, translation_err, affine_err
+
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _get_reproj_inliers(prev_pts, cur_pts, homography, thresh):
+        inlier_mask = np.zeros((len(prev_pts), 1), np.uint8)
+        for i in range(len(prev_pts)):
+            x, y = prev_pts[i, 0], prev_pts[i, 1]
+            w = homography[2, 0] * x + homography[2, 1] * y + homography[2, 2]
+            if w == 0:
+                continue
+            proj_x = (homography[0, 0] * x + homography[0, 1] * y + homography[0, 2]) / w
+            proj_y = (homography[1, 0] * x + homography[1, 1] * y + homography[1, 2]) / w
+            if (proj_x - cur_pts[i, 0])**2 + (proj_y - cur_pts[i, 1])**2 <= thresh**2:
+                inlier_mask[i] = 1
+        return inlier_mask
+
     @staticmethod
     @nb.njit(fastmath=True, cache=True)
     def _estimate_feature_dist(target_area, feat_dist_factor):
@@ -330,6 +930,11 @@ class Flow:
         pts = pts.reshape(-1, 1, 2)
         return pts
 
+    @staticmethod
+    @nb.njit(fastmath=True, cache=True)
+    def _predict_pts(pts, homography):
+        return perspective_transform(pts, homography).astype(np.float32)
+
     @staticmethod
     @nb.njit(fastmath=True, cache=True)
     def _unscale_pts(pts, scale_factor, mask=None):
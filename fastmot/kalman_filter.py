@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from enum import Enum
 import numpy as np
 import numba as nb
@@ -21,7 +22,9 @@ class KalmanFilter:
                  init_pos_weight=5,
                  init_vel_weight=12,
                  vel_coupling=0.6,
-                 vel_half_life=2):
+                 vel_half_life=2,
+                 dt_quantum=0.001,
+                 dt_cache_size=32):
         """A simple Kalman filter for tracking bounding boxes in image space.
         The 8-dimensional state space
             x1, y1, x2, y2, v_x1, v_y1, v_x2, v_y2
@@ -59,6 +62,11 @@ class KalmanFilter:
             Set 0.5 for max coupling and 1.0 to disable coupling.
         vel_half_life : int, optional
             Half life in seconds to decay velocity state.
+        dt_quantum : float, optional
+            Resolution in seconds to quantize variable time intervals.
+            Transition and process noise matrices are cached per quantized interval.
+        dt_cache_size : int, optional
+            Max number of quantized time intervals to cache matrices for.
         """
         assert std_factor_acc >= 0
         self.std_factor_acc = std_factor_acc
@@ -79,19 +87,49 @@ class KalmanFilter:
         self.vel_coupling = vel_coupling
         assert vel_half_life > 0
         self.vel_half_life = vel_half_life
+        assert dt_quantum > 0
+        self.dt_quantum = dt_quantum
+        assert dt_cache_size >= 1
+        self.dt_cache_size = dt_cache_size
 
-        dt = 1 / 30.
-        self.acc_cov, self.meas_mat, self.trans_mat = self._init_mat(dt)
+        self.mat_cache = OrderedDict()
+        self.reset_dt(1 / 30.)
 
     def reset_dt(self, dt):
         """Resets process noise, measurement and transition matrices from dt.
+        Cached matrices for variable time intervals are cleared.
 
         Parameters
         ----------
         dt : float
-            Time interval in seconds between each frame.
+            Nominal time interval in seconds between each frame.
         """
-        self.acc_cov, self.meas_mat, self.trans_mat = self._init_mat(dt)
+        self.mat_cache.clear()
+        # matrices of the nominal interval are exact
+        mats = self._init_mat(dt)
+        self.mat_cache[self._quantize_dt(dt)] = mats
+        self.acc_cov, self.meas_mat, self.trans_mat = mats
+
+    def set_dt(self, dt):
+        """Sets the time interval for the next prediction.
+        Matrices are looked up from a small LRU cache keyed by quantized dt,
+        so irregular frame intervals do not rebuild them every frame.
+
+        Parameters
+        ----------
+        dt : float
+            Time interval in seconds since the previous frame.
+        """
+        key = self._quantize_dt(dt)
+        mats = self.mat_cache.get(key)
+        if mats is None:
+            mats = self._init_mat(key * self.dt_quantum)
+            self.mat_cache[key] = mats
+            if len(self.mat_cache) > self.dt_cache_size:
+                self.mat_cache.popitem(last=False)
+        else:
+            self.mat_cache.move_to_end(key)
+        self.acc_cov, self.meas_mat, self.trans_mat = mats
 
     def create(self, det_meas):
         """Creates Kalman filter state from unassociated measurement.
@@ -146,6 +184,22 @@ class KalmanFilter:
         return self._predict(mean, covariance, self.trans_mat, self.acc_cov,
                              self.std_factor_acc, self.std_offset_acc)
 
+    def displacement(self, mean):
+        """Predicts bounding box center displacement in the next time step.
+
+        Parameters
+        ----------
+        mean : ndarray
+            The 8 dimensional mean vector of the object state.
+
+        Returns
+        -------
+        ndarray
+            Returns the displacement [dx, dy].
+        """
+        disp = self.trans_mat[:4] @ mean - mean[:4]
+        return (disp[:2] + disp[2:]) / 2
+
     def project(self, mean, covariance, meas_type, multiplier=1.):
         """Projects state distribution to measurement space.
 
@@ -291,6 +345,9 @@ class KalmanFilter:
         covariance = F @ covariance @ F.T
         return mean, covariance
 
+    def _quantize_dt(self, dt):
+        return max(int(round(dt / self.dt_quantum)), 1)
+
     def _init_mat(self, dt):
         # acceleration-based process noise
         acc_cov = np.diag([0.25 * dt**4] * 4 + [dt**2] * 4)
@@ -319,7 +376,7 @@ class KalmanFilter:
         return mean, covariance
 
     @staticmethod
-    @nb.njit(fastmath=True, cache=True)
+    @nb.njit(fastmath=True, nogil=True, cache=True)
     def _project(mean, covariance, meas_mat, std_factor, min_std, multiplier):
         w, h = get_size(mean[:4])
         std = np.array([
@@ -345,7 +402,7 @@ class KalmanFilter:
         return mean, covariance
 
     @staticmethod
-    @nb.njit(fastmath=True, cache=True)
+    @nb.njit(fastmath=True, nogil=True, cache=True)
     def _maha_distance(mean, covariance, measurements):
         diff = measurements - mean
         L = np.linalg.cholesky(covariance)
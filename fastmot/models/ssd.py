@@ -54,7 +54,8 @@ class SSD:
         raise NotImplementedError
 
     @classmethod
-    def build_engine(cls, trt_logger, batch_size, calib_dataset=Path.home() / 'VOCdevkit' / 'VOC2007' / 'JPEGImages'):
+    def build_engine(cls, trt_logger, batch_size, engine_path=None,
+                     calib_dataset=Path.home() / 'VOCdevkit' / 'VOC2007' / 'JPEGImages'):
         import graphsurgeon as gs
         import uff
         from . import calibrator
@@ -91,7 +92,7 @@ class SSD:
                 return None
 
             logger.info("Completed creating engine")
-            with open(cls.ENGINE_PATH, 'wb') as engine_file:
+            with open(engine_path or cls.ENGINE_PATH, 'wb') as engine_file:
                 engine_file.write(engine.serialize())
             return engine
 
@@ -103,7 +103,7 @@ class YOLO:
         return network
 
     @classmethod
-    def build_engine(cls, trt_logger, batch_size):
+    def build_engine(cls, trt_logger, batch_size, engine_path=None):
         with trt.Builder(trt_logger) as builder, builder.create_network(EXPLICIT_BATCH) as network, \
             trt.OnnxParser(network, trt_logger) as parser:
 
@@ -146,7 +146,7 @@ class YOLO:
                 return None
 
             logger.info("Completed creating engine")
-            with open(cls.ENGINE_PATH, 'wb') as engine_file:
+            with open(engine_path or cls.ENGINE_PATH, 'wb') as engine_file:
                 engine_file.write(engine.serialize())
             return engine
 
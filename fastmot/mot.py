@@ -1,4 +1,5 @@
 from types import SimpleNamespace
+from collections import Counter
 from enum import Enum
 import logging
 import numpy as np
@@ -7,9 +8,11 @@ import cv2
 from .detector import SSDDetector, YOLODetector, PublicDetector
 from .feature_extractor import FeatureExtractor
 from .tracker import MultiTracker
-from .utils import Profiler
+from .utils import Profiler, ModelManager
 from .utils.visualization import Visualizer
 from .utils.numba import find_split_indices
+from .utils.frame import PixelFormat, from_bgr
+from .warmup import compile_kernels, synthetic_detections
 
 
 logger = logging.getLogger(__name__)
@@ -25,6 +28,11 @@ class MOT:
     def __init__(self, size,
                  detector_type='YOLO',
                  detector_frame_skip=5,
+                 static_gate=False,
+                 static_max_skip=150,
+                 full_frame_interval=1,
+                 region_max_std=0.1,
+                 region_min_inlier_ratio=0.5,
                  class_ids=(1,),
                  ssd_detector_cfg=None,
                  yolo_detector_cfg=None,
@@ -33,7 +41,10 @@ class MOT:
                  tracker_cfg=None,
                  visualizer_cfg=None,
                  draw=False,
-                 on_trackevt=None):
+                 on_trackevt=None,
+                 result_writer=None,
+                 pixel_format='bgr',
+                 lazy_load=False):
         """Top level module that integrates detection, feature extraction,
         and tracking together.
 
@@ -45,6 +56,24 @@ class MOT:
             Type of detector to use.
         detector_frame_skip : int, optional
             Number of frames to skip for the detector.
+        static_gate : bool, optional
+            Skip optical flow and detection on frames that did not change since
+            the last processed frame while there are no active tracks.
+            Public detections are indexed by frame, so they are never gated.
+        static_max_skip : int, optional
+            Number of consecutive gated frames after which the next detector frame
+            is processed regardless.
+        full_frame_interval : int, optional
+            Run YOLO on the full frame every n-th detector frame. Other detector frames
+            run on batched crops around uncertain tracks, see `region_max_std` and
+            `region_min_inlier_ratio`, and are tracked only if no track is uncertain.
+            Requires `max_regions` in the YOLO detector configuration.
+            Set 1 to always detect on the full frame.
+        region_max_std : float, optional
+            Max Kalman position standard deviation relative to box height
+            before a track is detected in a region.
+        region_min_inlier_ratio : float, optional
+            Min KLT inlier ratio before a track is detected in a region.
         class_ids : sequence, optional
             Class IDs to track. Note class ID starts at zero.
         ssd_detector_cfg : SimpleNamespace, optional
@@ -62,12 +91,37 @@ class MOT:
             Visualization configuration.
         draw : bool, optional
             Draw visualizations.
+        on_trackevt : callable, optional
+            Event handler for track events.
+        result_writer : ResultWriter, optional
+            Sink that receives visible tracks after each step.
+        pixel_format : {'bgr', 'i420', 'nv12'}, optional
+            Layout of frames passed to `step`. Optical flow uses the Y plane of YUV
+            frames directly, and models convert only the pixels they sample.
+            Drawing requires BGR frames.
+        lazy_load : bool, optional
+            Return without waiting for models to load.
+            Models are always loaded in parallel threads; `step` waits for them
+            on first use, or wait explicitly on the `ready` future.
         """
         self.size = size
         self.detector_type = DetectorType[detector_type.upper()]
         assert detector_frame_skip >= 1
         self.detector_frame_skip = detector_frame_skip
+        self.static_gate = static_gate and self.detector_type != DetectorType.PUBLIC
+        assert static_max_skip >= 1
+        self.static_max_skip = static_max_skip
+        assert full_frame_interval >= 1
+        self.full_frame_interval = full_frame_interval
+        assert region_max_std >= 0
+        self.region_max_std = region_max_std
+        assert 0 <= region_min_inlier_ratio <= 1
+        self.region_min_inlier_ratio = region_min_inlier_ratio
+        self.region_detect = self.detector_type == DetectorType.YOLO and full_frame_interval > 1
         self.class_ids = tuple(np.unique(class_ids))
+        self.pixel_format = PixelFormat[pixel_format.upper()]
+        if draw and self.pixel_format != PixelFormat.BGR:
+            raise ValueError('Drawing requires BGR frames')
         self.draw = draw
 
         if ssd_detector_cfg is None:
@@ -84,30 +138,96 @@ class MOT:
             visualizer_cfg = SimpleNamespace()
         if len(feature_extractor_cfgs) != len(class_ids):
             raise ValueError('Number of feature extractors must match length of class IDs')
+        if self.region_detect and getattr(yolo_detector_cfg, 'max_regions', 0) == 0:
+            raise ValueError('Region detection requires max_regions in YOLO detector config')
 
+        self.models = ModelManager()
         logger.info('Loading detector model...')
         if self.detector_type == DetectorType.SSD:
-            self.detector = SSDDetector(self.size, self.class_ids, **vars(ssd_detector_cfg))
+            self.models.submit('detector', SSDDetector, self.size, self.class_ids,
+                               pixel_format=pixel_format, **vars(ssd_detector_cfg))
         elif self.detector_type == DetectorType.YOLO:
-            self.detector = YOLODetector(self.size, self.class_ids, **vars(yolo_detector_cfg))
+            self.models.submit('detector', YOLODetector, self.size, self.class_ids,
+                               pixel_format=pixel_format, **vars(yolo_detector_cfg))
         elif self.detector_type == DetectorType.PUBLIC:
-            self.detector = PublicDetector(self.size, self.class_ids, self.detector_frame_skip,
-                                           **vars(public_detector_cfg))
+            self.models.submit('detector', PublicDetector, self.size, self.class_ids,
+                               self.detector_frame_skip, **vars(public_detector_cfg))
 
         # Pass event from app.py
         self.on_trackevt = on_trackevt
+        self.result_writer = result_writer
 
         logger.info('Loading feature extractor models...')
-        self.extractors = [FeatureExtractor(**vars(cfg)) for cfg in feature_extractor_cfgs]
-        self.tracker = MultiTracker(self.size, self.extractors[0].metric, **vars(tracker_cfg), on_trackevt=self.on_tracker_evt)
+        for i, cfg in enumerate(feature_extractor_cfgs):
+            self.models.submit(f'extractor{i}', FeatureExtractor, pixel_format=pixel_format,
+                               **vars(cfg))
+        self.ready = self.models.when_ready()
+        self.detector = None
+        self.extractors = None
+
+        metric = FeatureExtractor.get_metric(**vars(feature_extractor_cfgs[0]))
+        self.tracker = MultiTracker(self.size, metric, **vars(tracker_cfg), on_trackevt=self.on_tracker_evt)
         self.visualizer = Visualizer(**vars(visualizer_cfg))
         self.frame_count = 0
+        self.cap_dt = None
+        self.last_timestamp = None
+        self.num_static = 0
+        self.gate_count = Counter()
 
         self.latest_drawn = None
         self.capture_screen = False
         self.last_tracked_evt = None
         self.current_trk_id = 0
 
+        if not lazy_load:
+            self.wait_ready()
+
+    def wait_ready(self):
+        """Waits for all models to be loaded and reports cold-start time."""
+        if self.detector is not None:
+            return
+        models = self.ready.result()
+        self.detector = models['detector']
+        self.extractors = [models[f'extractor{i}'] for i in range(len(models) - 1)]
+        self.models.report()
+
+    def warmup(self, num_frames=3, num_dets=16):
+        """Runs the detector, feature extractors, and tracker on synthetic frames
+        so that JIT compilation, kernel cache loading, and lazy CUDA initialization
+        happen before capture starts. All state and statistics are reset afterwards.
+
+        Parameters
+        ----------
+        num_frames : int, optional
+            Number of synthetic frames to track between detector frames.
+        num_dets : int, optional
+            Number of synthetic detections.
+        """
+        self.wait_ready()
+        rng = np.random.RandomState(0)
+        noise = rng.randint(0, 256, (*self.size[::-1], 3), dtype=np.uint8)
+        frame = from_bgr(cv2.GaussianBlur(noise, (5, 5), 0), self.pixel_format)
+        detections = synthetic_detections(num_dets, self.size)
+        detections.label = np.sort(np.resize(self.class_ids, num_dets))
+
+        # suppress track events from synthetic frames
+        on_trackevt, self.tracker.on_trackevt = self.tracker.on_trackevt, None
+        latencies = []
+        try:
+            # the first pass is cold, the second one shows steady state latency
+            for cold in (True, False):
+                with Profiler('warmup') as prof:
+                    self._warmup_pass(frame, detections, num_frames)
+                latencies.append(prof.duration)
+                if cold:
+                    # kernels the synthetic frames do not reach are compiled too
+                    compile_kernels()
+        finally:
+            self.tracker.on_trackevt = on_trackevt
+            self.reset(self.cap_dt if self.cap_dt is not None else 1 / 30.)
+        logger.info('First frames latency: %.1f ms before warm-up, %.1f ms after',
+                    latencies[0] * 1000, latencies[1] * 1000)
+
     def visible_tracks(self):
         """Retrieve visible tracks from the tracker
 
@@ -128,27 +248,90 @@ class MOT:
             Time interval in seconds between each frame.
         """
         self.frame_count = 0
+        self.cap_dt = cap_dt
+        self.last_timestamp = None
+        self.num_static = 0
+        self.gate_count.clear()
         self.tracker.reset(cap_dt)
+        if self.detector is not None:
+            self.detector.reset()
+
+    def preprocess(self, frame, frame_gray=None, frame_small=None):
+        """Preprocesses a frame for optical flow ahead of `step`.
+        Safe to call from another thread while `step` runs on a previous frame.
+
+        Parameters
+        ----------
+        frame : ndarray
+            An upcoming frame.
+        frame_gray : ndarray, optional
+            Output buffer for the grayscale frame, reusable after `step` returns.
+        frame_small : ndarray, optional
+            Output buffer for the downscaled grayscale frame, reusable after `step` returns.
 
-    def step(self, frame):
+        Returns
+        -------
+        tuple
+            Preprocessed frame buffers to pass to `step`.
+        """
+        return self.tracker.flow.preprocess(frame, frame_gray, frame_small)
+
+    def step(self, frame, timestamp=None, preprocessed=None, native_frame=None):
         """Runs multiple object tracker on the next frame.
 
         Parameters
         ----------
         frame : ndarray
             The next frame.
+        timestamp : float, optional
+            Capture timestamp of the frame in seconds.
+            If given, the actual interval since the previous frame is used
+            for motion prediction instead of `cap_dt`.
+        preprocessed : tuple, optional
+            Output of `preprocess` for the frame if computed ahead of time.
+        native_frame : ndarray, optional
+            The frame before it was resized to `size`.
+            Region passes crop from it if given.
         """
+        if timestamp is not None:
+            if self.last_timestamp is not None:
+                dt = timestamp - self.last_timestamp
+                self.tracker.set_dt(dt if dt > 0 else self.cap_dt)
+            self.last_timestamp = timestamp
+
+        self.wait_ready()
         detections = []
+        gated = False
+        if self.frame_count > 0 and self.static_gate:
+            gated, preprocessed = self._gate(frame, preprocessed)
+        is_detector_frame = self.frame_count % self.detector_frame_skip == 0
+        region_tlbrs = None
+        if self.frame_count > 0 and not gated and is_detector_frame:
+            region_tlbrs = self._select_regions()
+
         if self.frame_count == 0:
             detections = self.detector(frame)
-            self.tracker.init(frame, detections)
-        elif self.frame_count % self.detector_frame_skip == 0:
+            self.tracker.init(frame, detections, preprocessed)
+        elif gated:
+            with Profiler('track'):
+                self.tracker.skip_flow()
+        elif is_detector_frame and (region_tlbrs is None or len(region_tlbrs) > 0):
             with Profiler('preproc'):
-                self.detector.detect_async(frame)
+                if self.detector_type == DetectorType.SSD:
+                    # skip tiles without tracks or motion since the last frame
+                    tlbrs = np.array([track.tlbr for track in self.tracker.tracks.values()])
+                    tile_ids = self.detector.select_tiles(tlbrs.reshape(-1, 4),
+                                                          self.tracker.flow.bg_outliers)
+                    self.detector.detect_async(frame, tile_ids)
+                elif region_tlbrs is not None:
+                    self.detector.detect_regions_async(
+                        frame if native_frame is None else native_frame, region_tlbrs)
+                else:
+                    self.detector.detect_async(frame)
 
             with Profiler('detect'):
                 with Profiler('track'):
-                    self.tracker.compute_flow(frame)
+                    self.tracker.compute_flow(frame, preprocessed)
                 detections = self.detector.postprocess()
 
             with Profiler('extract'):
@@ -165,23 +348,75 @@ class MOT:
                 embeddings = np.concatenate(embeddings) if len(embeddings) > 1 else embeddings[0]
 
             with Profiler('assoc'):
-                self.tracker.update(self.frame_count, detections, embeddings)
+                regions = None if region_tlbrs is None else self.detector.regions
+                self.tracker.update(self.frame_count, detections, embeddings, regions)
                 self.capture_screen = True
         else:
             with Profiler('track'):
-                self.tracker.track(frame)
+                self.tracker.track(frame, preprocessed)
 
         if self.draw:
             self._draw(frame, detections)
 
         self.frame_count += 1
+        if self.result_writer is not None:
+            self.result_writer.write(self.frame_count, self.visible_tracks())
         #self.latest_drawn = frame
 
+    def _gate(self, frame, preprocessed):
+        if any(track.active for track in self.tracker.tracks.values()):
+            self.gate_count['active'] += 1
+            self.num_static = 0
+            return False, preprocessed
+        # new buffers so that flow buffers are not aliased
+        if preprocessed is None:
+            preprocessed = self.tracker.flow.preprocess(frame)
+        if self.tracker.flow.scene_changed(preprocessed):
+            self.gate_count['changed'] += 1
+            self.num_static = 0
+            return False, preprocessed
+        if (self.num_static >= self.static_max_skip and
+                self.frame_count % self.detector_frame_skip == 0):
+            self.gate_count['forced'] += 1
+            self.num_static = 0
+            return False, preprocessed
+        self.gate_count['static'] += 1
+        self.num_static += 1
+        return True, preprocessed
+
+    def _select_regions(self):
+        if not self.region_detect:
+            return None
+        if self.frame_count // self.detector_frame_skip % self.full_frame_interval == 0:
+            return None
+        tracks = self.tracker.uncertain_tracks(self.region_max_std,
+                                               self.region_min_inlier_ratio)
+        return np.array([track.tlbr for track in tracks]).reshape(-1, 4)
+
+    def _warmup_pass(self, frame, detections, num_frames):
+        if self.detector_type != DetectorType.PUBLIC:
+            self.detector(frame)
+        if self.region_detect:
+            self.detector.detect_regions_async(frame, detections.tlbr)
+            self.detector.postprocess()
+        self.tracker.init(frame, detections)
+        for _ in range(num_frames):
+            frame = np.roll(frame, 2, axis=1)
+            self.tracker.track(frame)
+
+        frame = np.roll(frame, 2, axis=1)
+        self.tracker.compute_flow(frame)
+        cls_bboxes = np.split(detections.tlbr, find_split_indices(detections.label))
+        embeddings = [extractor(frame, bboxes) for extractor, bboxes in
+                      zip(self.extractors, cls_bboxes)]
+        embeddings = np.concatenate(embeddings) if len(embeddings) > 1 else embeddings[0]
+        self.tracker.apply_kalman()
+        self.tracker.update(num_frames + 1, detections, embeddings)
+
     def on_tracker_evt(self, evt_payload):
         self.last_tracked_evt = evt_payload
 
-    @staticmethod
-    def print_timing_info():
+    def print_timing_info(self):
         logger.debug('=================Timing Stats=================')
         logger.debug(f"{'track time:':<37}{Profiler.get_avg_millis('track'):>6.3f} ms")
         logger.debug(f"{'preprocess time:':<37}{Profiler.get_avg_millis('preproc'):>6.3f} ms")
@@ -189,6 +424,18 @@ class MOT:
         logger.debug(f"{'feature extract/kalman filter time:':<37}"
                      f"{Profiler.get_avg_millis('extract'):>6.3f} ms")
         logger.debug(f"{'association time:':<37}{Profiler.get_avg_millis('assoc'):>6.3f} ms")
+        if self.detector_type == DetectorType.SSD:
+            self.detector.print_tile_stats()
+        elif self.detector_type == DetectorType.YOLO:
+            self.detector.print_region_stats()
+        self.tracker.flow.print_camera_motion_stats()
+        self.tracker.flow.print_track_motion_stats()
+        self.tracker.print_lod_stats()
+        self.tracker.print_budget_stats()
+        if self.static_gate:
+            for decision in ('static', 'changed', 'active', 'forced'):
+                logger.debug(f"{'gate ' + decision + ' frames:':<37}"
+                             f"{self.gate_count[decision]:>6}")
 
     def _draw(self, frame, detections):
         visible_tracks = list(self.visible_tracks())
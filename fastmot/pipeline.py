@@ -0,0 +1,95 @@
+from collections import Counter
+from queue import Queue
+import itertools
+import threading
+import logging
+import time
+import cupyx
+
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    def __init__(self, stream, mot, depth=2):
+        """Staged executor that overlaps frame reading and optical flow preprocessing
+        of upcoming frames with `MOT.step` on the current frame.
+        Frames are processed in order, so tracking results are identical to serial mode.
+
+        Parameters
+        ----------
+        stream : VideoIO
+            Started video stream to read frames from.
+        mot : MOT
+            Multiple object tracker to run on each frame.
+        depth : int, optional
+            Max number of preprocessed frames in flight ahead of `MOT.step`.
+        """
+        self.stream = stream
+        self.mot = mot
+        assert depth >= 1
+        self.depth = depth
+
+        self.queue = Queue(maxsize=self.depth)
+        # a buffer pair is reused only after its frame has been stepped: one is being
+        # filled, up to depth are queued, and one is being stepped
+        flow = self.mot.tracker.flow
+        self.buffers = [(cupyx.empty_like_pinned(flow.frame_gray),
+                         cupyx.empty_like_pinned(flow.frame_small))
+                        for _ in range(self.depth + 2)]
+        self.exit_event = threading.Event()
+        self.busy_time = Counter()
+        self.start_time = None
+        self.worker = threading.Thread(target=self._prefetch, name='pipeline', daemon=True)
+
+    def __iter__(self):
+        """Steps the tracker on each frame and yields the frame and its timestamp.
+        The frame can be drawn on or written after `MOT.step` in the loop body.
+        """
+        self.start_time = time.perf_counter()
+        if not self.worker.is_alive():
+            self.worker.start()
+        while True:
+            frame, timestamp, preprocessed, native_frame = self.queue.get()
+            if frame is None:
+                break
+            start = time.perf_counter()
+            self.mot.step(frame, timestamp, preprocessed, native_frame)
+            step_latency = time.perf_counter() - start
+            self.busy_time['step'] += step_latency
+            self.stream.update_latency(step_latency, timestamp)
+            yield frame, timestamp
+
+    def stop(self):
+        """Stops prefetching frames."""
+        self.exit_event.set()
+        # unblock the worker if the queue is full
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.worker.join()
+
+    def print_occupancy_info(self):
+        """Logs the fraction of wall time each stage is busy."""
+        if self.start_time is None:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        logger.info('=================Pipeline Stats===============')
+        for stage in ('read', 'preprocess', 'step'):
+            occupancy = self.busy_time[stage] / elapsed * 100
+            logger.info(f"{stage + ' occupancy:':<37}{occupancy:>6.1f} %")
+
+    def _prefetch(self):
+        for frame_gray, frame_small in itertools.cycle(self.buffers):
+            if self.exit_event.is_set():
+                break
+            start = time.perf_counter()
+            frame, timestamp = self.stream.read(return_timestamp=True)
+            native_frame = self.stream.native_frame
+            read_end = time.perf_counter()
+            self.busy_time['read'] += read_end - start
+            if frame is None:
+                self.queue.put((None, None, None, None))
+                break
+            preprocessed = self.mot.preprocess(frame, frame_gray, frame_small)
+            self.busy_time['preprocess'] += time.perf_counter() - read_end
+            self.queue.put((frame, timestamp, preprocessed, native_frame))
@@ -0,0 +1,142 @@
+from pathlib import Path
+from enum import Enum
+from queue import Queue
+import threading
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+RESULT_DTYPE = np.dtype(
+    [('frame_id', np.int32),
+     ('trk_id', np.int32),
+     ('tlwh', np.float64, 4)],
+    align=True
+)
+MOT_LINE_FMT = '%d,%d,%.6f,%.6f,%.6f,%.6f,-1,-1,-1\n'
+
+
+class ResultFormat(Enum):
+    TXT = 0
+    BIN = 1
+
+
+class ResultWriter:
+    def __init__(self, path, size,
+                 resolution=None,
+                 fmt='txt',
+                 flush_interval=100):
+        """Streaming writer for MOT Challenge format results.
+        Track states are collected per frame as arrays and handed off in batches
+        to a background thread, where they are rescaled and formatted in bulk.
+
+        Parameters
+        ----------
+        path : str or Path
+            Path to output results (e.g. MOT20-01.txt).
+        size : tuple
+            Width and height of each frame processed by the tracker.
+        resolution : tuple, optional
+            Original resolution of the input source to rescale bounding boxes to.
+            Defaults to `size`.
+        fmt : {'txt', 'bin'}, optional
+            Output format. `txt` writes MOT Challenge lines and `bin` writes raw
+            records of `RESULT_DTYPE` that can be loaded with `np.fromfile`.
+        flush_interval : int, optional
+            Number of frames to buffer before they are handed off to the writer thread.
+        """
+        self.path = Path(path)
+        self.size = size
+        self.resolution = size if resolution is None else resolution
+        self.fmt = ResultFormat[fmt.upper()]
+        assert flush_interval >= 1
+        self.flush_interval = flush_interval
+
+        self.scale_factor = np.array(self.resolution, np.float64) / self.size
+        self.scale_factor = np.tile(self.scale_factor, 2)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'w' if self.fmt == ResultFormat.TXT else 'wb')
+        self.pending = []
+        self.num_pending_frames = 0
+
+        self.queue = Queue()
+        self.write_thread = threading.Thread(target=self._write_batches)
+        self.write_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, frame_id, tracks):
+        """Collects results of the next frame.
+
+        Parameters
+        ----------
+        frame_id : int
+            Frame ID starting at one.
+        tracks : Iterable[Track]
+            Tracks to write, usually `MOT.visible_tracks()`.
+        """
+        tracks = list(tracks)
+        if len(tracks) > 0:
+            trk_ids = np.fromiter((track.trk_id for track in tracks), np.int32, len(tracks))
+            tlbrs = np.stack([track.tlbr for track in tracks])
+            self.pending.append((frame_id, trk_ids, tlbrs))
+        self.num_pending_frames += 1
+        if self.num_pending_frames >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Hands off buffered results to the writer thread."""
+        if len(self.pending) > 0:
+            self.queue.put(self.pending)
+        self.pending = []
+        self.num_pending_frames = 0
+
+    def close(self):
+        """Flushes remaining results and waits for the writer thread to finish."""
+        if self.file.closed:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.write_thread.join()
+        self.file.close()
+
+    def _write_batches(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            try:
+                records = self._to_records(batch, self.scale_factor)
+                if self.fmt == ResultFormat.TXT:
+                    self.file.write(self._format_lines(records))
+                else:
+                    records.tofile(self.file)
+                self.file.flush()
+            except (OSError, ValueError):
+                logger.exception('Failed to write results to %s', self.path)
+
+    @staticmethod
+    def _to_records(batch, scale_factor):
+        sizes = [len(trk_ids) for _, trk_ids, _ in batch]
+        records = np.empty(sum(sizes), RESULT_DTYPE)
+        records['frame_id'] = np.repeat([frame_id for frame_id, _, _ in batch], sizes)
+        records['trk_id'] = np.concatenate([trk_ids for _, trk_ids, _ in batch])
+        tlbrs = np.concatenate([tlbrs for _, _, tlbrs in batch]) * scale_factor
+        records['tlwh'][:, :2] = tlbrs[:, :2]
+        records['tlwh'][:, 2:] = tlbrs[:, 2:] - tlbrs[:, :2] + 1
+        return records
+
+    @staticmethod
+    def _format_lines(records):
+        columns = np.empty((len(records), 6))
+        columns[:, 0] = records['frame_id']
+        columns[:, 1] = records['trk_id']
+        columns[:, 2:] = records['tlwh']
+        # format all lines with a single string operation
+        return (MOT_LINE_FMT * len(records)) % tuple(columns.ravel())
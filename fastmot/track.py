@@ -144,6 +144,7 @@ class Track:
         self.inlier_ratio = 1.
         self.keypoints = np.empty((0, 2), np.float32)
         self.prev_keypoints = np.empty((0, 2), np.float32)
+        self.affine_mat = None
 
     def __str__(self):
         x, y = get_center(self.tlbr)
@@ -199,6 +200,7 @@ class Track:
         self.age = 0
         self.keypoints = np.empty((0, 2), np.float32)
         self.prev_keypoints = np.empty((0, 2), np.float32)
+        self.affine_mat = None
 
     def mark_missed(self):
         self.age += 1
@@ -212,6 +214,7 @@ class Track:
 
         self.keypoints = other.keypoints
         self.prev_keypoints = other.prev_keypoints
+        self.affine_mat = other.affine_mat
 
         if other.last_feat is not None:
             self.last_feat = other.last_feat
@@ -1,21 +1,47 @@
 from types import SimpleNamespace
-from collections import OrderedDict
+from collections import OrderedDict, Counter
+from multiprocessing.pool import ThreadPool
+from enum import Enum
 import itertools
+import threading
 import logging
+import time
 import numpy as np
 
 from .track import Track
-from .flow import Flow
+from .flow import CameraMotion, Flow
 from .kalman_filter import MeasType, KalmanFilter
 from .utils.distance import Metric, cdist, iou_dist
 from .utils.matching import linear_assignment, greedy_match, fuse_motion, gate_cost
+from .utils.matching import add_row_offsets
 from .utils.rect import as_tlbr, to_tlbr, ios, bbox_ious, find_occluded
 
 logger = logging.getLogger(__name__)
+
+
+BUDGET_SMOOTHING = 0.1 # weight of the latest frame in the per-track cost estimate
+
+
+class Association(Enum):
+    CASCADE = 0
+    GLOBAL = 1
+
+
+class TrackLOD(Enum):
+    """Track level of detail in descending priority."""
+    FAST = 0
+    SLOW = 1
+    SMALL = 2
+    STATIONARY = 3
+
+
 class MultiTracker:
     def __init__(self, size, metric,
+                 association='cascade',
                  max_age=6,
                  age_penalty=2,
+                 age_cost_offset=1.,
+                 parallel_classes=False,
                  motion_weight=0.2,
                  max_assoc_cost=0.9,
                  max_reid_cost=0.45,
@@ -25,6 +51,13 @@ class MultiTracker:
                  conf_thresh=0.5,
                  confirm_hits=1,
                  history_size=50,
+                 lod_interval=1,
+                 stationary_speed=0.05,
+                 fast_speed=1.,
+                 small_height=48,
+                 max_track_points=None,
+                 time_budget=None,
+                 track_budget=None,
                  kalman_filter_cfg=None,
                  flow_cfg=None,
                  on_trackevt=None,
@@ -38,11 +71,26 @@ class MultiTracker:
             Width and height of each frame.
         metric : {'euclidean', 'cosine'}
             Feature distance metric to associate tracks.
+        association : {'cascade', 'global'}, optional
+            Primary association mode. Cascade solves one assignment per age group,
+            starting with tracks of small age. Global solves a single assignment
+            with age priority encoded as cost offsets, which trades strict age
+            priority for more matches.
         max_age : int, optional
             Max number of undetected frames allowed before a track is terminated.
             Note that skipped frames are not included.
         age_penalty : int, optional
             Scale factor to penalize KLT measurements for tracks with large age.
+        age_cost_offset : float, optional
+            Cost added per age group in global association to break ties in favor
+            of younger tracks. The total cost is minimized, so an older track still
+            takes a detection from a younger track if that lets both match.
+        parallel_classes : bool, optional
+            Associate tracks and detections of each class concurrently.
+            Results are merged in class order, so they do not depend on thread timing.
+            Per-track cost construction still holds the GIL, so this needs
+            several busy classes and free CPU cores to pay off.
+            The thread pool has one worker per class and grows as new classes appear.
         motion_weight : float, optional
             Weight for motion term in matching cost function.
         max_assoc_cost : float, optional
@@ -61,6 +109,27 @@ class MultiTracker:
             Min number of detections to confirm a track.
         history_size : int, optional
             Max size of track history to keep for reID.
+        lod_interval : int, optional
+            KLT interval in frames for stationary and small tracks, which are
+            predicted by Kalman filter alone in between. Set 1 to run KLT every frame.
+        stationary_speed : float, optional
+            Max speed in box heights per second of stationary tracks.
+        fast_speed : float, optional
+            Min speed in box heights per second of fast tracks.
+        small_height : int, optional
+            Max box height of small (usually far) tracks.
+        max_track_points : int, optional
+            Max number of KLT feature points on tracks per frame. Points are granted
+            to fast, slow, small, then stationary tracks, and tracks beyond the
+            budget are predicted by Kalman filter alone. Deferred tracks are
+            granted points first in the next frame.
+        time_budget : float, optional
+            Target time in milliseconds for `compute_flow` and `apply_kalman` per frame.
+            The number of tracks that run KLT is limited using a running estimate of
+            the cost per track, and the rest are predicted by Kalman filter alone.
+        track_budget : int, optional
+            Max number of tracks that run KLT per frame. Tracks are prioritized by
+            confirmation, then closeness to the camera, then recent detection.
         kalman_filter_cfg : SimpleNamespace, optional
             Kalman Filter configuration.
         flow_cfg : SimpleNamespace, optional
@@ -69,10 +138,17 @@ class MultiTracker:
         """
         self.size = size
         self.metric = Metric[metric.upper()]
+        self.association = Association[association.upper()]
         assert max_age >= 1
         self.max_age = max_age
         assert age_penalty >= 1
         self.age_penalty = age_penalty
+        assert age_cost_offset >= 0
+        self.age_cost_offset = age_cost_offset
+        self.parallel_classes = parallel_classes
+        # one worker per class, created on first use
+        self.pool = None
+        self.pool_size = 0
         assert 0 <= motion_weight <= 1
         self.motion_weight = motion_weight
         assert 0 <= max_assoc_cost <= 2
@@ -91,6 +167,20 @@ class MultiTracker:
         self.confirm_hits = confirm_hits
         assert history_size >= 0
         self.history_size = history_size
+        assert lod_interval >= 1
+        self.lod_interval = lod_interval
+        assert stationary_speed >= 0
+        self.stationary_speed = stationary_speed
+        assert fast_speed >= stationary_speed
+        self.fast_speed = fast_speed
+        assert small_height >= 0
+        self.small_height = small_height
+        assert max_track_points is None or max_track_points >= 0
+        self.max_track_points = max_track_points
+        assert time_budget is None or time_budget > 0
+        self.time_budget = time_budget
+        assert track_budget is None or track_budget >= 0
+        self.track_budget = track_budget
 
         if kalman_filter_cfg is None:
             kalman_filter_cfg = SimpleNamespace()
@@ -105,10 +195,21 @@ class MultiTracker:
 
         self.klt_bboxes = {}
         self.homography = None
+        self._reset_stats()
+
+        # parallel Numba kernels are not launched from multiple threads at once
+        self.parallel_kernel_lock = threading.Lock()
 
         # pass event from mot.py
         self.on_trackevt = on_trackevt 
 
+    def __del__(self):
+        # the constructor may fail before the pool attribute is set
+        pool = getattr(self, 'pool', None)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     def cb_evt(self, evt_payload, log_level, log_payload):
         #logger.info("cb_evt()")
 
@@ -130,10 +231,25 @@ class MultiTracker:
             Time interval in seconds between each frame.
         """
         self.kf.reset_dt(dt)
+        self.tracks.clear()
         self.hist_tracks.clear()
+        self.klt_bboxes = {}
+        self.homography = None
+        self.flow.reset()
+        self._reset_stats()
         Track._count = 0
 
-    def init(self, frame, detections):
+    def set_dt(self, dt):
+        """Sets the time interval for the next motion prediction.
+
+        Parameters
+        ----------
+        dt : float
+            Time interval in seconds since the previous frame.
+        """
+        self.kf.set_dt(dt)
+
+    def init(self, frame, detections, preprocessed=None):
         """Initializes the tracker from detections in the first frame.
 
         Parameters
@@ -142,48 +258,120 @@ class MultiTracker:
             Initial frame.
         detections : recarray[DET_DTYPE]
             Record array of N detections.
+        preprocessed : tuple, optional
+            Output of `Flow.preprocess` for the frame if computed ahead of time.
         """
         self.tracks.clear()
-        self.flow.init(frame)
+        self.homography = None
+        self.flow.init(frame, preprocessed)
         for det in detections:
             state = self.kf.create(det.tlbr)
-            new_trk = Track(0, det.tlbr, state, det.label, self.confirm_hits)
+            # detections are views of a reused buffer
+            new_trk = Track(0, det.tlbr.copy(), state, det.label, self.confirm_hits)
             self.tracks[new_trk.trk_id] = new_trk
             #logger.debug(f"{'Detected:':<14}{new_trk}")
             self.cb_evt({'detected': new_trk.toJSONSerializable()}, 'debug', f"{'Detected:':<14}{new_trk}")
 
-    def track(self, frame):
+    def track(self, frame, preprocessed=None):
         """Convenience function that combines `compute_flow` and `apply_kalman`.
 
         Parameters
         ----------
         frame : ndarray
             The next frame.
+        preprocessed : tuple, optional
+            Output of `Flow.preprocess` for the frame if computed ahead of time.
         """
-        self.compute_flow(frame)
+        self.compute_flow(frame, preprocessed)
         self.apply_kalman()
 
-    def compute_flow(self, frame):
+    def compute_flow(self, frame, preprocessed=None):
         """Computes optical flow to estimate tracklet positions and camera motion.
 
         Parameters
         ----------
         frame : ndarray
             The next frame.
+        preprocessed : tuple, optional
+            Output of `Flow.preprocess` for the frame if computed ahead of time.
         """
         active_tracks = [track for track in self.tracks.values() if track.active]
-        self.klt_bboxes, self.homography = self.flow.predict(frame, active_tracks)
+        init_disps = None
+        if self.flow.init_flow:
+            init_disps = {track.trk_id: self.kf.displacement(track.state[0])
+                          for track in active_tracks}
+        start = time.perf_counter()
+        skip_ids = self._schedule_flow(active_tracks)
+        skip_ids = self._apply_budget(active_tracks, skip_ids)
+        self.klt_bboxes, self.homography = self.flow.predict(frame, active_tracks, preprocessed,
+                                                              init_disps, self.homography,
+                                                              skip_ids, self.max_track_points)
+        self.num_deferred += len(self.flow.deferred_ids)
+        self.num_klt_tracks = (len(active_tracks) - len(self.flow.deferred_ids) -
+                               (0 if skip_ids is None else len(skip_ids)))
+        self.flow_time = time.perf_counter() - start
         if self.homography is None:
             # clear tracks when camera motion cannot be estimated
             self.tracks.clear()
 
+    def skip_flow(self):
+        """Predicts tracks by Kalman filter alone in place of `compute_flow` and
+        `apply_kalman`, for frames without camera or target motion.
+        """
+        self.klt_bboxes = {}
+        self.homography = np.eye(3)
+        # gated frames are not representative of the per-track cost, so the budget is not updated
+        self._predict_kalman()
+
+    @property
+    def budget_metrics(self):
+        """Dictionary of bounded latency metrics: budgeted frames, budget overruns,
+        and tracks degraded to Kalman filter prediction."""
+        return {
+            'frames': self.budget_frames,
+            'overruns': self.budget_overruns,
+            'degraded_tracks': self.num_degraded
+        }
+
+    def print_budget_stats(self):
+        """Logs bounded latency metrics."""
+        if self.time_budget is None and self.track_budget is None:
+            return
+        metrics = self.budget_metrics
+        overrun_ratio = metrics['overruns'] / max(metrics['frames'], 1) * 100
+        logger.debug(f"{'budget overruns:':<37}{overrun_ratio:>6.1f} %")
+        logger.debug(f"{'degraded tracks:':<37}{metrics['degraded_tracks']:>6}")
+        if self.target_cost is not None:
+            logger.debug(f"{'est. KLT time per track:':<37}{self.target_cost:>6.3f} ms")
+
+    def print_lod_stats(self):
+        """Logs track counts per level of detail and the estimated KLT time saved."""
+        if self.lod_interval == 1 and self.max_track_points is None:
+            return
+        for lod in TrackLOD:
+            logger.debug(f"{lod.name.lower() + ' tracks:':<37}{self.lod_count[lod]:>6}")
+        logger.debug(f"{'KLT skipped tracks:':<37}{self.num_skipped:>6}")
+        logger.debug(f"{'KLT deferred tracks:':<37}{self.num_deferred:>6}")
+        if self.flow.num_targets > 0:
+            avg_time = self.flow.target_time * 1000 / self.flow.num_targets
+            saved_time = (self.num_skipped + self.num_deferred) * avg_time
+            logger.debug(f"{'est. KLT time saved:':<37}{saved_time:>6.3f} ms")
+
     def apply_kalman(self):
         """Performs kalman filter predict and update from KLT measurements.
         The function should be called after `compute_flow`.
         """
+        start = time.perf_counter()
+        self._predict_kalman()
+        if self.time_budget is not None or self.track_budget is not None:
+            self._update_budget(self.flow_time + time.perf_counter() - start)
+
+    def _predict_kalman(self):
         for trk_id, track in list(self.tracks.items()):
             mean, cov = track.state
-            mean, cov = self.kf.warp(mean, cov, self.homography)
+            # no camera motion to compensate for a static camera
+            if self.flow.estimator != CameraMotion.STATIC:
+                mean, cov = self.kf.warp(mean, cov, self.homography)
             mean, cov = self.kf.predict(mean, cov)
             if trk_id in self.klt_bboxes:
                 klt_tlbr = self.klt_bboxes[trk_id]
@@ -199,7 +387,32 @@ class MultiTracker:
                     self.cb_evt({'out': track.toJSONSerializable()}, 'info', f"{'Out:':<14}{track}")
                 self._mark_lost(trk_id)
 
-    def update(self, frame_id, detections, embeddings):
+    def uncertain_tracks(self, max_std, min_inlier_ratio):
+        """Finds tracks that need a closer look by the detector.
+
+        Parameters
+        ----------
+        max_std : float
+            Max Kalman position standard deviation relative to box height.
+        min_inlier_ratio : float
+            Min KLT inlier ratio.
+
+        Returns
+        -------
+        List[Track]
+            Tracks that exceed either limit, most uncertain first.
+        """
+        stds = {}
+        for trk_id, track in self.tracks.items():
+            mean, cov = track.state
+            height = max(mean[3] - mean[1] + 1, 1.)
+            std = np.sqrt(np.mean(np.diag(cov)[:4])) / height
+            if std > max_std or track.inlier_ratio < min_inlier_ratio:
+                stds[trk_id] = std
+        return sorted((self.tracks[trk_id] for trk_id in stds),
+                      key=lambda track: stds[track.trk_id], reverse=True)
+
+    def update(self, frame_id, detections, embeddings, regions=None):
         """Associates detections to tracklets based on motion and feature embeddings.
 
         Parameters
@@ -210,38 +423,25 @@ class MultiTracker:
             Record array of N detections.
         embeddings : ndarray
             NxM matrix of N extracted embeddings with dimension M.
+        regions : ndarray, optional
+            Mx4 array of regions the detector was limited to. Unmatched tracks
+            outside all regions were not observed, so they are not marked missed.
         """
         occluded_det_mask = find_occluded(detections.tlbr, self.occlusion_thresh)
         confirmed_by_depth, unconfirmed = self._group_tracks_by_depth()
-
-        # association with motion and embeddings, tracks with small age are prioritized
-        matches1 = []
-        u_trk_ids1 = []
-        u_det_ids = list(range(len(detections)))
-        for depth, trk_ids in enumerate(confirmed_by_depth):
-            if len(u_det_ids) == 0:
-                u_trk_ids1.extend(itertools.chain.from_iterable(confirmed_by_depth[depth:]))
-                break
-            if len(trk_ids) == 0:
-                continue
-            u_detections, u_embeddings = detections[u_det_ids], embeddings[u_det_ids]
-            u_occluded_dmask = occluded_det_mask[u_det_ids]
-            cost = self._matching_cost(trk_ids, u_detections, u_embeddings, u_occluded_dmask)
-            matches, u_trk_ids, u_det_ids = linear_assignment(cost, trk_ids, u_det_ids)
-            matches1 += matches
-            u_trk_ids1 += u_trk_ids
-
-        # 2nd association with IoU
-        active = [trk_id for trk_id in u_trk_ids1 if self.tracks[trk_id].active]
-        u_trk_ids1 = [trk_id for trk_id in u_trk_ids1 if not self.tracks[trk_id].active]
-        u_detections = detections[u_det_ids]
-        cost = self._iou_cost(active, u_detections)
-        matches2, u_trk_ids2, u_det_ids = linear_assignment(cost, active, u_det_ids)
-
-        # 3rd association with unconfirmed tracks
-        u_detections = detections[u_det_ids]
-        cost = self._iou_cost(unconfirmed, u_detections)
-        matches3, u_trk_ids3, u_det_ids = linear_assignment(cost, unconfirmed, u_det_ids)
+        det_ids = list(range(len(detections)))
+
+        # cross-class pairs are gated, so classes can be associated independently
+        labels = {track.label for track in self.tracks.values()}
+        labels.update(np.unique(detections.label).tolist())
+        if self.parallel_classes and len(labels) > 1:
+            matches, u_trk_ids, u_det_ids = self._associate_by_class(
+                sorted(labels), confirmed_by_depth, unconfirmed, det_ids,
+                detections, embeddings, occluded_det_mask)
+        else:
+            matches, u_trk_ids, u_det_ids = self._associate(
+                confirmed_by_depth, unconfirmed, det_ids,
+                detections, embeddings, occluded_det_mask)
 
         # reID with track history
         hist_ids = [trk_id for trk_id, track in self.hist_tracks.items()
@@ -257,9 +457,6 @@ class MultiTracker:
         reid_matches, _, reid_u_det_ids = greedy_match(cost, hist_ids, valid_u_det_ids,
                                                        self.max_reid_cost)
 
-        matches = itertools.chain(matches1, matches2, matches3)
-        u_trk_ids = itertools.chain(u_trk_ids1, u_trk_ids2, u_trk_ids3)
-
         # rectify matches that may cause duplicate tracks
         matches, u_trk_ids = self._rectify_matches(matches, u_trk_ids, detections)
 
@@ -270,7 +467,7 @@ class MultiTracker:
             #logger.info(f"{'Reidentified:':<14}{track}")
             self.cb_evt({'reidentified': track.toJSONSerializable()}, 'info', f"{'Reidentified:':<14}{track}")
             state = self.kf.create(det.tlbr)
-            track.reinstate(frame_id, det.tlbr, state, embeddings[det_id])
+            track.reinstate(frame_id, det.tlbr.copy(), state, embeddings[det_id])
             self.tracks[trk_id] = track
 
         # update matched tracks
@@ -294,6 +491,8 @@ class MultiTracker:
         # clean up lost tracks
         for trk_id in u_trk_ids:
             track = self.tracks[trk_id]
+            if regions is not None and all(ios(track.tlbr, region) < 0.5 for region in regions):
+                continue
             track.mark_missed()
             if not track.confirmed:
                 #logger.debug(f"{'Unconfirmed:':<14}{track}")
@@ -310,11 +509,28 @@ class MultiTracker:
         for det_id in u_det_ids:
             det = detections[det_id]
             state = self.kf.create(det.tlbr)
-            new_trk = Track(frame_id, det.tlbr, state, det.label, self.confirm_hits)
+            new_trk = Track(frame_id, det.tlbr.copy(), state, det.label, self.confirm_hits)
             self.tracks[new_trk.trk_id] = new_trk
             #logger.debug(f"{'Detected:':<14}{new_trk}")
             self.cb_evt({'detected': new_trk.toJSONSerializable()}, 'debug', f"{'Detected:':<14}{new_trk}")
 
+    def _reset_stats(self):
+        # level of detail statistics
+        self.flow_count = 0
+        self.lod_count = Counter()
+        self.num_skipped = 0
+        self.num_deferred = 0
+
+        # bounded latency cost estimates and metrics
+        self.target_cost = None
+        self.base_cost = 0.
+        self.flow_time = 0.
+        self.num_klt_tracks = 0
+        self.prev_target_time = 0.
+        self.budget_frames = 0
+        self.budget_overruns = 0
+        self.num_degraded = 0
+
     def _mark_lost(self, trk_id):
         track = self.tracks.pop(trk_id)
         if track.confirmed:
@@ -322,6 +538,69 @@ class MultiTracker:
             if len(self.hist_tracks) > self.history_size:
                 self.hist_tracks.popitem(last=False)
 
+    def _schedule_flow(self, tracks):
+        self.flow_count += 1
+        if self.lod_interval == 1 and self.max_track_points is None:
+            return None
+        lods = {track.trk_id: self._classify(track) for track in tracks}
+        # order by priority for the point budget
+        tracks.sort(key=lambda track: lods[track.trk_id].value)
+        skip_ids = set()
+        for track in tracks:
+            lod = lods[track.trk_id]
+            self.lod_count[lod] += 1
+            # stagger low priority tracks across frames
+            if (lod in (TrackLOD.SMALL, TrackLOD.STATIONARY) and
+                    (self.flow_count + track.trk_id) % self.lod_interval != 0):
+                skip_ids.add(track.trk_id)
+        self.num_skipped += len(skip_ids)
+        return skip_ids
+
+    def _apply_budget(self, tracks, skip_ids):
+        max_tracks = self.track_budget
+        if self.time_budget is not None and self.target_cost is not None:
+            time_tracks = max(int((self.time_budget - self.base_cost) / self.target_cost), 0)
+            max_tracks = time_tracks if max_tracks is None else min(max_tracks, time_tracks)
+        if max_tracks is None:
+            return skip_ids
+        klt_tracks = [track for track in tracks if skip_ids is None or
+                      track.trk_id not in skip_ids]
+        if len(klt_tracks) <= max_tracks:
+            return skip_ids
+        # confirmed, closer, then recently detected tracks first
+        klt_tracks.sort(key=lambda track: (track.confirmed, track), reverse=True)
+        degraded_ids = {track.trk_id for track in klt_tracks[max_tracks:]}
+        self.num_degraded += len(degraded_ids)
+        return degraded_ids if skip_ids is None else skip_ids | degraded_ids
+
+    def _update_budget(self, elapsed):
+        elapsed *= 1000
+        self.budget_frames += 1
+        if self.time_budget is not None and elapsed > self.time_budget:
+            self.budget_overruns += 1
+        # split frame time into per-track KLT cost and the rest
+        target_time = (self.flow.target_time - self.prev_target_time) * 1000
+        self.prev_target_time = self.flow.target_time
+        if self.num_klt_tracks > 0:
+            target_cost = target_time / self.num_klt_tracks
+            if self.target_cost is None:
+                self.target_cost = target_cost
+            else:
+                self.target_cost += BUDGET_SMOOTHING * (target_cost - self.target_cost)
+        self.base_cost += BUDGET_SMOOTHING * (elapsed - target_time - self.base_cost)
+
+    def _classify(self, track):
+        mean = track.state[0]
+        height = max(mean[3] - mean[1] + 1, 1.)
+        speed = np.linalg.norm(mean[4:6] + mean[6:8]) / 2 / height
+        if speed >= self.fast_speed:
+            return TrackLOD.FAST
+        if speed < self.stationary_speed:
+            return TrackLOD.STATIONARY
+        if height < self.small_height:
+            return TrackLOD.SMALL
+        return TrackLOD.SLOW
+
     def _group_tracks_by_depth(self, group_size=2):
         n_depth = (self.max_age + group_size) // group_size
         confirmed_by_depth = [[] for _ in range(n_depth)]
@@ -334,6 +613,92 @@ class MultiTracker:
                 unconfirmed.append(trk_id)
         return confirmed_by_depth, unconfirmed
 
+    def _associate_by_class(self, labels, confirmed_by_depth, unconfirmed, det_ids,
+                            detections, embeddings, occluded_det_mask):
+        args = []
+        for label in labels:
+            cls_confirmed_by_depth = [[trk_id for trk_id in trk_ids
+                                       if self.tracks[trk_id].label == label]
+                                      for trk_ids in confirmed_by_depth]
+            cls_unconfirmed = [trk_id for trk_id in unconfirmed
+                               if self.tracks[trk_id].label == label]
+            cls_det_ids = [det_id for det_id in det_ids if detections[det_id].label == label]
+            args.append((cls_confirmed_by_depth, cls_unconfirmed, cls_det_ids,
+                         detections, embeddings, occluded_det_mask))
+
+        # the pool grows with the number of classes seen so far
+        if len(labels) > self.pool_size:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            self.pool = ThreadPool(len(labels))
+            self.pool_size = len(labels)
+
+        # results are merged in class order
+        matches, u_trk_ids, u_det_ids = [], [], []
+        for cls_matches, cls_u_trk_ids, cls_u_det_ids in self.pool.starmap(self._associate, args):
+            matches += cls_matches
+            u_trk_ids += cls_u_trk_ids
+            u_det_ids += cls_u_det_ids
+        return matches, u_trk_ids, sorted(u_det_ids)
+
+    def _associate(self, confirmed_by_depth, unconfirmed, det_ids,
+                   detections, embeddings, occluded_det_mask):
+        # association with motion and embeddings, tracks with small age are prioritized
+        if self.association == Association.GLOBAL:
+            matches1, u_trk_ids1, u_det_ids = self._associate_global(
+                confirmed_by_depth, det_ids, detections, embeddings, occluded_det_mask)
+        else:
+            matches1, u_trk_ids1, u_det_ids = self._associate_cascade(
+                confirmed_by_depth, det_ids, detections, embeddings, occluded_det_mask)
+
+        # 2nd association with IoU
+        active = [trk_id for trk_id in u_trk_ids1 if self.tracks[trk_id].active]
+        u_trk_ids1 = [trk_id for trk_id in u_trk_ids1 if not self.tracks[trk_id].active]
+        u_detections = detections[u_det_ids]
+        cost = self._iou_cost(active, u_detections)
+        matches2, u_trk_ids2, u_det_ids = linear_assignment(cost, active, u_det_ids)
+
+        # 3rd association with unconfirmed tracks
+        u_detections = detections[u_det_ids]
+        cost = self._iou_cost(unconfirmed, u_detections)
+        matches3, u_trk_ids3, u_det_ids = linear_assignment(cost, unconfirmed, u_det_ids)
+
+        matches = list(itertools.chain(matches1, matches2, matches3))
+        u_trk_ids = list(itertools.chain(u_trk_ids1, u_trk_ids2, u_trk_ids3))
+        return matches, u_trk_ids, u_det_ids
+
+    def _associate_cascade(self, confirmed_by_depth, det_ids, detections, embeddings,
+                           occluded_det_mask):
+        matches1 = []
+        u_trk_ids1 = []
+        u_det_ids = det_ids
+        for depth, trk_ids in enumerate(confirmed_by_depth):
+            if len(u_det_ids) == 0:
+                u_trk_ids1.extend(itertools.chain.from_iterable(confirmed_by_depth[depth:]))
+                break
+            if len(trk_ids) == 0:
+                continue
+            u_detections, u_embeddings = detections[u_det_ids], embeddings[u_det_ids]
+            u_occluded_dmask = occluded_det_mask[u_det_ids]
+            cost = self._matching_cost(trk_ids, u_detections, u_embeddings, u_occluded_dmask)
+            matches, u_trk_ids, u_det_ids = linear_assignment(cost, trk_ids, u_det_ids)
+            matches1 += matches
+            u_trk_ids1 += u_trk_ids
+        return matches1, u_trk_ids1, u_det_ids
+
+    def _associate_global(self, confirmed_by_depth, det_ids, detections, embeddings,
+                          occluded_det_mask):
+        trk_ids = list(itertools.chain.from_iterable(confirmed_by_depth))
+        cost = self._matching_cost(trk_ids, detections[det_ids], embeddings[det_ids],
+                                   occluded_det_mask[det_ids])
+
+        # offset valid costs by age group, gated pairs stay unmatched
+        depths = np.repeat(np.arange(len(confirmed_by_depth)),
+                           [len(ids) for ids in confirmed_by_depth])
+        add_row_offsets(cost, depths * self.age_cost_offset)
+        return linear_assignment(cost, trk_ids, det_ids)
+
     def _matching_cost(self, trk_ids, detections, embeddings, occluded_dmask):
         n_trk, n_det = len(trk_ids), len(detections)
         if n_trk == 0 or n_det == 0:
@@ -350,7 +715,8 @@ class MultiTracker:
 
         empty_mask = invalid_fmask[:, None] | occluded_dmask
         fill_val = min(self.max_assoc_cost + 0.1, 1.)
-        cost = cdist(features, embeddings, self.metric, empty_mask, fill_val)
+        with self.parallel_kernel_lock:
+            cost = cdist(features, embeddings, self.metric, empty_mask, fill_val)
 
         # fuse motion information
         for row, trk_id in enumerate(trk_ids):
@@ -1,4 +1,5 @@
 from .inference import TRTInference
 from .decoder import ConfigDecoder
 from .profiler import Profiler
+from .model_manager import ModelManager
 from .tojson import NpEncoder
\ No newline at end of file
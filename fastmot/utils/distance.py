@@ -87,7 +87,7 @@ def cosine(XA, XB, empty_mask=None, filler=1., symmetric=False):
     return Y
 
 
-@nb.njit(parallel=False, fastmath=True, cache=True)
+@nb.njit(parallel=False, fastmath=True, nogil=True, cache=True)
 def iou_dist(tlbrs1, tlbrs2):
     """Computes pairwise IoU distance."""
     assert tlbrs1.ndim == tlbrs2.ndim == 2
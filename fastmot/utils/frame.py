@@ -0,0 +1,119 @@
+from enum import Enum
+import numpy as np
+import cv2
+
+
+class PixelFormat(Enum):
+    """Frame layouts. YUV frames are single channel arrays of shape (H * 3 / 2, W)
+    as delivered by OpenCV and GStreamer, with the full resolution Y plane first."""
+    BGR = 0
+    I420 = 1
+    NV12 = 2
+
+
+def frame_size(frame, pixel_format):
+    """Returns the width and height of a frame."""
+    if pixel_format == PixelFormat.BGR:
+        return frame.shape[1], frame.shape[0]
+    return frame.shape[1], frame.shape[0] * 2 // 3
+
+
+def yuv_planes(frame, pixel_format, tlbr=None):
+    """Returns views of the Y plane and the U and V planes at half resolution,
+    optionally cropped to a region of the frame.
+    Works with any array type that supports slicing and reshaping, e.g. CuPy arrays."""
+    y, chroma = _split_planes(frame, pixel_format)
+    if tlbr is not None:
+        y, chroma = _crop_planes(y, chroma, tlbr)
+    if pixel_format == PixelFormat.I420:
+        return y, chroma[0], chroma[1]
+    return y, chroma[0][..., 0], chroma[0][..., 1]
+
+
+def resize_to_bgr(frame, pixel_format, dsize, tlbr=None):
+    """Crops and resizes a frame to a BGR image of size `dsize`.
+    YUV planes are resized first so that only output pixels are converted.
+
+    Parameters
+    ----------
+    frame : ndarray
+        Frame to resize.
+    pixel_format : PixelFormat
+        Layout of the frame.
+    dsize : tuple
+        Width and height of the output image.
+    tlbr : ndarray, optional
+        Region of the frame to crop.
+
+    Returns
+    -------
+    ndarray
+        BGR image.
+    """
+    if pixel_format == PixelFormat.BGR:
+        if tlbr is not None:
+            xmin, ymin, xmax, ymax = np.maximum(np.asarray(tlbr, np.int_), 0)
+            frame = frame[ymin:ymax + 1, xmin:xmax + 1]
+        return cv2.resize(frame, dsize)
+
+    y, chroma = _split_planes(frame, pixel_format)
+    if tlbr is not None:
+        y, chroma = _crop_planes(y, chroma, tlbr)
+
+    # planes are resized into a small frame of the same format with even size,
+    # which OpenCV converts with nearest chroma like the full frame conversion
+    width, height = dsize
+    even_size = (width + width % 2, height + height % 2)
+    small = np.empty((even_size[1] * 3 // 2, even_size[0]), np.uint8)
+    small_y, small_chroma = _split_planes(small, pixel_format)
+    if even_size == tuple(dsize):
+        cv2.resize(y, even_size, dst=small_y)
+    else:
+        small_y[:] = cv2.resize(y, even_size)
+    chroma_size = (even_size[0] // 2, even_size[1] // 2)
+    for plane, small_plane in zip(chroma, small_chroma):
+        small_plane[:] = cv2.resize(plane, chroma_size)
+    code = cv2.COLOR_YUV2BGR_I420 if pixel_format == PixelFormat.I420 else cv2.COLOR_YUV2BGR_NV12
+    return cv2.cvtColor(small, code)[:height, :width]
+
+
+def to_bgr(frame, pixel_format):
+    """Converts a full frame to BGR."""
+    if pixel_format == PixelFormat.I420:
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+    if pixel_format == PixelFormat.NV12:
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_NV12)
+    return frame
+
+
+def from_bgr(frame, pixel_format):
+    """Converts a BGR frame with even width and height to a pixel format."""
+    if pixel_format == PixelFormat.BGR:
+        return frame
+    i420 = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+    if pixel_format == PixelFormat.I420:
+        return i420
+    y, u, v = yuv_planes(i420, PixelFormat.I420)
+    nv12 = np.empty_like(i420)
+    _, nv12_u, nv12_v = yuv_planes(nv12, PixelFormat.NV12)
+    nv12[:len(y)] = y
+    nv12_u[:] = u
+    nv12_v[:] = v
+    return nv12
+
+
+def _split_planes(frame, pixel_format):
+    # Y plane and chroma planes, NV12 chroma stays interleaved
+    width, height = frame_size(frame, pixel_format)
+    y = frame[:height]
+    if pixel_format == PixelFormat.I420:
+        chroma = frame[height:].reshape(2, height // 2, width // 2)
+        return y, [chroma[0], chroma[1]]
+    return y, [frame[height:].reshape(height // 2, width // 2, 2)]
+
+
+def _crop_planes(y, chroma, tlbr):
+    xmin, ymin, xmax, ymax = np.maximum(np.asarray(tlbr, np.int_), 0)
+    y = y[ymin:ymax + 1, xmin:xmax + 1]
+    chroma = [plane[ymin // 2:ymax // 2 + 1, xmin // 2:xmax // 2 + 1] for plane in chroma]
+    return y, chroma
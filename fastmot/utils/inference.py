@@ -1,9 +1,25 @@
 import ctypes
+import logging
 import cupy as cp
 import cupyx
 import tensorrt as trt
 
 
+logger = logging.getLogger(__name__)
+
+# bump to invalidate engines cached by older versions
+ENGINE_CACHE_VERSION = 1
+
+
+def engine_cache_path(model, batch_size):
+    """Returns the versioned engine path keyed by model, batch size, and backend."""
+    compute = cp.cuda.Device().compute_capability
+    return model.ENGINE_PATH.with_name(
+        f'{model.ENGINE_PATH.stem}_b{batch_size}_trt{trt.__version__}_sm{compute}'
+        f'_v{ENGINE_CACHE_VERSION}{model.ENGINE_PATH.suffix}'
+    )
+
+
 class HostDeviceMem:
     def __init__(self, size, dtype):
         self.size = size
@@ -29,11 +45,13 @@ class HostDeviceMem:
     def devptr(self):
         return self.device.data.ptr
 
-    def copy_htod_async(self, stream):
-        self.device.data.copy_from_host_async(self.hostptr, self.nbytes, stream)
+    def copy_htod_async(self, stream, nbytes=None):
+        nbytes = self.nbytes if nbytes is None else nbytes
+        self.device.data.copy_from_host_async(self.hostptr, nbytes, stream)
 
-    def copy_dtoh_async(self, stream):
-        self.device.data.copy_to_host_async(self.hostptr, self.nbytes, stream)
+    def copy_dtoh_async(self, stream, nbytes=None):
+        nbytes = self.nbytes if nbytes is None else nbytes
+        self.device.data.copy_to_host_async(self.hostptr, nbytes, stream)
 
 
 class TRTInference:
@@ -52,13 +70,17 @@ class TRTInference:
             except OSError as err:
                 raise RuntimeError('Plugin not found') from err
 
-        # load trt engine or build one if not found
-        if not self.model.ENGINE_PATH.exists():
-            self.engine = self.model.build_engine(TRTInference.TRT_LOGGER, self.batch_size)
-        else:
-            runtime = trt.Runtime(TRTInference.TRT_LOGGER)
-            with open(self.model.ENGINE_PATH, 'rb') as engine_file:
-                self.engine = runtime.deserialize_cuda_engine(engine_file.read())
+        # load cached trt engine or build one if not found
+        # a compatible engine at the unversioned path is still accepted
+        self.engine_path = engine_cache_path(self.model, self.batch_size)
+        self.engine = None
+        for engine_path in (self.engine_path, self.model.ENGINE_PATH):
+            self.engine = self._load_engine(engine_path, self.batch_size)
+            if self.engine is not None:
+                break
+        if self.engine is None:
+            self.engine = self.model.build_engine(TRTInference.TRT_LOGGER, self.batch_size,
+                                                  engine_path=self.engine_path)
         if self.engine is None:
             raise RuntimeError('Unable to load the engine file')
         if self.engine.has_implicit_batch_dimension:
@@ -103,17 +125,23 @@ class TRTInference:
         self.infer_async()
         return self.synchronize()
 
-    def infer_async(self, from_device=False):
+    def infer_async(self, from_device=False, batch_size=None):
+        # a smaller batch only runs and transfers the leading part of each buffer
+        # for implicit batch engines, explicit batch engines always run in full
+        if batch_size is None or not self.engine.has_implicit_batch_dimension:
+            batch_size = self.batch_size
+        assert 1 <= batch_size <= self.batch_size
         self.start.record(self.stream)
         if not from_device:
-            self.input.copy_htod_async(self.stream)
+            self.input.copy_htod_async(self.stream,
+                                       self.input.nbytes * batch_size // self.batch_size)
         if self.engine.has_implicit_batch_dimension:
-            self.context.execute_async(batch_size=self.batch_size, bindings=self.bindings,
+            self.context.execute_async(batch_size=batch_size, bindings=self.bindings,
                                        stream_handle=self.stream.ptr)
         else:
             self.context.execute_async_v2(bindings=self.bindings, stream_handle=self.stream.ptr)
         for out in self.outputs:
-            out.copy_dtoh_async(self.stream)
+            out.copy_dtoh_async(self.stream, out.nbytes * batch_size // self.batch_size)
         self.end.record(self.stream)
 
     def synchronize(self):
@@ -123,3 +151,23 @@ class TRTInference:
     def get_infer_time(self):
         self.end.synchronize()
         return cp.cuda.get_elapsed_time(self.start, self.end)
+
+    @staticmethod
+    def _load_engine(engine_path, batch_size):
+        if not engine_path.exists():
+            return None
+        runtime = trt.Runtime(TRTInference.TRT_LOGGER)
+        with open(engine_path, 'rb') as engine_file:
+            engine = runtime.deserialize_cuda_engine(engine_file.read())
+        if engine is None:
+            logger.warning('Incompatible engine file: %s', engine_path)
+            return None
+        # reject engines built for a different batch size
+        if engine.has_implicit_batch_dimension:
+            compatible = batch_size <= engine.max_batch_size
+        else:
+            compatible = engine.get_binding_shape(0)[0] == batch_size
+        if not compatible:
+            logger.warning('Engine file built for a different batch size: %s', engine_path)
+            return None
+        return engine
@@ -54,6 +54,37 @@ def greedy_match(cost, row_ids, col_ids, max_cost):
     return _greedy_match(cost, row_ids, col_ids, max_cost)
 
 
+def sparse_greedy_match(rows, cols, costs, row_ids, col_ids, max_cost):
+    """Performs greedy matching on sparse (row, column, cost) triplets until
+    the cost exceeds `max_cost`. Matches are identical to `greedy_match` on
+    a dense matrix holding the same finite entries.
+
+    Parameters
+    ----------
+    rows : ndarray
+        Row index of each entry.
+    cols : ndarray
+        Column index of each entry.
+    costs : ndarray
+        Cost of each entry.
+    row_ids : List[int]
+        IDs that correspond to each row.
+    col_ids : List[int]
+        IDs that correspond to each column.
+    max_cost : float
+        Maximum cost allowed to match a row with a column.
+
+    Returns
+    -------
+    List[tuple], List[int], List[int]
+        Matched row and column IDs, unmatched row IDs, and unmatched column IDs.
+    """
+    row_ids = np.fromiter(row_ids, int, len(row_ids))
+    col_ids = np.fromiter(col_ids, int, len(col_ids))
+    return _sparse_greedy_match(np.asarray(rows, np.int64), np.asarray(cols, np.int64),
+                                np.asarray(costs, np.float64), row_ids, col_ids, max_cost)
+
+
 @nb.njit(fastmath=True, cache=True)
 def _get_assignment_matches(cost, row_ids, col_ids, m_rows, m_cols):
     unmatched_rows = list(set(range(cost.shape[0])) - set(m_rows))
@@ -72,32 +103,44 @@ def _get_assignment_matches(cost, row_ids, col_ids, m_rows, m_cols):
 
 @nb.njit(fastmath=True, cache=True)
 def _greedy_match(cost, row_ids, col_ids, max_cost):
-    indices_rows = np.arange(cost.shape[0])
-    indices_cols = np.arange(cost.shape[1])
+    # row-major order so that ties resolve like argmin over the whole matrix
+    rows, cols = np.nonzero(cost <= max_cost)
+    costs = np.empty(len(rows))
+    for k in range(len(rows)):
+        costs[k] = cost[rows[k], cols[k]]
+    return _sweep_edges(rows, cols, costs, row_ids, col_ids)
 
-    matches = []
-    while cost.shape[0] > 0 and cost.shape[1] > 0:
-        idx = np.argmin(cost)
-        i, j = idx // cost.shape[1], idx % cost.shape[1]
-        if cost[i, j] <= max_cost:
-            matches.append((row_ids[indices_rows[i]], col_ids[indices_cols[j]]))
-            row_mask = np.ones(cost.shape[0], np.bool_)
-            col_mask = np.ones(cost.shape[1], np.bool_)
-            row_mask[i] = False
-            col_mask[j] = False
-
-            indices_rows = indices_rows[row_mask]
-            indices_cols = indices_cols[col_mask]
-            cost = cost[row_mask, :][:, col_mask]
-        else:
-            break
 
-    unmatched_row_ids = [row_ids[row] for row in indices_rows]
-    unmatched_col_ids = [col_ids[col] for col in indices_cols]
-    return matches, unmatched_row_ids, unmatched_col_ids
+@nb.njit(fastmath=True, cache=True)
+def _sparse_greedy_match(rows, cols, costs, row_ids, col_ids, max_cost):
+    mask = costs <= max_cost
+    rows, cols, costs = rows[mask], cols[mask], costs[mask]
+    order = np.argsort(rows * len(col_ids) + cols, kind='mergesort')
+    return _sweep_edges(rows[order], cols[order], costs[order], row_ids, col_ids)
 
 
 @nb.njit(fastmath=True, cache=True)
+def _sweep_edges(rows, cols, costs, row_ids, col_ids):
+    row_taken = np.zeros(len(row_ids), np.bool_)
+    col_taken = np.zeros(len(col_ids), np.bool_)
+
+    # stable sort keeps row-major order among equal costs
+    matches = []
+    for k in np.argsort(costs, kind='mergesort'):
+        i, j = rows[k], cols[k]
+        if not row_taken[i] and not col_taken[j]:
+            matches.append((row_ids[i], col_ids[j]))
+            row_taken[i] = True
+            col_taken[j] = True
+            if len(matches) == min(len(row_ids), len(col_ids)):
+                break
+
+    unmatched_row_ids = [row_ids[row] for row in range(len(row_ids)) if not row_taken[row]]
+    unmatched_col_ids = [col_ids[col] for col in range(len(col_ids)) if not col_taken[col]]
+    return matches, unmatched_row_ids, unmatched_col_ids
+
+
+@nb.njit(fastmath=True, nogil=True, cache=True)
 def fuse_motion(cost, m_dist, m_weight):
     """Fuse each row of cost matrix with motion information."""
     norm_factor = 1. / CHI_SQ_INV_95
@@ -106,7 +149,7 @@ def fuse_motion(cost, m_dist, m_weight):
     cost[m_dist > CHI_SQ_INV_95] = INF_COST
 
 
-@nb.njit(parallel=False, fastmath=True, cache=True)
+@nb.njit(parallel=False, fastmath=True, nogil=True, cache=True)
 def gate_cost(cost, row_labels, col_labels, max_cost=None):
     """Gate cost matrix if cost exceeds the maximum."""
     for i in nb.prange(cost.shape[0]):
@@ -114,3 +157,12 @@ def gate_cost(cost, row_labels, col_labels, max_cost=None):
             if (row_labels[i] != col_labels[j] or
                 max_cost is not None and cost[i, j] > max_cost):
                 cost[i, j] = INF_COST
+
+
+@nb.njit(fastmath=True, nogil=True, cache=True)
+def add_row_offsets(cost, offsets):
+    """Add an offset to valid costs in each row of cost matrix."""
+    for i in range(cost.shape[0]):
+        for j in range(cost.shape[1]):
+            if cost[i, j] < INF_COST:
+                cost[i, j] += offsets[i]
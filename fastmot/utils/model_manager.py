@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+import threading
+import logging
+
+from .profiler import Profiler
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModelManager:
+    def __init__(self, max_workers=None):
+        """Loads inference backends in parallel threads.
+        Loading TensorRT engines (or building them on a cache miss) is mostly
+        spent outside the GIL, so independent models load concurrently.
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            Max number of loader threads. Defaults to one thread per model.
+        """
+        self.max_workers = max_workers
+        self.executor = None
+        self.futures = OrderedDict()
+        self.load_times = OrderedDict()
+
+    def __getitem__(self, name):
+        """Waits for a model to finish loading and returns it."""
+        return self.futures[name].result()
+
+    def submit(self, name, factory, *args, **kwargs):
+        """Schedules a model to be loaded in a background thread.
+
+        Parameters
+        ----------
+        name : str
+            Unique component name used for lookup and timing report.
+        factory : callable
+            Function or class that creates the model.
+        *args, **kwargs
+            Arguments passed to `factory`.
+
+        Returns
+        -------
+        Future
+            Future that resolves to the loaded model.
+        """
+        assert name not in self.futures
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='model_loader')
+        future = self.executor.submit(self._load, name, factory, *args, **kwargs)
+        self.futures[name] = future
+        return future
+
+    def when_ready(self):
+        """Returns a future that resolves once all submitted models are loaded.
+
+        Returns
+        -------
+        Future
+            Future that resolves to the loaded models by component name.
+        """
+        ready = Future()
+
+        def wait_all():
+            try:
+                ready.set_result(self.wait())
+            except Exception as err: # propagate any loader error
+                ready.set_exception(err)
+
+        threading.Thread(target=wait_all, daemon=True).start()
+        return ready
+
+    def wait(self):
+        """Waits for all models to be loaded.
+        Exceptions raised by any loader are propagated.
+
+        Returns
+        -------
+        Dict[str, object]
+            Loaded models by component name.
+        """
+        return OrderedDict((name, future.result()) for name, future in self.futures.items())
+
+    def report(self):
+        """Logs cold-start time of each component."""
+        logger.info('=================Cold Start===================')
+        for name, duration in self.load_times.items():
+            logger.info(f"{name + ':':<37}{duration:>6.3f} s")
+
+    def _load(self, name, factory, *args, **kwargs):
+        logger.info('Loading %s...', name)
+        with Profiler('load_' + name) as prof:
+            model = factory(*args, **kwargs)
+        self.load_times[name] = prof.duration
+        return model
@@ -0,0 +1,182 @@
+from enum import Enum
+import numpy as np
+import numba as nb
+
+
+class NMSMethod(Enum):
+    PLAIN = 0
+    DIOU = 1
+    SOFT = 2
+
+
+@nb.njit(fastmath=True, cache=True)
+def batched_nms(tlwhs, scores, split_indices, nms_thresh, method, beta=0.6,
+                sigma=0.5, score_thresh=0.001, max_cells=64):
+    """Applies Non-Maximum Suppression on bounding boxes [x, y, w, h] of all
+    classes in a single pass. Boxes must be sorted by class, with class boundaries
+    given by `split_indices`. Only boxes sharing a grid cell are compared, and
+    suppression is tracked with in-place masks.
+    Plain and DIoU methods keep the same boxes as `nms` and `diou_nms` per class.
+    The soft method decays scores of overlapping boxes with a Gaussian penalty
+    instead, and drops boxes once their scores fall below `score_thresh`.
+
+    Returns
+    -------
+    ndarray, ndarray
+        Indexes of the bounding boxes to keep, ordered by class and descending
+        score, and the scores of all boxes after suppression.
+    """
+    num_boxes = len(tlwhs)
+    scores_out = scores.copy()
+    if num_boxes == 0:
+        return np.empty(0, np.int64), scores_out
+
+    areas = tlwhs[:, 2] * tlwhs[:, 3]
+    tls = tlwhs[:, :2]
+    brs = tlwhs[:, :2] + tlwhs[:, 2:] - 1
+    centers = (tls + brs) / 2
+
+    # class offsets
+    num_classes = len(split_indices) + 1
+    begins = np.empty(num_classes, np.int64)
+    ends = np.empty(num_classes, np.int64)
+    for c in range(num_classes):
+        begins[c] = 0 if c == 0 else split_indices[c - 1]
+        ends[c] = num_boxes if c == num_classes - 1 else split_indices[c]
+
+    # descending score order within each class, matching the per-class NMS
+    order = np.empty(num_boxes, np.int64)
+    for c in range(num_classes):
+        cls_order = scores[begins[c]:ends[c]].argsort()[::-1]
+        order[begins[c]:ends[c]] = cls_order + begins[c]
+
+    # bucket boxes into a uniform grid per class, cell size close to box size
+    origin_x, origin_y = tls[:, 0].min(), tls[:, 1].min()
+    extent_x = brs[:, 0].max() + 1 - origin_x
+    extent_y = brs[:, 1].max() + 1 - origin_y
+    cell_size = max(np.mean(np.maximum(tlwhs[:, 2], tlwhs[:, 3])),
+                    extent_x / max_cells, extent_y / max_cells, 1.)
+    grid_w = int(extent_x / cell_size) + 1
+    grid_h = int(extent_y / cell_size) + 1
+    if nms_thresh < 0 and method != NMSMethod.SOFT:
+        # non-overlapping boxes can be suppressed
+        grid_w, grid_h = 1, 1
+    cell_ranges = np.empty((num_boxes, 4), np.int64)
+    cell_counts = np.zeros(num_classes * grid_w * grid_h + 1, np.int64)
+    for c in range(num_classes):
+        for i in range(begins[c], ends[c]):
+            # boxes within one pixel overlap
+            cell_ranges[i, 0] = min(max(int((tls[i, 0] - origin_x) / cell_size), 0), grid_w - 1)
+            cell_ranges[i, 1] = min(max(int((tls[i, 1] - origin_y) / cell_size), 0), grid_h - 1)
+            cell_ranges[i, 2] = min(max(int((brs[i, 0] + 1 - origin_x) / cell_size), 0),
+                                    grid_w - 1)
+            cell_ranges[i, 3] = min(max(int((brs[i, 1] + 1 - origin_y) / cell_size), 0),
+                                    grid_h - 1)
+            for y in range(cell_ranges[i, 1], cell_ranges[i, 3] + 1):
+                for x in range(cell_ranges[i, 0], cell_ranges[i, 2] + 1):
+                    cell_counts[(c * grid_h + y) * grid_w + x + 1] += 1
+    cell_starts = np.cumsum(cell_counts)
+    cell_boxes = np.empty(cell_starts[-1], np.int64)
+    fill = cell_starts[:-1].copy()
+    for c in range(num_classes):
+        for i in range(begins[c], ends[c]):
+            for y in range(cell_ranges[i, 1], cell_ranges[i, 3] + 1):
+                for x in range(cell_ranges[i, 0], cell_ranges[i, 2] + 1):
+                    cell = (c * grid_h + y) * grid_w + x
+                    cell_boxes[fill[cell]] = i
+                    fill[cell] += 1
+
+    keep = np.empty(num_boxes, np.int64)
+    num_keep = 0
+    done = np.zeros(num_boxes, np.bool_)
+    visited = np.full(num_boxes, -1, np.int64)
+    candidates = np.empty(num_boxes, np.int64)
+    for c in range(num_classes):
+        p = begins[c]
+        while p < ends[c]:
+            if method == NMSMethod.SOFT:
+                # pick the remaining box with the highest decayed score
+                i = -1
+                for k in range(begins[c], ends[c]):
+                    if not done[k] and (i == -1 or scores_out[k] > scores_out[i]):
+                        i = k
+                if i == -1 or scores_out[i] < score_thresh:
+                    break
+            else:
+                i = order[p]
+                p += 1
+                if done[i]:
+                    continue
+            done[i] = True
+            keep[num_keep] = i
+            num_keep += 1
+
+            # gather remaining boxes from the same cells
+            num_candidates = 0
+            for y in range(cell_ranges[i, 1], cell_ranges[i, 3] + 1):
+                for x in range(cell_ranges[i, 0], cell_ranges[i, 2] + 1):
+                    cell = (c * grid_h + y) * grid_w + x
+                    for k in range(cell_starts[cell], cell_starts[cell + 1]):
+                        j = cell_boxes[k]
+                        if not done[j] and visited[j] != i:
+                            visited[j] = i
+                            candidates[num_candidates] = j
+                            num_candidates += 1
+            if num_candidates == 0:
+                continue
+            others = candidates[:num_candidates]
+            if method == NMSMethod.PLAIN:
+                _suppress(_iou(tls, brs, areas, i, others), others, nms_thresh, done)
+            elif method == NMSMethod.DIOU:
+                _suppress(_diou(tls, brs, areas, centers, i, others, beta),
+                          others, nms_thresh, done)
+            else:
+                iou = _iou(tls, brs, areas, i, others)
+                for k in range(num_candidates):
+                    scores_out[others[k]] *= np.exp(-iou[k]**2 / sigma)
+    return keep[:num_keep], scores_out
+
+
+@nb.njit(fastmath=True, cache=True, inline='always')
+def _suppress(overlap, others, nms_thresh, done):
+    for k in range(len(others)):
+        if not overlap[k] <= nms_thresh:
+            done[others[k]] = True
+
+
+@nb.njit(fastmath=True, cache=True, inline='always')
+def _iou(tls, brs, areas, i, others):
+    # same arithmetic as nms and diou_nms for identical results
+    other_tls = tls[others]
+    other_brs = brs[others]
+
+    # compute IoU
+    inter_xmin = np.maximum(tls[i, 0], other_tls[:, 0])
+    inter_ymin = np.maximum(tls[i, 1], other_tls[:, 1])
+    inter_xmax = np.minimum(brs[i, 0], other_brs[:, 0])
+    inter_ymax = np.minimum(brs[i, 1], other_brs[:, 1])
+
+    inter_w = np.maximum(0, inter_xmax - inter_xmin + 1)
+    inter_h = np.maximum(0, inter_ymax - inter_ymin + 1)
+    inter_area = inter_w * inter_h
+    union_area = areas[i] + areas[others] - inter_area
+    return inter_area / union_area
+
+
+@nb.njit(fastmath=True, cache=True, inline='always')
+def _diou(tls, brs, areas, centers, i, others, beta):
+    iou = _iou(tls, brs, areas, i, others)
+
+    # compute DIoU
+    other_tls = tls[others]
+    other_brs = brs[others]
+    encls_xmin = np.minimum(tls[i, 0], other_tls[:, 0])
+    encls_ymin = np.minimum(tls[i, 1], other_tls[:, 1])
+    encls_xmax = np.maximum(brs[i, 0], other_brs[:, 0])
+    encls_ymax = np.maximum(brs[i, 1], other_brs[:, 1])
+
+    encls_w = encls_xmax - encls_xmin + 1
+    encls_h = encls_ymax - encls_ymin + 1
+    c = encls_w**2 + encls_h**2
+    d = np.sum((centers[i] - centers[others])**2, axis=1)
+    return iou - (d / c)**beta
@@ -1,12 +1,18 @@
 from pathlib import Path
 from enum import Enum
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import subprocess
 import threading
 import logging
+import time
+import math
+import numpy as np
 import cv2
 
+from .utils.frame import PixelFormat, to_bgr
+
 logger = logging.getLogger(__name__)
 # set up logging
 LOG_PATH_GSTREAMER_CAPTURE = 'site/gstreamer_capture.log' 
@@ -27,13 +33,137 @@ class Protocol(Enum):
     MQTT  = 7
     WS    = 8
 
+
+class CapturePolicy(Enum):
+    FIFO     = 0 # process buffered frames in order
+    LATEST   = 1 # always process the newest frame
+    BOUNDED  = 2 # drop frames that would be too stale once processed
+    DECIMATE = 3 # only buffer every N-th captured frame
+
+class ImageSequence:
+    def __init__(self, pattern, frame_rate, min_size=None, num_threads=4, prefetch=None):
+        """Image sequence source with the subset of the `cv2.VideoCapture` interface
+        used by `VideoIO`. Files are read and decoded by a thread pool ahead of `read`,
+        and frames are returned in order. Decoding releases the GIL.
+
+        Parameters
+        ----------
+        pattern : str
+            Printf-style path of images, e.g. 'img1/%06d.jpg'.
+            Numbering starts at 0 or 1 and ends at the first missing file.
+        frame_rate : int
+            Frame rate of the sequence.
+        min_size : tuple, optional
+            Min width and height of decoded frames. JPEG images are decoded at
+            1/2, 1/4, or 1/8 scale if the result is not smaller. Defaults to full scale.
+        num_threads : int, optional
+            Number of decoding threads.
+        prefetch : int, optional
+            Max number of images in flight. Defaults to twice `num_threads`.
+        """
+        self.pattern = pattern
+        self.frame_rate = frame_rate
+        assert num_threads >= 1
+        self.num_threads = num_threads
+        self.prefetch = 2 * num_threads if prefetch is None else prefetch
+        assert self.prefetch >= 1
+
+        self.next_idx = 0 if Path(self.pattern % 0).exists() else 1
+        self.flags = cv2.IMREAD_COLOR
+        first = self._load(self.pattern % self.next_idx)
+        if first is None:
+            raise RuntimeError('Unable to read image sequence')
+        height, width = first.shape[:2]
+        if min_size is not None and Path(pattern).suffix.lower() in ('.jpg', '.jpeg'):
+            # libjpeg scales in the DCT domain, so reduced decoding is much cheaper
+            for factor, flags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                  (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if -(-width // factor) >= min_size[0] and -(-height // factor) >= min_size[1]:
+                    self.flags = flags
+                    width, height = -(-width // factor), -(-height // factor)
+                    break
+        self.width, self.height = width, height
+        # the first frame is returned by the first read without decoding it again
+        if self.flags != cv2.IMREAD_COLOR:
+            first = self._load(self.pattern % self.next_idx)
+        self.first_frame = first
+        self.next_idx += 1
+        self.pos = -1
+        self.ended = False
+        self.futures = deque()
+        self.executor = ThreadPoolExecutor(self.num_threads, thread_name_prefix='image_sequence')
+
+    def isOpened(self):
+        return self.executor is not None
+
+    def read(self):
+        """Returns the next frame in order, or (False, None) after the last frame."""
+        if self.executor is None:
+            return False, None
+        while not self.ended and len(self.futures) < self.prefetch:
+            self.futures.append(self.executor.submit(self._load, self.pattern % self.next_idx))
+            self.next_idx += 1
+        if self.first_frame is not None:
+            frame, self.first_frame = self.first_frame, None
+        else:
+            if len(self.futures) == 0:
+                return False, None
+            frame = self.futures.popleft().result()
+            if frame is None:
+                # files after the first missing one are ignored
+                self.ended = True
+                self._cancel()
+                return False, None
+        self.pos += 1
+        return True, frame
+
+    def get(self, prop_id):
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop_id == cv2.CAP_PROP_FPS:
+            return self.frame_rate
+        if prop_id == cv2.CAP_PROP_POS_MSEC:
+            return max(self.pos, 0) * 1000 / self.frame_rate
+        return 0.
+
+    def release(self):
+        if self.executor is not None:
+            self._cancel()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.first_frame = None
+
+    def _cancel(self):
+        for future in self.futures:
+            future.cancel()
+        self.futures.clear()
+
+    def _load(self, path):
+        try:
+            buf = np.fromfile(path, np.uint8)
+        except FileNotFoundError:
+            return None
+        frame = cv2.imdecode(buf, self.flags)
+        if frame is None:
+            logger.warning('Unable to decode %s', path)
+        return frame
+
+
 class VideoIO:
     def __init__(self, size, input_uri,
                  output_uri=None,
                  resolution=(1920, 1080),
                  frame_rate=30,
                  buffer_size=10,
-                 proc_fps=30):
+                 proc_fps=30,
+                 capture_policy='fifo',
+                 max_staleness=100,
+                 decimation=0,
+                 pixel_format='bgr',
+                 image_threads=4,
+                 reduced_decode=False):
         """Class for video capturing and output saving.
         Encoding, decoding, and scaling can be accelerated using the GStreamer backend.
 
@@ -61,6 +191,28 @@ class VideoIO:
         proc_fps : int, optional
             Estimated processing speed that may limit the capture interval `cap_dt`.
             This depends on hardware and processing complexity.
+        capture_policy : {'fifo', 'latest', 'bounded', 'decimate'}, optional
+            Frame dropping policy for live sources, driven by the processing latency
+            reported through `update_latency`. `fifo` reads buffered frames in order,
+            `latest` always reads the newest frame, `bounded` drops frames older than
+            `max_staleness` after processing, and `decimate` only buffers every N-th frame.
+            Files are always read in order.
+        max_staleness : float, optional
+            Max age of a frame in milliseconds once processed, for the `bounded` policy.
+        decimation : int, optional
+            Keep every N-th frame for the `decimate` policy.
+            Set to 0 to derive N from the processing latency.
+        pixel_format : {'bgr', 'i420', 'nv12'}, optional
+            Layout of output frames. YUV formats skip the conversion to BGR in the
+            capture pipeline and require the GStreamer backend to scale frames.
+            Written frames are converted to BGR.
+        image_threads : int, optional
+            Number of threads that read and decode BGR image sequences ahead of `read`.
+            Set to 0 to decode image sequences with GStreamer instead.
+        reduced_decode : bool, optional
+            Decode JPEG image sequences at 1/2, 1/4, or 1/8 scale as long as frames
+            stay at least as large as `size`. `native_frame` is then the reduced
+            frame instead of the source image, so keep it off for region detection.
         """
         self.size = size
         self.input_uri = input_uri
@@ -72,25 +224,47 @@ class VideoIO:
         self.buffer_size = buffer_size
         assert proc_fps > 0
         self.proc_fps = proc_fps
+        assert max_staleness > 0
+        self.max_staleness = max_staleness / 1000
+        assert decimation >= 0
+        self.decimation = decimation
+        self.pixel_format = PixelFormat[pixel_format.upper()]
+        if self.pixel_format != PixelFormat.BGR and not WITH_GSTREAMER:
+            raise ValueError('YUV frames require the GStreamer backend')
+        assert image_threads >= 0
+        self.image_threads = image_threads
+        self.reduced_decode = reduced_decode
 
         self.input_protocol = self._parse_uri(self.input_uri)
         self.output_protocol = self._parse_uri(self.output_uri)
         self.input_is_live = self.input_protocol != Protocol.IMAGE and self.input_protocol != Protocol.VIDEO
         self.output_is_live = self.output_protocol != Protocol.IMAGE and self.output_protocol != Protocol.VIDEO
+        self.capture_policy = CapturePolicy[capture_policy.upper()]
+        if not self.input_is_live:
+            self.capture_policy = CapturePolicy.FIFO
         # TODO: https://blog.csdn.net/weixin_41099962/article/details/103097384
         # TODO: https://forums.developer.nvidia.com/t/opencv-video-writer-to-gstreamer-appsrc/115567/20
         # TODO: https://docs.opencv.org/3.4/d8/dfe/classcv_1_1VideoCapture.html
-        logger.debug("cv2.VideoCapture(str, int)")
-        with open(LOG_PATH_GSTREAMER_CAPTURE, 'a') as f:
-            with contextlib.redirect_stdout(f):
-                with contextlib.redirect_stderr(f):
-                    if WITH_GSTREAMER:            
-                        self.source = cv2.VideoCapture(self._gst_cap_pipeline(), cv2.CAP_GSTREAMER)
-                    else:
-                        self.source = cv2.VideoCapture(self.input_uri)
+        if (self.input_protocol == Protocol.IMAGE and self.image_threads > 0 and
+                self.pixel_format == PixelFormat.BGR):
+            logger.debug("ImageSequence()")
+            min_size = self.size if self.reduced_decode else None
+            self.source = ImageSequence(self.input_uri, self.frame_rate, min_size,
+                                        self.image_threads)
+        else:
+            logger.debug("cv2.VideoCapture(str, int)")
+            with open(LOG_PATH_GSTREAMER_CAPTURE, 'a') as f:
+                with contextlib.redirect_stdout(f):
+                    with contextlib.redirect_stderr(f):
+                        if WITH_GSTREAMER:            
+                            self.source = cv2.VideoCapture(self._gst_cap_pipeline(), cv2.CAP_GSTREAMER)
+                        else:
+                            self.source = cv2.VideoCapture(self.input_uri)
 
         logger.debug("deque()")
         self.frame_queue = deque([], maxlen=self.buffer_size)
+        # last frame read before it was resized, None if no resize happened
+        self.native_frame = None
         self.cond = threading.Condition()
         self.exit_event = threading.Event()
         self.cap_thread = threading.Thread(target=self._capture_frames)
@@ -99,16 +273,28 @@ class VideoIO:
         ret, frame = self.source.read()
         if not ret:
             raise RuntimeError('Unable to read video stream')
-        self.frame_queue.append(frame)
 
         width = self.source.get(cv2.CAP_PROP_FRAME_WIDTH)
         height = self.source.get(cv2.CAP_PROP_FRAME_HEIGHT)
         self.cap_fps = self.source.get(cv2.CAP_PROP_FPS)
         self.do_resize = (width, height) != self.size
+        if self.do_resize and self.pixel_format != PixelFormat.BGR:
+            raise RuntimeError('Unable to capture YUV frames at %dx%d' % self.size)
         if self.cap_fps == 0:
             self.cap_fps = self.frame_rate # fallback to config if unknown
         logger.info('%dx%d stream @ %d FPS', width, height, self.cap_fps)
 
+        # latency feedback and counters
+        self.proc_latency = None
+        self.num_dropped = 0
+        self.num_processed = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.num_skipped = 0
+
+        self.num_captured = 0
+        self.frame_queue.append((frame, self._capture_timestamp()))
+
         if self.output_uri is not None:
             #TODO: How to determine as file path?
             if (self.output_protocol == Protocol.VIDEO):
@@ -128,8 +314,50 @@ class VideoIO:
 
     @property
     def cap_dt(self):
+        if not self.input_is_live:
+            return 1 / self.cap_fps
         # limit capture interval at processing latency for live sources
-        return 1 / min(self.cap_fps, self.proc_fps) if self.input_is_live else 1 / self.cap_fps
+        if self.capture_policy == CapturePolicy.DECIMATE:
+            cap_dt = self._decimation_factor() / self.cap_fps
+        else:
+            cap_dt = 1 / self.cap_fps
+        if self.proc_latency is None:
+            return max(cap_dt, 1 / self.proc_fps)
+        return max(cap_dt, self.proc_latency)
+
+    def update_latency(self, proc_latency, timestamp=None, alpha=0.1):
+        """Reports processing latency of the last frame read to drive frame dropping.
+
+        Parameters
+        ----------
+        proc_latency : float
+            Processing time of the frame in seconds, e.g. duration of `MOT.step`.
+        timestamp : float, optional
+            Capture timestamp returned by `read` to measure glass-to-result latency.
+        alpha : float, optional
+            Smoothing factor of the latency moving average.
+        """
+        if self.proc_latency is None:
+            self.proc_latency = proc_latency
+        else:
+            self.proc_latency += alpha * (proc_latency - self.proc_latency)
+        self.num_processed += 1
+        if self.input_is_live and timestamp is not None:
+            latency = time.perf_counter() - timestamp
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def print_capture_info(self):
+        """Logs frame dropping counters and glass-to-result latency."""
+        if not self.input_is_live:
+            return
+        avg_latency = self.total_latency / max(self.num_processed, 1)
+        logger.info('=================Capture Stats================')
+        logger.info(f"{'capture policy:':<37}{self.capture_policy.name.lower():>6}")
+        logger.info(f"{'processed frames:':<37}{self.num_processed:>6d}")
+        logger.info(f"{'dropped frames:':<37}{self.num_dropped + self.num_skipped:>6d}")
+        logger.info(f"{'avg glass-to-result latency:':<37}{avg_latency * 1000:>6.3f} ms")
+        logger.info(f"{'max glass-to-result latency:':<37}{self.max_latency * 1000:>6.3f} ms")
 
     def start_capture(self):
         logger.debug("start_capture()")
@@ -148,32 +376,42 @@ class VideoIO:
         self.frame_queue.clear()
         self.cap_thread.join()
 
-    def read(self):
+    def read(self, return_timestamp=False):
         logger.debug("read()")
         """Reads the next video frame.
 
+        Parameters
+        ----------
+        return_timestamp : bool, optional
+            Also return the capture timestamp of the frame in seconds.
+            Timestamps come from the stream position for files and from
+            the capture clock for live sources.
+
         Returns
         -------
-        ndarray
-            Returns None if there are no more frames.
+        ndarray or (ndarray, float)
+            Returns None (or None, None) if there are no more frames.
         """
         with self.cond:            
             while len(self.frame_queue) == 0 and not self.exit_event.is_set():
                 self.cond.wait()
             if len(self.frame_queue) == 0 and self.exit_event.is_set():
-                return None           
-            frame = self.frame_queue.popleft()
+                return (None, None) if return_timestamp else None
+            self._drop_stale_frames()
+            frame, timestamp = self.frame_queue.popleft()
             self.cond.notify()
+        self.native_frame = None
         if self.do_resize:
             logger.debug("cv2.resize: %s", self.size)            
+            self.native_frame = frame
             frame = cv2.resize(frame, self.size)
-        return frame
+        return (frame, timestamp) if return_timestamp else frame
 
     def write(self, frame):
         logger.debug("write()")
         """Writes the next video frame."""
         assert hasattr(self, 'writer')
-        self.writer.write(frame)
+        self.writer.write(to_bgr(frame, self.pixel_format))
 
     def release(self):
         logger.debug("release()")
@@ -187,19 +425,20 @@ class VideoIO:
         gst_elements = str(subprocess.check_output('gst-inspect-1.0'))
         if 'nvvidconv' in gst_elements and self.input_protocol != Protocol.V4L2:
             # format conversion for hardware decoder
-            # Note: detector accepts BGR only.
+            # Note: models accept BGR, I420, and NV12 frames.
             cvt_pipeline = (
                 'nvvidconv interpolation-method=5 ! videoconvert ! videorate ! '
-                'video/x-raw, width=%d, height=%d, framerate=%d/1, format=BGR ! ' #I420 / BGRx #Limited to 3 FPS for AI
+                'video/x-raw, width=%d, height=%d, framerate=%d/1, format=%s ! ' #I420 / BGRx #Limited to 3 FPS for AI
                 'appsink sync=false' # sync=false
-                % (*self.size, self.frame_rate)
+                % (*self.size, self.frame_rate, self.pixel_format.name)
             )
         else:
+            # videoconvert passes decoder output through if it is already in the format
             cvt_pipeline = (
                 'videoscale ! '
                 'video/x-raw, width=%d, height=%d ! '
-                'videoconvert ! appsink sync=false'
-                % self.size
+                'videoconvert ! video/x-raw, format=%s ! appsink sync=false'
+                % (*self.size, self.pixel_format.name)
             )
 
         if self.input_protocol == Protocol.IMAGE:
@@ -316,6 +555,7 @@ class VideoIO:
         logger.debug("_capture_frames()")
         while not self.exit_event.is_set():
             ret, frame = self.source.read()
+            timestamp = self._capture_timestamp()
             with self.cond:
                 if not ret:
                     self.exit_event.set()
@@ -326,9 +566,51 @@ class VideoIO:
                     while (len(self.frame_queue) == self.buffer_size and
                            not self.exit_event.is_set()):
                         self.cond.wait()
-                self.frame_queue.append(frame)
+                elif self.capture_policy == CapturePolicy.DECIMATE:
+                    self.num_captured += 1
+                    if (self.num_captured - 1) % self._decimation_factor() != 0:
+                        self.num_skipped += 1
+                        continue
+                if len(self.frame_queue) == self.buffer_size:
+                    self.num_dropped += 1 # the oldest frame is discarded
+                self.frame_queue.append((frame, timestamp))
                 self.cond.notify()
 
+    def _drop_stale_frames(self):
+        if self.capture_policy == CapturePolicy.LATEST:
+            num_stale = len(self.frame_queue) - 1
+        elif self.capture_policy == CapturePolicy.BOUNDED:
+            # drop a frame if it would exceed max staleness once processed
+            expiry = time.perf_counter() + (self.proc_latency or 0.) - self.max_staleness
+            num_stale = 0
+            for _, timestamp in self.frame_queue:
+                if num_stale == len(self.frame_queue) - 1 or timestamp >= expiry:
+                    break
+                num_stale += 1
+        else:
+            return
+        for _ in range(num_stale):
+            self.frame_queue.popleft()
+        self.num_dropped += num_stale
+
+    def _decimation_factor(self):
+        if self.decimation > 0:
+            return self.decimation
+        if self.proc_latency is None:
+            return max(1, math.ceil(self.cap_fps / self.proc_fps))
+        return max(1, math.ceil(self.proc_latency * self.cap_fps))
+
+    def _capture_timestamp(self):
+        # live sources drop frames, so use the capture clock
+        if self.input_is_live:
+            return time.perf_counter()
+        self.num_captured += 1
+        pos_msec = self.source.get(cv2.CAP_PROP_POS_MSEC)
+        if pos_msec > 0:
+            return pos_msec / 1000
+        # fallback to frame index if the stream position is unknown
+        return (self.num_captured - 1) / self.cap_fps
+
     @staticmethod
     def _parse_uri(uri):
         result = urlparse(uri)
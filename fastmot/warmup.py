@@ -0,0 +1,251 @@
+"""Precompiles Numba kernels so that the first frames do not stall on JIT compilation.
+
+Kernels are cached on disk (`cache=True`), so this only needs to run once after
+installation or an upgrade:
+
+    python3 -m fastmot.warmup
+
+Deployment images can ship the compiled kernels by setting NUMBA_CACHE_DIR to a
+directory inside the image when building it. `--check` then verifies that every
+kernel is loaded from the cache without compilation at startup:
+
+    NUMBA_CACHE_DIR=/opt/fastmot/numba python3 -m fastmot.warmup
+    NUMBA_CACHE_DIR=/opt/fastmot/numba python3 -m fastmot.warmup --check
+"""
+import argparse
+import inspect
+import logging
+import sys
+import numpy as np
+
+from .detector import DET_DTYPE, SSDDetector, YOLODetector
+from .feature_extractor import FeatureExtractor
+from .flow import Flow
+from .kalman_filter import MeasType, KalmanFilter
+from .track import AverageFeature
+from .utils import Profiler
+from .utils.distance import Metric, cdist, iou_dist
+from .utils.matching import linear_assignment, greedy_match, fuse_motion, gate_cost
+from .utils.matching import add_row_offsets, sparse_greedy_match
+from .utils.nms import NMSMethod
+from .utils.numba import find_split_indices, mask_area
+from .utils.rect import as_tlbr, to_tlbr, intersection, crop, multi_crop, ios, find_occluded
+
+
+logger = logging.getLogger(__name__)
+
+
+def compile_kernels(num_dets=8, feature_dim=512):
+    """Compiles Numba kernels with the argument types used at runtime.
+    No GPU is required.
+
+    Parameters
+    ----------
+    num_dets : int, optional
+        Number of synthetic detections.
+    feature_dim : int, optional
+        Dimension of synthetic embeddings.
+    """
+    with Profiler('compile') as prof:
+        _compile_tracker_kernels(num_dets, feature_dim)
+        _compile_flow_kernels()
+        _compile_detector_kernels(num_dets)
+    logger.info('Compiled Numba kernels in %.3f s', prof.duration)
+
+
+def find_kernels():
+    """Returns all Numba dispatchers defined in fastmot modules by qualified name."""
+    kernels = {}
+    for mod_name, module in list(sys.modules.items()):
+        if not mod_name.startswith(__package__) or module is None:
+            continue
+        for name, obj in vars(module).items():
+            attrs = vars(obj).items() if inspect.isclass(obj) else [(None, obj)]
+            for attr_name, attr in attrs:
+                if isinstance(attr, staticmethod):
+                    attr = attr.__func__
+                # Numba dispatchers keep the original function and cache stats
+                if hasattr(attr, 'py_func') and hasattr(attr, 'stats'):
+                    qualname = attr.py_func.__module__ + '.' + attr.py_func.__qualname__
+                    kernels[qualname] = attr
+    return kernels
+
+
+def cache_misses():
+    """Returns names of kernels that were compiled instead of loaded from the cache."""
+    return sorted(name for name, kernel in find_kernels().items()
+                  if sum(kernel.stats.cache_misses.values()) > 0)
+
+
+def synthetic_detections(num_dets, size=(640, 480), label=1, seed=0):
+    """Creates a record array of random detections (DET_DTYPE)."""
+    rng = np.random.RandomState(seed)
+    detections = np.zeros(num_dets, DET_DTYPE).view(np.recarray)
+    for det in detections:
+        x, y = rng.randint(0, size[0] - 64), rng.randint(0, size[1] - 128)
+        det.tlbr[:] = to_tlbr((x, y, rng.randint(16, 64), rng.randint(32, 128)))
+    detections.label = label
+    detections.conf = rng.uniform(0.5, 1., num_dets)
+    return detections
+
+
+def _compile_tracker_kernels(num_dets, feature_dim):
+    kf = KalmanFilter()
+    detections = synthetic_detections(num_dets)
+    embeddings = np.random.rand(num_dets, feature_dim).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    frame_rect = to_tlbr((0, 0, 640, 480))
+    det_ids = list(range(num_dets))
+
+    occluded_mask = find_occluded(detections.tlbr, 0.7)
+    u_detections, u_embeddings = detections[det_ids], embeddings[det_ids]
+
+    # Kalman filter
+    det = detections[0]
+    mean, cov = kf.create(det.tlbr)
+    mean, cov = kf.warp(mean, cov, np.eye(3))
+    mean, cov = kf.predict(mean, cov)
+    mean, cov = kf.update(mean, cov, det.tlbr, MeasType.DETECTOR)
+    mean, cov = kf.update(mean, cov, to_tlbr((10, 10, 32, 64)), MeasType.FLOW, 1.5)
+    m_dist = kf.motion_distance(mean, cov, u_detections.tlbr)
+    next_tlbr = as_tlbr(mean[:4])
+    ios(next_tlbr, frame_rect)
+
+    # matching cost
+    features = np.empty((num_dets, feature_dim))
+    features[:] = embeddings
+    empty_mask = np.zeros(num_dets, np.bool_)[:, None] | occluded_mask[det_ids]
+    for metric in Metric:
+        cost = cdist(features, u_embeddings, metric, empty_mask, 0.9)
+        cdist(embeddings, u_embeddings, metric)
+    fuse_motion(cost[0], m_dist, 0.2)
+    t_labels = np.fromiter(detections.label, int, num_dets)
+    gate_cost(cost, t_labels, u_detections.label, 0.8)
+    gate_cost(cost, t_labels, u_detections.label)
+    add_row_offsets(cost, np.arange(num_dets) * 1.)
+    linear_assignment(cost, det_ids, det_ids)
+
+    # IoU cost and rectification
+    iou_cost = iou_dist(np.array(list(detections.tlbr)), u_detections.tlbr)
+    iou_dist(np.array(list(detections.tlbr)), detections[tuple(det_ids),].tlbr)
+    greedy_match(iou_cost, det_ids, det_ids, 0.2)
+    rows, cols = np.nonzero(iou_cost < 1.)
+    sparse_greedy_match(rows, cols, iou_cost[rows, cols], det_ids, det_ids, 0.2)
+
+    # track features
+    avg_feat = AverageFeature()
+    for embedding in embeddings[:3]:
+        avg_feat.update(embedding)
+
+
+def _compile_flow_kernels(size=(640, 480), scale_factor=(0.5, 0.5)):
+    rng = np.random.RandomState(0)
+    fg_mask = np.full(size[::-1], 255, np.uint8)
+    frame_rect = to_tlbr((0, 0, *size))
+    tlbr = to_tlbr((100, 100, 64, 128))
+
+    inside_tlbr = intersection(tlbr, frame_rect)
+    target_mask = crop(fg_mask, inside_tlbr)
+    target_area = mask_area(target_mask)
+    Flow._estimate_feature_dist(target_area, 0.06)
+
+    keypoints = rng.uniform(100, 160, (32, 1, 2)).astype(np.float32)
+    keypoints = Flow._ellipse_filter(keypoints, tlbr, inside_tlbr[:2])
+    keypoints = Flow._rect_filter(keypoints, inside_tlbr, fg_mask)
+    Flow._rect_filter(np.empty((0, 2), np.float32), inside_tlbr, fg_mask)
+
+    prev_pts = Flow._unscale_pts(rng.uniform(0, 64, (32, 2)).astype(np.float32), (0.1, 0.1))
+    scaled_pts = Flow._scale_pts(prev_pts, scale_factor)
+    Flow._scale_pts(Flow._predict_pts(prev_pts, np.eye(3)), scale_factor)
+    status = np.ones((len(scaled_pts), 1), np.uint8)
+    err = np.zeros((len(scaled_pts), 1), np.float32)
+    status = Flow._get_status(status, err, 100)
+    cur_pts = Flow._unscale_pts(scaled_pts.copy(), scale_factor, status)
+
+    prev_pts, cur_pts = Flow._get_good_match(prev_pts, cur_pts, status, 0, -1)
+    prev_pts, cur_pts = Flow._fg_filter(prev_pts, cur_pts, fg_mask, size)
+    inlier_mask = np.ones((len(cur_pts), 1), np.uint8)
+    Flow._get_inliers(prev_pts, cur_pts, inlier_mask)
+    Flow._get_reproj_inliers(prev_pts, cur_pts, np.eye(3), 3.)
+    Flow._estimate_translation(prev_pts, cur_pts, 3.)
+    Flow._model_errors(np.eye(3), size)
+    cell_size = np.array(size, np.float32) / (16, 9)
+    Flow._bucket_pts(cur_pts, cell_size, np.zeros((9, 16), np.int32), 2)
+    affine_mat = Flow._translation_mat(tlbr, np.eye(3), np.zeros(2))
+    inlier_mask = Flow._get_affine_inliers(prev_pts, cur_pts, affine_mat, 3.)
+    affine_mat = Flow._fit_partial_affine(prev_pts, cur_pts, inlier_mask)
+    est_tlbr = Flow._estimate_bbox(tlbr, affine_mat)
+    crop(fg_mask, est_tlbr)
+
+
+def _compile_detector_kernels(num_dets, size=(640, 480)):
+    detections = synthetic_detections(num_dets, size)
+    frame = np.zeros((*size[::-1], 3), np.uint8)
+    find_split_indices(detections.label)
+
+    # YOLO postprocessing
+    label_mask = np.zeros(2, np.bool_)
+    label_mask[1] = True
+    det_out = np.zeros((num_dets, 7), np.float32)
+    det_out[:, :2] = np.random.rand(num_dets, 2) * 0.8
+    det_out[:, 2:4] = 0.1
+    det_out[:, 4:7] = (0.9, 1, 0.9)
+    out = np.empty(num_dets, DET_DTYPE).view(np.recarray)
+    class_counts = np.empty(len(label_mask) + 1, np.int64)
+    split_indices = np.empty(len(label_mask), np.int64)
+    candidates = np.empty_like(det_out)
+    for nms_method in NMSMethod:
+        YOLODetector._filter_dets(det_out, np.array(size), np.zeros(2), label_mask,
+                                  0.25, 0.5, nms_method, 800000, 1.2, class_counts,
+                                  split_indices, candidates, out)
+    crops = YOLODetector._select_regions(detections.tlbr * 2, np.array(size) * 2,
+                                         np.array((416, 416)), 2., 4)
+    region_det_out = np.tile(det_out, (len(crops), 1, 1))
+    YOLODetector._map_region_dets(region_det_out, crops, np.array(size) * 2, np.full(2, 2.))
+
+    # SSD preprocessing and postprocessing
+    label_mask = np.zeros(91, np.bool_)
+    label_mask[1] = True
+    topk = 4
+    tiles = np.array([to_tlbr((c * 150, 0, 300, 300)) for c in range(2)])
+    inp = np.empty((len(tiles), 3, 300, 300), np.float32)
+    SSDDetector._normalize(np.zeros((300, 450, 3), np.uint8), tiles, inp)
+    det_out = np.zeros(len(tiles) * topk * 7, np.float32)
+    out = np.empty(max(len(tiles) * topk, num_dets), DET_DTYPE).view(np.recarray)
+    out_tile_ids = np.empty(len(out), np.int64)
+    SSDDetector._filter_dets(det_out, tiles, np.arange(len(tiles)), topk, label_mask,
+                             120000, 0.5, (1., 1.), out, out_tile_ids)
+    max_pairs = num_dets * (num_dets - 1) // 2
+    SSDDetector._merge(detections, np.arange(num_dets) % len(tiles), tiles + (0, 0, 1, 1),
+                       0.6, np.empty((num_dets, 4)), np.empty((4, num_dets + 1), np.int64),
+                       np.empty((4, num_dets), np.bool_), np.empty(len(tiles)),
+                       np.empty((max_pairs, 2), np.int64), np.empty(2 * max_pairs, np.int64),
+                       np.empty(2 * max_pairs, np.bool_), out)
+    SSDDetector._active_tile_mask(tiles + (0, 0, 1, 1), np.array(list(detections.tlbr)),
+                                  np.zeros((4, 2), np.float32), 0.5)
+
+    # feature extractor preprocessing
+    cls_bboxes = np.split(detections.tlbr, find_split_indices(detections.label))
+    multi_crop(frame, cls_bboxes[0])
+    FeatureExtractor._normalize(np.zeros((256, 128, 3), np.uint8),
+                                np.empty((1, 3, 256, 128), np.float32)[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompile Numba kernels')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if any kernel is not already cached')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    compile_kernels()
+    misses = cache_misses()
+    for name in misses:
+        logger.info('Compiled %s', name)
+    if args.check and len(misses) > 0:
+        logger.error('%d kernels were not cached', len(misses))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for postprocessing kernels on synthetic data.
+
+Usage:
+    python3 scripts/benchmark.py merge --counts 50 200 800
+    python3 scripts/benchmark.py nms --counts 1000 4000
+    python3 scripts/benchmark.py greedy --counts 10 50 200
+    python3 scripts/benchmark.py pyramid --scale-factors 0.25 0.5 1
+    python3 scripts/benchmark.py initflow --shift 12 4
+    python3 scripts/benchmark.py tiles --camera-motions static auto
+"""
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from fastmot import models
+from fastmot.detector import DET_DTYPE, SSDDetector
+from fastmot.flow import Flow
+from fastmot.utils.matching import greedy_match
+from fastmot.utils.nms import NMSMethod, batched_nms
+from fastmot.utils.numba import find_split_indices
+from fastmot.utils.rect import nms, diou_nms
+
+
+def time_millis(func, *args, repeat=50, setup=None):
+    """Returns the average time of `func` in milliseconds, excluding the first call."""
+    setup = setup or (lambda *args: args)
+    func(*setup(*args))
+    elapsed = 0.
+    for _ in range(repeat):
+        call_args = setup(*args)
+        start = time.perf_counter()
+        func(*call_args)
+        elapsed += time.perf_counter() - start
+    return elapsed * 1000 / repeat
+
+
+def tiled_detections(num_dets, tiles, scale_factor, num_objects=None, seed=0):
+    """Generates raw detections of objects seen by overlapping tiles."""
+    rng = np.random.RandomState(seed)
+    num_objects = num_objects or max(num_dets // 3, 1)
+    extents = (tiles + (0, 0, 1, 1)) * np.tile(scale_factor, 2)
+    centers = rng.uniform(extents[:, :2].min(0), extents[:, 2:].max(0), (num_objects, 2))
+    tile_ids = rng.randint(0, len(tiles), num_dets)
+    detections = np.zeros(num_dets, DET_DTYPE).view(np.recarray)
+    for det, tile_id in zip(detections, tile_ids):
+        center = centers[rng.randint(num_objects)]
+        half_size = rng.uniform(5, 40, 2)
+        tl = np.clip(center - half_size, extents[tile_id, :2], extents[tile_id, 2:])
+        br = np.clip(center + half_size, extents[tile_id, :2], extents[tile_id, 2:])
+        det.tlbr[:] = np.rint(np.r_[tl, br])
+    detections.label = 1
+    detections.conf = rng.uniform(0.5, 1., num_dets)
+    return detections, tile_ids
+
+
+def merge_scratch(num_dets, num_tiles):
+    """Returns scratch buffers of `SSDDetector._merge` large enough for any overlap."""
+    max_pairs = num_dets * (num_dets - 1) // 2
+    return (np.empty((num_dets, 4)), np.empty((4, num_dets + 1), np.int64),
+            np.empty((4, num_dets), np.bool_), np.empty(num_tiles),
+            np.empty((max_pairs, 2), np.int64), np.empty(2 * max_pairs, np.int64),
+            np.empty(2 * max_pairs, np.bool_))
+
+
+def bench_merge(args):
+    model = models.SSD.get_model(args.model)
+    tiler = SimpleNamespace(model=model, tiling_grid=tuple(args.tiling_grid), tile_overlap=0.25)
+    tiles, tiling_region_sz = SSDDetector._generate_tiles(tiler)
+    scale_factor = tuple(np.array(args.size) / tiling_region_sz)
+    tile_extents = (tiles + (0, 0, 1, 1)) * np.tile(scale_factor, 2)
+
+    print(f"{'raw detections':>15}{'merged':>10}{'time (ms)':>12}")
+    for num_dets in args.counts:
+        detections, tile_ids = tiled_detections(num_dets, tiles, scale_factor)
+        out = np.empty(num_dets, DET_DTYPE).view(np.recarray)
+        scratch = merge_scratch(num_dets, len(tiles))
+        num_merged, _ = SSDDetector._merge(detections.copy(), tile_ids.copy(), tile_extents,
+                                           0.6, *scratch, out)
+        millis = time_millis(SSDDetector._merge, detections, tile_ids, tile_extents, 0.6,
+                             *scratch, out, repeat=args.repeat,
+                             setup=lambda dets, ids, *rest: (dets.copy(), ids.copy(), *rest))
+        print(f'{num_dets:>15}{num_merged:>10}{millis:>12.3f}')
+
+
+def yolo_candidates(num_boxes, size, num_classes=1, seed=0):
+    """Generates crowded candidate boxes [x, y, w, h] sorted by class."""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, 1, (max(num_boxes // 10, 1), 2)) * size
+    tlwhs = np.empty((num_boxes, 4), np.float32)
+    tlwhs[:, 2] = rng.uniform(0.01, 0.05, num_boxes) * size[0]
+    tlwhs[:, 3] = tlwhs[:, 2] * rng.uniform(1.2, 3., num_boxes)
+    tlwhs[:, :2] = centers[rng.randint(len(centers), size=num_boxes)] - tlwhs[:, 2:] / 2
+    tlwhs[:, :2] += rng.normal(0, 0.01, (num_boxes, 2)) * size
+    scores = rng.uniform(0.25, 1., num_boxes).astype(np.float32)
+    labels = np.sort(rng.randint(0, num_classes, num_boxes))
+    return tlwhs, scores, labels
+
+
+def per_class_nms(tlwhs, scores, split_indices, nms_thresh, method):
+    """Reference NMS that runs `nms` or `diou_nms` on each class separately."""
+    nms_func = diou_nms if method == NMSMethod.DIOU else nms
+    bounds = [0, *split_indices, len(tlwhs)]
+    keep = [np.arange(begin, end)[nms_func(tlwhs[begin:end], scores[begin:end], nms_thresh)]
+            for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+    return np.concatenate(keep)
+
+
+def bench_nms(args):
+    size = np.array(args.size)
+    print(f"{'candidates':>15}{'method':>8}{'kept':>8}{'per-class (ms)':>16}"
+          f"{'batched (ms)':>14}{'identical':>11}")
+    for num_boxes in args.counts:
+        tlwhs, scores, labels = yolo_candidates(num_boxes, size, args.num_classes)
+        split_indices = find_split_indices(labels)
+        for method in (NMSMethod.PLAIN, NMSMethod.DIOU):
+            keep, _ = batched_nms(tlwhs, scores, split_indices, args.nms_thresh, method)
+            ref_keep = per_class_nms(tlwhs, scores, split_indices, args.nms_thresh, method)
+            ref_millis = time_millis(per_class_nms, tlwhs, scores, split_indices,
+                                     args.nms_thresh, method, repeat=args.repeat)
+            millis = time_millis(batched_nms, tlwhs, scores, split_indices,
+                                 args.nms_thresh, method, repeat=args.repeat)
+            identical = np.array_equal(keep, ref_keep)
+            print(f'{num_boxes:>15}{method.name.lower():>8}{len(keep):>8}{ref_millis:>16.3f}'
+                  f'{millis:>14.3f}{str(identical):>11}')
+
+
+def argmin_greedy_match(cost, row_ids, col_ids, max_cost):
+    """Reference greedy matching that takes the argmin of the remaining matrix."""
+    rows, cols = list(range(cost.shape[0])), list(range(cost.shape[1]))
+    matches = []
+    while len(rows) > 0 and len(cols) > 0:
+        sub_cost = cost[np.ix_(rows, cols)]
+        i, j = np.unravel_index(np.argmin(sub_cost), sub_cost.shape)
+        if sub_cost[i, j] > max_cost:
+            break
+        matches.append((row_ids[rows.pop(i)], col_ids[cols.pop(j)]))
+    return matches, [row_ids[row] for row in rows], [col_ids[col] for col in cols]
+
+
+def bench_greedy(args):
+    rng = np.random.RandomState(0)
+    print(f"{'size':>15}{'matches':>9}{'argmin (ms)':>13}{'sorted (ms)':>13}{'identical':>11}")
+    for size in args.counts:
+        # quantized costs create ties, gated entries are never matched
+        cost = np.round(rng.uniform(0, 1, (size, size)), 2)
+        cost[rng.uniform(0, 1, (size, size)) < args.sparsity] = 1e5
+        ids = list(range(size))
+        result = greedy_match(cost, ids, ids, args.max_cost)
+        ref_result = argmin_greedy_match(cost, ids, ids, args.max_cost)
+        ref_millis = time_millis(argmin_greedy_match, cost, ids, ids, args.max_cost,
+                                 repeat=args.repeat)
+        millis = time_millis(greedy_match, cost, ids, ids, args.max_cost, repeat=args.repeat)
+        identical = all(list(a) == list(b) for a, b in zip(result, ref_result))
+        print(f'{size:>15}{len(result[0]):>9}{ref_millis:>13.3f}{millis:>13.3f}'
+              f'{str(identical):>11}')
+
+
+def lk_pyramid_input_supported(frame, pts, opt_flow_params):
+    """Returns whether cv2.calcOpticalFlowPyrLK accepts prebuilt pyramids."""
+    _, pyramid = cv2.buildOpticalFlowPyramid(frame, opt_flow_params['winSize'],
+                                             opt_flow_params['maxLevel'])
+    try:
+        cv2.calcOpticalFlowPyrLK(pyramid, pyramid, pts, None, **opt_flow_params)
+    except cv2.error:
+        return False
+    return True
+
+
+def bench_pyramid(args):
+    rng = np.random.RandomState(0)
+    size = np.array(args.size)
+    # textured frame panned by a few pixels
+    frame = cv2.GaussianBlur(rng.randint(0, 256, size[::-1], np.uint8), (5, 5), 0)
+    next_frame = np.roll(frame, (1, 3), axis=(0, 1))
+    opt_flow_params = {'winSize': (5, 5), 'maxLevel': 5, 'criteria': (3, 10, 0.03)}
+
+    print(f"{'scale factor':>15}{'flow size':>12}{'LK (ms)':>10}{'next pyramid (ms)':>19}"
+          f"{'share':>8}")
+    for scale_factor in args.scale_factors:
+        opt_flow_sz = tuple(int(round(length * scale_factor)) for length in size)
+        prev_small = cv2.resize(frame, opt_flow_sz)
+        next_small = cv2.resize(next_frame, opt_flow_sz)
+        pts = rng.uniform(0, 1, (args.num_points, 1, 2)).astype(np.float32)
+        pts *= np.array(opt_flow_sz, np.float32) - 1
+        lk_millis = time_millis(lambda: cv2.calcOpticalFlowPyrLK(prev_small, next_small, pts,
+                                                                 None, **opt_flow_params),
+                                repeat=args.repeat)
+        # pyramid of the next frame is rebuilt as the previous pyramid in the next call
+        pyr_millis = time_millis(lambda: cv2.buildOpticalFlowPyramid(
+            next_small, opt_flow_params['winSize'], opt_flow_params['maxLevel'],
+            withDerivatives=False), repeat=args.repeat)
+        flow_size = '%dx%d' % opt_flow_sz
+        print(f'{scale_factor:>15g}{flow_size:>12}{lk_millis:>10.3f}{pyr_millis:>19.3f}'
+              f'{pyr_millis / lk_millis:>8.1%}')
+    if not lk_pyramid_input_supported(frame, pts, opt_flow_params):
+        print('cv2.calcOpticalFlowPyrLK does not accept prebuilt pyramids in this build, '
+              'so pyramids cannot be reused from Python')
+
+
+def bench_initflow(args):
+    rng = np.random.RandomState(0)
+    size = np.array(args.size)
+    frame = cv2.GaussianBlur(rng.randint(0, 256, size[::-1], np.uint8), (5, 5), 0)
+    shift = np.array(args.shift, np.float32)
+    next_frame = cv2.warpAffine(frame, np.float32([[1, 0, shift[0]], [0, 1, shift[1]]]),
+                                tuple(size))
+    margin = np.abs(shift).max() + 10
+    pts = rng.uniform(margin, size - margin, (args.num_points, 1, 2)).astype(np.float32)
+    # predictions are off by motion model noise
+    init_pts = pts + shift + rng.normal(0, args.noise, pts.shape).astype(np.float32)
+
+    print(f"{'max level':>15}{'search':>10}{'time (ms)':>11}{'error (px)':>12}{'tracked':>9}")
+    for max_level in range(args.max_level + 1):
+        for search in ('previous', 'predicted'):
+            params = {'winSize': (5, 5), 'maxLevel': max_level,
+                      'criteria': (3, args.max_iter, 0.03)}
+            if search == 'predicted':
+                params['flags'] = cv2.OPTFLOW_USE_INITIAL_FLOW
+
+            def calc_flow():
+                next_pts = init_pts.copy() if search == 'predicted' else None
+                return cv2.calcOpticalFlowPyrLK(frame, next_frame, pts, next_pts, **params)
+            millis = time_millis(calc_flow, repeat=args.repeat)
+            next_pts, status, _ = calc_flow()
+            tracked = status.ravel() == 1
+            error = np.linalg.norm(next_pts - pts - shift, axis=-1).ravel()[tracked]
+            error = np.median(error) if len(error) > 0 else np.nan
+            print(f'{max_level:>15}{search:>10}{millis:>11.3f}{error:>12.3f}'
+                  f'{tracked.mean():>9.1%}')
+
+
+def moving_block_frames(size, num_frames, block_size=80, step=8, seed=0):
+    """Generates BGR frames of a block moving across a fixed textured background."""
+    rng = np.random.RandomState(seed)
+    background = cv2.GaussianBlur(rng.randint(0, 256, size[::-1], np.uint8), (5, 5), 0)
+    block = rng.randint(0, 256, (block_size, block_size), np.uint8)
+    y = (size[1] - block_size) // 2
+    for i in range(num_frames):
+        frame = background.copy()
+        x = 20 + i * step
+        frame[y:y + block_size, x:x + block_size] = block
+        yield cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def bench_tiles(args):
+    model = models.SSD.get_model(args.model)
+    tiler = SimpleNamespace(model=model, tiling_grid=tuple(args.tiling_grid), tile_overlap=0.25)
+    tiles, tiling_region_sz = SSDDetector._generate_tiles(tiler)
+    scale_factor = tuple(np.array(args.size) / tiling_region_sz)
+
+    print(f"{'camera motion':>15}{'skipped tiles':>15}{'predict (ms)':>14}")
+    idle_modes = []
+    for camera_motion in args.camera_motions:
+        tiler = SimpleNamespace(batch_size=len(tiles),
+                                tile_extents=(tiles + (0, 0, 1, 1)) * np.tile(scale_factor, 2),
+                                tile_refresh_interval=args.refresh_interval,
+                                num_selections=0, num_tiles_skipped=0,
+                                _active_tile_mask=SSDDetector._active_tile_mask)
+        flow = Flow(tuple(args.size), camera_motion=camera_motion,
+                    opt_flow_params=SimpleNamespace())
+        frames = moving_block_frames(tuple(args.size), args.num_frames + 1)
+        flow.init(next(frames))
+        elapsed = 0.
+        for frame in frames:
+            start = time.perf_counter()
+            flow.predict(frame, [])
+            elapsed += time.perf_counter() - start
+            # no tracks, so only moving points keep tiles active
+            SSDDetector.select_tiles(tiler, np.empty((0, 4)), flow.bg_outliers)
+        skipped_ratio = tiler.num_tiles_skipped / (tiler.num_selections * tiler.batch_size)
+        if skipped_ratio == 0:
+            idle_modes.append(camera_motion)
+        print(f'{camera_motion:>15}{skipped_ratio:>15.1%}'
+              f'{elapsed * 1000 / args.num_frames:>14.3f}')
+    if idle_modes:
+        sys.exit('No tiles skipped with camera motion: ' + ', '.join(idle_modes))
+
+
+def parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--repeat', type=int, default=50, help='number of timed runs')
+    subparsers = parser.add_subparsers(dest='kernel', required=True)
+
+    merge = subparsers.add_parser('merge', help='SSD tile merge')
+    merge.add_argument('--counts', type=int, nargs='+', default=[50, 100, 200, 400, 800, 1600],
+                       help='raw detection counts')
+    merge.add_argument('--model', default='SSDInceptionV2', help='SSD model for tile geometry')
+    merge.add_argument('--size', type=int, nargs=2, default=[1280, 720], help='frame size')
+    merge.add_argument('--tiling-grid', type=int, nargs=2, default=[4, 2], help='tile layout')
+    merge.set_defaults(func=bench_merge)
+
+    nms_parser = subparsers.add_parser('nms', help='YOLO class-batched NMS')
+    nms_parser.add_argument('--counts', type=int, nargs='+', default=[250, 1000, 2000, 4000],
+                            help='candidate box counts')
+    nms_parser.add_argument('--num-classes', type=int, default=1, help='number of classes')
+    nms_parser.add_argument('--nms-thresh', type=float, default=0.5, help='overlap threshold')
+    nms_parser.add_argument('--size', type=int, nargs=2, default=[1920, 1080],
+                            help='frame size')
+    nms_parser.set_defaults(func=bench_nms)
+
+    greedy = subparsers.add_parser('greedy', help='greedy matching')
+    greedy.add_argument('--counts', type=int, nargs='+', default=[10, 50, 100, 200],
+                        help='cost matrix sizes')
+    greedy.add_argument('--max-cost', type=float, default=0.5, help='max matching cost')
+    greedy.add_argument('--sparsity', type=float, default=0.8,
+                        help='fraction of gated entries')
+    greedy.set_defaults(func=bench_greedy)
+
+    pyramid = subparsers.add_parser('pyramid', help='optical flow pyramid construction')
+    pyramid.add_argument('--scale-factors', type=float, nargs='+', default=[0.25, 0.5, 0.75, 1.],
+                         help='optical flow scale factors')
+    pyramid.add_argument('--num-points', type=int, default=200, help='number of tracked points')
+    pyramid.add_argument('--size', type=int, nargs=2, default=[1280, 720], help='frame size')
+    pyramid.set_defaults(func=bench_pyramid)
+
+    initflow = subparsers.add_parser('initflow', help='optical flow from predicted positions')
+    initflow.add_argument('--shift', type=float, nargs=2, default=[12., 4.],
+                          help='frame motion in pixels at optical flow scale')
+    initflow.add_argument('--noise', type=float, default=1., help='prediction noise in pixels')
+    initflow.add_argument('--max-level', type=int, default=5, help='max pyramid level')
+    initflow.add_argument('--max-iter', type=int, default=5, help='max iterations')
+    initflow.add_argument('--num-points', type=int, default=500, help='number of points')
+    initflow.add_argument('--size', type=int, nargs=2, default=[640, 360],
+                          help='optical flow frame size')
+    initflow.set_defaults(func=bench_initflow)
+
+    tiles_parser = subparsers.add_parser('tiles', help='SSD tile skipping per camera motion')
+    tiles_parser.add_argument('--camera-motions', nargs='+',
+                              choices=['static', 'translation', 'affine', 'homography', 'auto'],
+                              default=['static', 'homography', 'auto'],
+                              help='camera motion models')
+    tiles_parser.add_argument('--num-frames', type=int, default=60, help='number of frames')
+    tiles_parser.add_argument('--refresh-interval', type=int, default=10,
+                              help='tile refresh interval')
+    tiles_parser.add_argument('--model', default='SSDInceptionV2',
+                              help='SSD model for tile geometry')
+    tiles_parser.add_argument('--size', type=int, nargs=2, default=[1280, 720], help='frame size')
+    tiles_parser.add_argument('--tiling-grid', type=int, nargs=2, default=[4, 2],
+                              help='tile layout')
+    tiles_parser.set_defaults(func=bench_tiles)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
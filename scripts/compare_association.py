@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Compares cascade and global association on MOT Challenge sequences.
+
+Each sequence is tracked with public detections in both association modes.
+Embeddings are identical for all detections so that only motion and age
+priority drive association, and no GPU is required. The report shows
+association latency, agreement of the visible tracks between modes, and
+MOTA against ground truth when gt/gt.txt is available.
+
+Global association minimizes the total cost of a single assignment, so it
+prefers more matches over age priority. For the tracks of the global run,
+the report also counts primary matches global association adds over the
+cascade, and detections the cascade gives to a younger track than global.
+
+Usage:
+    python3 scripts/compare_association.py MOT20/train/MOT20-01 MOT20/train/MOT20-02
+"""
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+import argparse
+import configparser
+import json
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from fastmot.detector import PublicDetector
+from fastmot.tracker import Association, MultiTracker
+from fastmot.utils import ConfigDecoder, Profiler
+from fastmot.utils.rect import to_tlbr, bbox_ious, find_occluded
+
+
+def read_sequence(seq_root):
+    """Returns the frame size, frame rate, and frame paths of a sequence."""
+    seqinfo = configparser.ConfigParser()
+    seqinfo.read(seq_root / 'seqinfo.ini')
+    seq = seqinfo['Sequence']
+    size = (int(seq['imWidth']), int(seq['imHeight']))
+    frame_paths = sorted((seq_root / seq.get('imDir', 'img1')).glob('*' + seq['imExt']))
+    return size, float(seq['frameRate']), frame_paths
+
+
+def primary_differences(tracker, detections, embeddings):
+    """Returns the number of extra primary matches of global association over the
+    cascade, and the number of detections the cascade gives to a younger track."""
+    occluded_det_mask = find_occluded(detections.tlbr, tracker.occlusion_thresh)
+    confirmed_by_depth, _ = tracker._group_tracks_by_depth()
+    args = (confirmed_by_depth, list(range(len(detections))), detections, embeddings,
+            occluded_det_mask)
+    cascade = {det_id: trk_id for trk_id, det_id in tracker._associate_cascade(*args)[0]}
+    global_ = {det_id: trk_id for trk_id, det_id in tracker._associate_global(*args)[0]}
+    depths = {trk_id: depth for depth, trk_ids in enumerate(confirmed_by_depth)
+              for trk_id in trk_ids}
+    inversions = sum(det_id in global_ and depths[global_[det_id]] > depths[trk_id]
+                     for det_id, trk_id in cascade.items())
+    return len(global_) - len(cascade), inversions
+
+
+def run_tracker(seq_root, association, mot_cfg, max_frames, differences=None):
+    """Tracks a sequence and returns visible tracks as {frame_id: {trk_id: tlbr}}.
+    Primary association differences are accumulated in `differences` if given."""
+    size, frame_rate, frame_paths = read_sequence(seq_root)
+    frame_skip = mot_cfg.detector_frame_skip
+    detector_cfg = dict(vars(mot_cfg.public_detector_cfg))
+    detector_cfg['sequence_path'] = str(seq_root.resolve())
+    detector = PublicDetector(size, (1,), frame_skip, **detector_cfg)
+    tracker_cfg = dict(vars(mot_cfg.tracker_cfg))
+    tracker_cfg['association'] = association
+    tracker = MultiTracker(size, 'cosine', **tracker_cfg)
+    tracker.reset(1 / frame_rate)
+
+    results = {}
+    for frame_id, frame_path in enumerate(frame_paths[:max_frames]):
+        frame = cv2.imread(str(frame_path))
+        if frame_id == 0:
+            tracker.init(frame, detector.postprocess())
+        elif frame_id % frame_skip == 0:
+            tracker.compute_flow(frame)
+            detections = detector.postprocess()
+            tracker.apply_kalman()
+            embeddings = np.ones((len(detections), 1))
+            if differences is not None:
+                extra_matches, inversions = primary_differences(tracker, detections, embeddings)
+                differences['extra matches'] += extra_matches
+                differences['inversions'] += inversions
+            with Profiler(association):
+                tracker.update(frame_id, detections, embeddings)
+        else:
+            tracker.track(frame)
+        results[frame_id] = {trk_id: track.tlbr.copy() for trk_id, track in
+                             tracker.tracks.items() if track.confirmed and track.active}
+    return results
+
+
+def agreement(results1, results2):
+    """Returns the fraction of frames with identical visible tracks and the first
+    frame that differs."""
+    first_diff = None
+    num_equal = 0
+    for frame_id, tracks1 in results1.items():
+        tracks2 = results2[frame_id]
+        if tracks1.keys() == tracks2.keys() and all(np.array_equal(tlbr, tracks2[trk_id])
+                                                     for trk_id, tlbr in tracks1.items()):
+            num_equal += 1
+        elif first_diff is None:
+            first_diff = frame_id
+    return num_equal / max(len(results1), 1), first_diff
+
+
+def read_ground_truth(seq_root):
+    """Returns pedestrian ground truth as {frame_id: {obj_id: tlbr}}."""
+    gt_txt = seq_root / 'gt' / 'gt.txt'
+    if not gt_txt.exists():
+        return None
+    gt = {}
+    for row in np.loadtxt(gt_txt, delimiter=',', ndmin=2):
+        # only evaluated pedestrians are considered
+        if row[6] == 0 or row[7] != 1:
+            continue
+        gt.setdefault(int(row[0]) - 1, {})[int(row[1])] = to_tlbr(row[2:6])
+    return gt
+
+
+def mota(results, gt, iou_thresh=0.5):
+    """Computes MOTA, counting ID switches of ground truth objects."""
+    num_gt = num_errors = num_switches = 0
+    last_match = {}
+    for frame_id, tracks in results.items():
+        objects = gt.get(frame_id, {})
+        obj_ids, trk_ids = list(objects), list(tracks)
+        num_gt += len(obj_ids)
+        num_matches = 0
+        if len(obj_ids) > 0 and len(trk_ids) > 0:
+            ious = bbox_ious(np.array([objects[i] for i in obj_ids]),
+                             np.array([tracks[i] for i in trk_ids]))
+            for row, col in zip(*linear_sum_assignment(-ious)):
+                if ious[row, col] >= iou_thresh:
+                    num_matches += 1
+                    obj_id, trk_id = obj_ids[row], trk_ids[col]
+                    if last_match.get(obj_id, trk_id) != trk_id:
+                        num_switches += 1
+                    last_match[obj_id] = trk_id
+        num_errors += len(obj_ids) - num_matches + len(trk_ids) - num_matches
+    return 1 - (num_errors + num_switches) / max(num_gt, 1)
+
+
+def parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sequences', nargs='+', help='MOT Challenge sequence directories')
+    parser.add_argument('-c', '--config', metavar="FILE",
+                        default=Path(__file__).parents[1] / 'cfg' / 'mot.json',
+                        help='path to JSON configuration file')
+    parser.add_argument('-s', '--frame-skip', type=int, help='override detector frame skip')
+    parser.add_argument('-n', '--max-frames', type=int, help='max number of frames per sequence')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.config) as cfg_file:
+        config = json.load(cfg_file, cls=ConfigDecoder,
+                           object_hook=lambda d: SimpleNamespace(**d))
+    mot_cfg = config.mot_cfg
+    if args.frame_skip is not None:
+        mot_cfg.detector_frame_skip = args.frame_skip
+
+    modes = [association.name.lower() for association in Association]
+    # keep JIT compilation and lazy initialization out of the timing
+    for mode in modes:
+        run_tracker(Path(args.sequences[0]), mode, mot_cfg, args.max_frames)
+    print(f"{'sequence':<16}" + ''.join(f"{mode + ' (ms)':>15}" for mode in modes) +
+          f"{'agreement':>11}{'1st diff':>10}{'extra matches':>15}{'inversions':>12}" +
+          ''.join(f"{mode + ' MOTA':>14}" for mode in modes))
+    for seq in args.sequences:
+        seq_root = Path(seq)
+        Profiler.reset()
+        differences = {'extra matches': 0, 'inversions': 0}
+        results = [run_tracker(seq_root, mode, mot_cfg, args.max_frames,
+                               differences if mode == 'global' else None) for mode in modes]
+        millis = ''.join(f'{Profiler.get_avg_millis(mode):>15.3f}' for mode in modes)
+        ratio, first_diff = agreement(*results)
+        line = (f'{seq_root.name:<16}{millis}{ratio:>11.1%}{str(first_diff):>10}'
+                f"{differences['extra matches']:>15}{differences['inversions']:>12}")
+        gt = read_ground_truth(seq_root)
+        if gt is not None:
+            line += ''.join(f'{mota(result, gt):>14.1%}' for result in results)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
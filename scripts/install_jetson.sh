@@ -46,3 +46,7 @@ sudo -H LLVM_CONFIG=/usr/bin/llvm-config-8 pip3 install numba==0.48
 # CuPy
 echo "Installing CuPy, this may take a while..."
 sudo -H CUPY_NVCC_GENERATE_CODE="current" CUPY_NUM_BUILD_JOBS=$(nproc) pip3 install cupy==9.2
+
+# Precompile Numba kernels
+echo "Precompiling Numba kernels, this may take a while..."
+cd "$(dirname "$0")/.." && python3 -m fastmot.warmup